@@ -1,9 +1,10 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
-from django.db import connection
+from django.db import connection, transaction
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import Book, BookSubscription, Checkout, CustomUser, Reservation
+from .book_cache import invalidate_books
+from .models import Book, BookCopy, BookSubscription, Checkout, CustomUser, FineRun, OutboxMessage, ReportJob, Reservation
 from .forms import UserRegisterForm
 from accounts import models
 
@@ -11,8 +12,9 @@ class CustomUserAdmin(UserAdmin):
     model = CustomUser
     add_form = UserRegisterForm
     
-    list_display = ['username', 'email', 'get_user_type_display', 'is_staff']
+    list_display = ['username', 'email', 'get_user_type_display', 'is_staff', 'active_loans', 'overdue_loans', 'fine_balance']
     list_filter = ['user_type', 'is_staff', 'is_superuser']
+    readonly_fields = ['active_loans', 'overdue_loans', 'fine_balance']
     search_fields = ['username', 'email', 'first_name', 'last_name']
     ordering = ['username']
     
@@ -26,6 +28,7 @@ class CustomUserAdmin(UserAdmin):
                       'groups', 'user_permissions', 'user_type'),
         }),
         ('Important Dates', {'fields': ('last_login', 'date_joined')}),
+        ('Loans', {'fields': ('active_loans', 'overdue_loans', 'fine_balance')}),
     )
     
     add_fieldsets = (
@@ -59,9 +62,8 @@ class BookAdmin(admin.ModelAdmin):
     actions = ['reset_availability','send_new_book_notifications']
     
     def send_new_book_notifications(self, request, queryset):
-        for book in queryset:
-            book.notify_subscribers_about_new_book()
-        self.message_user(request, f"Notifications sent for {queryset.count()} books")
+        queued = sum(book.notify_subscribers_about_new_book() for book in queryset)
+        self.message_user(request, f"{queued} notifications queued for {queryset.count()} books")
     send_new_book_notifications.short_description = "Send new book notifications"
 
     def available_copies(self, obj):
@@ -78,9 +80,12 @@ class BookAdmin(admin.ModelAdmin):
     is_available.short_description = 'Available?'
     
     def reset_availability(self, request, queryset):
-        updated = queryset.update(available=models.F('quantity'))
-        self.message_user(request, f"{updated} books availability reset")
-    reset_availability.short_description = "Reset available copies to total"
+        # `available` is the number of copies on the shelf, so recount it from them
+        pks = list(queryset.values_list('pk', flat=True))
+        updated = Book.recount_available(pks)
+        invalidate_books(*pks)
+        self.message_user(request, f"{updated} books availability recounted from their copies")
+    reset_availability.short_description = "Recount available copies from the shelf"
     
     def delete_model(self, request, obj):
         try:
@@ -92,10 +97,41 @@ class BookAdmin(admin.ModelAdmin):
                         "DELETE FROM accounts_book WHERE id = %s",
                         [obj.id]
                     )
+                invalidate_books(obj.id)
                 self.message_user(request, "Book deleted (used emergency method)")
             else:
                 raise
 
+@admin.register(BookCopy)
+class BookCopyAdmin(admin.ModelAdmin):
+    list_display = ['barcode', 'book', 'status', 'checkout']
+    list_filter = ['status']
+    search_fields = ['barcode', 'book__title', 'book__isbn']
+    raw_id_fields = ['book', 'checkout']
+    readonly_fields = ['status', 'checkout']
+
+@admin.register(FineRun)
+class FineRunAdmin(admin.ModelAdmin):
+    list_display = ['as_of', 'incremental', 'started_at', 'finished_at', 'updated', 'skipped']
+    list_filter = ['incremental']
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ['kind', 'member', 'object_id', 'status', 'attempts', 'next_attempt_at', 'sent_at']
+    list_filter = ['status', 'kind']
+    raw_id_fields = ['member']
+    actions = ['retry_now']
+
+    @admin.action(description='Retry now (including dead letters)')
+    def retry_now(self, request, queryset):
+        count = queryset.exclude(status=OutboxMessage.SENT).update(
+            status=OutboxMessage.PENDING, attempts=0, next_attempt_at=timezone.now(),
+        )
+        self.message_user(request, f"{count} notifications requeued")
+
 @admin.register(Checkout)
 class CheckoutAdmin(admin.ModelAdmin):
     list_display = [
@@ -134,18 +170,14 @@ class CheckoutAdmin(admin.ModelAdmin):
     def mark_returned(self, request, queryset):
         updated = 0
         for checkout in queryset:
-            if not checkout.returned:
-                checkout.returned = True
-                checkout.return_date = timezone.now()
-                checkout.book.return_copy()
-                checkout.save()
+            if checkout.mark_returned():
                 updated += 1
         self.message_user(request, f"{updated} checkouts marked as returned")
     mark_returned.short_description = "Mark selected as returned"
 
     def recalculate_fines(self, request, queryset):
         for checkout in queryset:
-            checkout.calculate_fine()
+            checkout.save()  # recalculates the fine and the member's balance
         self.message_user(request, "Fines recalculated")
     recalculate_fines.short_description = "Recalculate fines for selected checkouts"
 
@@ -159,31 +191,33 @@ class CheckoutAdmin(admin.ModelAdmin):
         self.message_user(request, f"{overdue.count()} overdue notices sent")
     
     def send_due_notifications(self, request, queryset):
-        count = 0
-        for checkout in queryset:
-            checkout.send_due_notification()
-            count += 1
-        self.message_user(request, f"{count} notifications sent")
+        queued = OutboxMessage.enqueue(OutboxMessage.DUE, queryset.values_list('member_id', 'pk'))
+        self.message_user(request, f"{len(queued)} notifications queued")
     send_due_notifications.short_description = "Send due date notifications"
 
 @admin.register(Reservation)
 class ReservationAdmin(admin.ModelAdmin):
+    list_display = ('member', 'book', 'reservation_date', 'queue_position', 'copy', 'expiry_date', 'fulfilled', 'expired')
+    list_filter = ('fulfilled', 'expired')
+    list_select_related = ('member', 'book', 'copy')
+    raw_id_fields = ('copy',)
     actions = ['send_available_notifications']
     
     def send_available_notifications(self, request, queryset):
-        count = 0
-        for reservation in queryset:
-            reservation.send_available_notification()
-            reservation.notified = True
-            reservation.save()
-            count += 1
-        self.message_user(request, f"{count} notifications sent")
-    send_available_notifications.short_description = "Send availability notifications"
+        with transaction.atomic():
+            queued = Reservation.allocate_holds(queryset.values_list('book_id', flat=True))
+        self.message_user(request, f"{queued} copies put on hold, notifications queued")
+    send_available_notifications.short_description = "Hold free copies for the front of the queue"
 
 @admin.register(BookSubscription)
 class BookSubscriptionAdmin(admin.ModelAdmin):
-    list_display = ('member', 'genre', 'is_active')
-    list_filter = ('genre', 'is_active')
+    list_display = ('member', 'genre', 'frequency', 'is_active')
+    list_filter = ('genre', 'frequency', 'is_active')
     search_fields = ('member__username', 'member__email')
 
-
+@admin.register(ReportJob)
+class ReportJobAdmin(admin.ModelAdmin):
+    list_display = ('report', 'format', 'status', 'requests', 'requested_by', 'created_at', 'finished_at', 'attempts')
+    list_filter = ('report', 'format', 'status')
+    list_select_related = ('requested_by',)
+    readonly_fields = ('key',)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import time
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+BOOK_CACHE_TIMEOUT = 60 * 60  # versioned keys go stale on their own, this just frees memory
+CATALOG_VERSION_KEY = 'books:catalog:version'
+HITS_KEY = 'books:cache:hits'
+MISSES_KEY = 'books:cache:misses'
+CASE_SENSITIVE = {'cursor'}  # signed pagination cursors
+
+
+def _book_version_key(pk):
+    return f'books:{pk}:version'
+
+
+def _current_version(key):
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 1, so an evicted version key
+        # can't bring old entries back to life
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def _shared():
+    """
+    A per-process cache never hears about version bumps made by other web
+    workers or by management commands, so it would keep serving stale books
+    until the timeout. Caching is skipped altogether in one.
+    """
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def _digest(parts):
+    """Stable hash of search parameters, ignoring case (cursors aside), whitespace and empty values"""
+    normalized = {
+        name: str(value) if name in CASE_SENSITIVE else ' '.join(str(value).lower().split())
+        for name, value in parts.items()
+        if value not in (None, '')
+    }
+    return hashlib.md5(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+def _read_through(key, loader, timeout):
+    value = cache.get(key)
+    if value is None:
+        _count(MISSES_KEY)
+        value = loader()
+        cache.set(key, value, timeout)
+    else:
+        _count(HITS_KEY)
+    return value
+
+
+def invalidate_books(*pks):
+    """
+    Make cached copies of these books, and every cached catalog page, unreachable.
+    Runs after commit, otherwise a reader could cache the old row under the new version.
+    """
+    def bump():
+        for pk in pks:
+            _bump(_book_version_key(pk))
+        _bump(CATALOG_VERSION_KEY)
+    transaction.on_commit(bump)
+
+
+def get_book(pk):
+    """Book by primary key, read through the cache. Raises Book.DoesNotExist like .get()"""
+    from .models import Book  # Import here to avoid circular imports
+
+    if not _shared():
+        return Book.objects.get(pk=pk)
+    key = f'books:{pk}:v{_current_version(_book_version_key(pk))}'
+    return _read_through(key, lambda: Book.objects.get(pk=pk), BOOK_CACHE_TIMEOUT)
+
+
+def get_catalog(name, parts, loader, timeout=BOOK_CACHE_TIMEOUT):
+    """
+    Read-through cache for anything derived from the whole catalog (list pages, facets).
+    Entries are keyed by the catalog version, so any book change retires all of them.
+    """
+    if not _shared():
+        return loader()
+    key = f'books:{name}:v{_current_version(CATALOG_VERSION_KEY)}:{_digest(parts)}'
+    return _read_through(key, loader, timeout)
+
+
+def cache_stats():
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / lookups, 4) if lookups else None,
+    }
@@ -0,0 +1,25 @@
+from django.utils.functional import SimpleLazyObject
+
+from .models import BookSubscription
+
+
+def get_subscribed_genres(request):
+    """
+    Genres the current user has active subscriptions for.
+    Loaded with one query the first time it's asked for, then cached on the request.
+    """
+    if not hasattr(request, '_subscribed_genres'):
+        user = request.user
+        if user.is_authenticated:
+            request._subscribed_genres = frozenset(
+                BookSubscription.objects.filter(member=user, is_active=True)
+                .values_list('genre', flat=True)
+            )
+        else:
+            request._subscribed_genres = frozenset()
+    return request._subscribed_genres
+
+
+def subscriptions(request):
+    # Lazy so pages that never look at subscriptions don't pay for the query
+    return {'subscribed_genres': SimpleLazyObject(lambda: get_subscribed_genres(request))}
@@ -0,0 +1,223 @@
+import csv
+import datetime
+import zipfile
+from decimal import Decimal
+from xml.sax.saxutils import escape
+
+from django.http import StreamingHttpResponse
+from django.shortcuts import redirect
+from django.utils import timezone
+
+from .models import ReportJob
+
+CHUNK_SIZE = 2000  # rows per fetch from the server-side cursor
+
+# Every column a loan export can have: header, the fields it needs loaded, and how to read it
+COLUMNS = {
+    'id': ('Loan', ('id',), lambda loan: loan.pk),
+    'book': ('Book', ('book__title',), lambda loan: loan.book.title),
+    'isbn': ('ISBN', ('book__isbn',), lambda loan: loan.book.isbn),
+    'author': ('Author', ('book__author',), lambda loan: loan.book.author),
+    'member': ('Member', ('member__username',), lambda loan: loan.member.username),
+    'member_name': ('Member Name', ('member__first_name', 'member__last_name'), lambda loan: loan.member.get_full_name()),
+    'member_email': ('Email', ('member__email',), lambda loan: loan.member.email),
+    'quantity': ('Copies', ('quantity',), lambda loan: loan.quantity),
+    'checkout_date': ('Checked Out', ('checkout_date',), lambda loan: loan.checkout_date),
+    'due_date': ('Due Date', ('due_date',), lambda loan: loan.due_date),
+    'returned': ('Returned', ('returned',), lambda loan: loan.returned),
+    'return_date': ('Return Date', ('return_date',), lambda loan: loan.return_date),
+    'days_overdue': ('Days Overdue', ('returned', 'due_date'), lambda loan: loan.days_overdue),
+    'total_fine': ('Fine', ('total_fine',), lambda loan: loan.total_fine),
+}
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+
+def selected_columns(request, default):
+    """?columns=book,member,due_date picks and orders the columns; unknown names are ignored"""
+    requested = [name.strip() for name in request.GET.get('columns', '').split(',')]
+    return [name for name in requested if name in COLUMNS] or list(default)
+
+
+def export_rows(queryset, columns):
+    """The header, then one list of values per loan, fetched in chunks so memory stays flat"""
+    fields = set().union(*(COLUMNS[name][1] for name in columns))
+    related = sorted({field.split('__')[0] for field in fields} & {'book', 'member'})
+    queryset = queryset.select_related(None).select_related(*related).only(*fields)
+    yield [COLUMNS[name][0] for name in columns]
+    for loan in queryset.iterator(chunk_size=CHUNK_SIZE):
+        yield [COLUMNS[name][2](loan) for name in columns]
+
+
+class Echo:
+    """Just enough of a file for csv.writer; write() hands the line straight back"""
+
+    def write(self, value):
+        return value
+
+
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_cell(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localtime(value).strftime('%Y-%m-%d %H:%M')
+    # Names and usernames are typed in by members; don't let a spreadsheet run them as formulas
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_stream(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow([csv_cell(value) for value in row])
+
+
+class ZipOutput:
+    """A write-only, unseekable file for zipfile; take() empties what's been written so far"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Report" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    # Style 1 is a date-time format, for the datetime cells
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd hh:mm"/></numFmts>'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+
+EXCEL_EPOCH = datetime.datetime(1899, 12, 30)
+
+
+def xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float, Decimal)):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, datetime.datetime):
+        serial = (timezone.localtime(value).replace(tzinfo=None) - EXCEL_EPOCH) / datetime.timedelta(days=1)
+        return f'<c s="1"><v>{serial:.6f}</v></c>'
+    return f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>'
+
+
+def xlsx_stream(rows):
+    """
+    A one-sheet workbook, written row by row into a zip that's never seeked,
+    so every few hundred rows' worth of compressed bytes can go straight out.
+    Strings are inline rather than in a shared table, which would need every
+    row before the first could be written.
+    """
+    output = ZipOutput()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        for name, xml in XLSX_PARTS.items():
+            workbook.writestr(name, xml)
+        yield output.take()
+
+        with workbook.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            for number, row in enumerate(rows, 1):
+                sheet.write(f'<row r="{number}">{"".join(xlsx_cell(value) for value in row)}</row>'.encode())
+                if number % 500 == 0 and output.chunks:
+                    yield output.take()
+            sheet.write(b'</sheetData></worksheet>')
+    yield output.take()
+
+
+def export_response(request, queryset, filename, default_columns):
+    """
+    Stream `queryset` as the CSV or XLSX named by ?export=, or None if no
+    export was asked for. Filtering and ordering are the caller's.
+    """
+    export = request.GET.get('export')
+    if export not in EXPORT_FORMATS:
+        return None
+    rows = export_rows(queryset, selected_columns(request, default_columns))
+    if export == 'csv':
+        response = StreamingHttpResponse(csv_stream(rows), content_type='text/csv')
+    else:
+        response = StreamingHttpResponse(
+            xlsx_stream(rows), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        )
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{export}"'
+    return response
+
+
+class ExportMixin:
+    """
+    Adds ?export=csv|xlsx (and ?columns=) to a list view, over the same
+    get_queryset() as the page itself, in `export_ordering`. Views naming an
+    `export_report` also take ?async=1, which queues the export as a ReportJob.
+    """
+    export_filename = 'report'
+    export_columns = ('id', 'book', 'member', 'checkout_date', 'due_date', 'total_fine')
+    export_ordering = ('id',)
+    export_report = None
+
+    def get(self, request, *args, **kwargs):
+        export = request.GET.get('export')
+        if self.export_report and export in EXPORT_FORMATS and request.GET.get('async'):
+            columns = selected_columns(request, self.export_columns)
+            job = ReportJob.request(self.export_report, export, columns, request.user)
+            return redirect('report-job', pk=job.pk)
+        response = export_response(
+            request, self.get_queryset().order_by(*self.export_ordering), self.export_filename, self.export_columns,
+        )
+        return response or super().get(request, *args, **kwargs)
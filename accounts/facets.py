@@ -0,0 +1,55 @@
+from django.db import connections
+
+from .book_cache import get_catalog
+from .models import Book
+
+FACET_CACHE_TIMEOUT = 60  # seconds
+MAX_PUBLISHER_FACETS = 10
+
+# One scan of the filtered books, grouped four ways at once.
+# GROUPING(...) says which of the four sets a result row belongs to.
+FACET_SQL = """
+    SELECT GROUPING(genre, publisher, on_shelf, decade), genre, publisher, on_shelf, decade, COUNT(*)
+    FROM (
+        SELECT genre, publisher, available > 0 AS on_shelf,
+               (EXTRACT(YEAR FROM publication_date)::int / 10) * 10 AS decade
+        FROM ({books}) AS filtered
+    ) AS facets
+    GROUP BY GROUPING SETS ((genre), (publisher), (on_shelf), (decade))
+"""
+
+# Bitmask values from GROUPING(genre, publisher, on_shelf, decade)
+GENRE_SET, PUBLISHER_SET, SHELF_SET, DECADE_SET = 0b0111, 0b1011, 0b1101, 0b1110
+
+
+def compute_book_facets(books):
+    """Genre, publisher, availability and decade counts for `books` in a single query"""
+    sql, params = books.order_by().values('genre', 'publisher', 'available', 'publication_date').query.sql_with_params()
+    with connections[books.db].cursor() as cursor:
+        cursor.execute(FACET_SQL.format(books=sql), params)
+        rows = cursor.fetchall()
+
+    genre_names = dict(Book.GENRE_CHOICES)
+    facets = {'genre': [], 'publisher': [], 'availability': [], 'decade': []}
+    for grouping, genre, publisher, on_shelf, decade, count in rows:
+        if grouping == GENRE_SET:
+            facets['genre'].append((genre, genre_names.get(genre, genre), count))
+        elif grouping == PUBLISHER_SET:
+            facets['publisher'].append((publisher, publisher, count))
+        elif grouping == SHELF_SET:
+            facets['availability'].append(
+                ('yes', 'Available', count) if on_shelf else ('no', 'Checked out', count)
+            )
+        elif grouping == DECADE_SET:
+            facets['decade'].append((decade, f'{decade}s', count))
+
+    facets['genre'].sort(key=lambda facet: -facet[2])
+    facets['publisher'] = sorted(facets['publisher'], key=lambda facet: -facet[2])[:MAX_PUBLISHER_FACETS]
+    facets['availability'].sort()
+    facets['decade'].sort(reverse=True)
+    return facets
+
+
+def book_facets(books, search):
+    """Facet counts for a search, served from a short-lived cache when possible"""
+    return get_catalog('facets', search, lambda: compute_book_facets(books), FACET_CACHE_TIMEOUT)
@@ -1,8 +1,45 @@
 from django.utils import timezone
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
+from django.urls import reverse_lazy
+from django.utils.http import urlencode
 from .models import Book, Checkout, CustomUser, BookRequest  # Add BookRequestfrom django.core.exceptions import ValidationError
 
+
+class AutocompleteSelect(forms.Select):
+    """
+    Select that only renders the currently chosen option.
+    The rest are fetched from the autocomplete endpoint as the user types,
+    so the page never materialises the whole table.
+    """
+    def __init__(self, url, params=None, attrs=None, forward=None):
+        super().__init__(attrs)
+        self.url = url
+        self.params = params or {}
+        self.forward = forward  # another field in the form whose value goes along with each lookup
+
+    def build_attrs(self, base_attrs, extra_attrs=None):
+        attrs = super().build_attrs(base_attrs, extra_attrs)
+        url = str(self.url)
+        if self.params:
+            url = f"{url}?{urlencode(self.params)}"
+        attrs['data-autocomplete-url'] = url
+        if self.forward:
+            attrs['data-autocomplete-forward'] = self.forward
+        return attrs
+
+    def optgroups(self, name, value, attrs=None):
+        iterator = self.choices
+        self.choices = [('', '---------')]
+        selected = [v for v in value if str(v).isdigit()]
+        if selected:
+            self.choices += [iterator.choice(obj) for obj in iterator.queryset.filter(pk__in=selected)]
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = iterator
+
+
 class CheckoutForm(forms.ModelForm):
     quantity = forms.IntegerField(
         min_value=1,
@@ -21,14 +58,23 @@ class CheckoutForm(forms.ModelForm):
                 'type': 'datetime-local',
                 'class': 'form-control'
             }),
-            'book': forms.Select(attrs={'class': 'form-control'}),
-            'member': forms.Select(attrs={'class': 'form-control'}),
+            'book': AutocompleteSelect(
+                reverse_lazy('book-autocomplete'),
+                params={'available': 1},
+                attrs={'class': 'form-control'},
+                forward='member',
+            ),
+            'member': AutocompleteSelect(
+                reverse_lazy('member-autocomplete'),
+                attrs={'class': 'form-control'}
+            ),
         }
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # Only show available books
-        self.fields['book'].queryset = Book.objects.filter(available__gt=0)
+        # Only books with a copy to lend, counting any held for the chosen member's reservation
+        member_id = self.data.get('member') if str(self.data.get('member', '')).isdigit() else None
+        self.fields['book'].queryset = Book.objects.filter(Book.lendable_filter(member_id))
         # Only show members
         self.fields['member'].queryset = CustomUser.objects.filter(user_type=3)
         
@@ -39,12 +85,14 @@ class CheckoutForm(forms.ModelForm):
     def clean(self):
         cleaned_data = super().clean()
         book = cleaned_data.get('book')
+        member = cleaned_data.get('member')
         quantity = cleaned_data.get('quantity', 1)
         
         if book and quantity:
-            if book.available < quantity:
+            available = book.available_to(member.pk if member else None)
+            if available < quantity:
                 raise forms.ValidationError(
-                    f"Only {book.available} copy(s) available - you requested {quantity}"
+                    f"Only {available} copy(s) available - you requested {quantity}"
                 )
         return cleaned_data
 
@@ -106,8 +154,9 @@ class UserUpdateForm(forms.ModelForm):
 class BookForm(forms.ModelForm):
     class Meta:
         model = Book
-        fields = fields = ['title', 'author', 'genre', 'isbn', 'publisher', 
-                 'publication_date', 'quantity', 'available', 
+        # 'available' is counted from the physical copies, so it isn't editable
+        fields = ['title', 'author', 'genre', 'isbn', 'publisher', 
+                 'publication_date', 'quantity', 
                  'description', 'cover_image', 'notify_subscribers']
         widgets = {
             'title': forms.TextInput(attrs={'class': 'form-control'}),
@@ -122,22 +171,32 @@ class BookForm(forms.ModelForm):
                 'class': 'form-control',
                 'min': 1
             }),
-            'available': forms.NumberInput(attrs={
-                'class': 'form-control',
-                'min': 0
-            }),
             'description': forms.Textarea(attrs={
                 'class': 'form-control',
                 'rows': 3
             }),
         }
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        if not self.instance.pk and 'quantity' in self.initial:
-            self.initial['available'] = self.initial['quantity']
+    def clean_quantity(self):
+        quantity = self.cleaned_data['quantity']
+        if self.instance.pk:
+            # Only shelf copies can be removed; lent and held ones stay
+            off_shelf = self.instance.copies.filter(status__in=['ON_LOAN', 'ON_HOLD']).count()
+            if quantity < off_shelf:
+                raise forms.ValidationError(
+                    f"{off_shelf} copy(s) are out on loan or on hold - total can't go below that"
+                )
+        return quantity
 
 class BookSearchForm(forms.Form):
+    q = forms.CharField(
+        required=False,
+        label='Search',
+        widget=forms.TextInput(attrs={
+            'class': 'form-control',
+            'placeholder': 'Title, author, publisher, ISBN or "exact phrase"'
+        })
+    )
     title = forms.CharField(
         required=False,
         widget=forms.TextInput(attrs={
@@ -153,7 +212,7 @@ class BookSearchForm(forms.Form):
         })
     )
     genre = forms.ChoiceField(
-        choices=Book.GENRE_CHOICES,
+        choices=[('', 'All genres')] + Book.GENRE_CHOICES,
         required=False,
         widget=forms.Select(attrs={'class': 'form-control'})
     )
@@ -164,6 +223,20 @@ class BookSearchForm(forms.Form):
             'placeholder': 'Publisher'
         })
     )
+    availability = forms.ChoiceField(
+        choices=[('', 'Any'), ('yes', 'Available'), ('no', 'Checked out')],
+        required=False,
+        widget=forms.Select(attrs={'class': 'form-control'})
+    )
+    # Only set from the decade facet links
+    decade = forms.IntegerField(required=False, widget=forms.HiddenInput)
+
+    def clean_decade(self):
+        # A hand-edited decade that date() can't represent just drops the filter
+        decade = self.cleaned_data['decade']
+        if decade is not None and not 1 <= decade <= 9980:
+            return None
+        return decade
 
 
 class BookRequestForm(forms.ModelForm):
@@ -0,0 +1,68 @@
+import threading
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+
+from accounts.models import Book
+
+
+@transaction.atomic
+def locked_checkout(book_id):
+    """The old path: lock the row, then rewrite every column"""
+    book = Book.objects.select_for_update().get(pk=book_id)
+    if book.available <= 0:
+        return False
+    book.available -= 1
+    models.Model.save(book)  # plain full-row write, without Book.save's copy bookkeeping
+    return True
+
+
+def copy_checkout(book_id):
+    return Book(pk=book_id).checkout_copies(1)
+
+
+class Command(BaseCommand):
+    help = 'Measure checkout throughput for N parallel desks hammering one book'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Parallel desks (threads, one DB connection each)')
+        parser.add_argument('--checkouts', type=int, default=200, help='Checkouts per worker')
+
+    def handle(self, *args, **options):
+        for name, checkout in [('select_for_update + save', locked_checkout),
+                               ('SKIP LOCKED copy allocation', copy_checkout)]:
+            elapsed, succeeded, total = self.run(checkout, options['workers'], options['checkouts'])
+            self.stdout.write(
+                f"{name:<28} {succeeded}/{total} checkouts in {elapsed:.2f}s "
+                f"= {succeeded / elapsed:,.0f} checkouts/s"
+            )
+
+    def run(self, checkout, workers, per_worker):
+        total = workers * per_worker
+        book = Book.objects.create(
+            title='Checkout benchmark', author='Benchmark', publisher='Benchmark', genre='NF',
+            isbn=f"X{time.time_ns() % 10 ** 12:012d}", publication_date=date.today(),
+            quantity=total, available=total, notify_subscribers=False,
+        )
+        results = []
+        start = threading.Barrier(workers + 1)
+
+        def desk():
+            start.wait()
+            done = sum(1 for _ in range(per_worker) if checkout(book.pk))
+            results.append(done)
+            connection.close()
+
+        threads = [threading.Thread(target=desk) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - began
+
+        book.delete()
+        return elapsed, sum(results), total
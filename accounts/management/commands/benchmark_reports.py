@@ -0,0 +1,83 @@
+import time
+import tracemalloc
+from datetime import date
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+from accounts.models import Book, Checkout, CustomUser
+from accounts.reports import issued_books_pdf, report_rows
+
+SEED_SQL = """
+    INSERT INTO accounts_checkout (book_id, member_id, quantity, checkout_date, due_date, returned, daily_fine_rate, total_fine)
+    SELECT %(book)s, %(member)s, 1, now() - interval '20 days',
+           now() + make_interval(days => 10 - n %% 30), false, 10, 0
+    FROM generate_series(1, %(rows)s) AS n
+"""
+
+
+def buffered_pdf(checkouts):
+    """The old path: every row loaded, the whole PDF drawn into a BytesIO, then copied out"""
+    buffer = BytesIO()
+    p = canvas.Canvas(buffer, pagesize=letter)
+    y = 680
+    for checkout in list(checkouts):
+        p.drawString(100, y, checkout.book.title[:30])
+        p.drawString(300, y, checkout.member.get_full_name())
+        p.drawString(450, y, checkout.due_date.strftime('%Y-%m-%d'))
+        p.drawString(550, y, "Overdue" if checkout.is_overdue else "On Time")
+        y -= 20
+        if y < 50:
+            p.showPage()
+            y = 750
+    p.showPage()
+    p.save()
+    yield buffer.getvalue()
+
+
+def streamed_pdf(checkouts):
+    return issued_books_pdf(report_rows(checkouts))
+
+
+class Command(BaseCommand):
+    help = 'Compare memory and time-to-first-byte of the buffered and streamed issued books PDF'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100_000, help='Open checkouts to add for the run (rolled back after)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            member = CustomUser.objects.create_user(username=f'bench{time.time_ns()}', first_name='Report', last_name='Bench')
+            book = Book.objects.create(
+                title='Report benchmark', author='Benchmark', publisher='Benchmark', genre='NF',
+                isbn=f"R{time.time_ns() % 10 ** 12:012d}", publication_date=date.today(), notify_subscribers=False,
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(SEED_SQL, {'book': book.pk, 'member': member.pk, 'rows': options['rows']})
+            self.stdout.write(f"{Checkout.objects.filter(returned=False).count():,} open checkouts")
+
+            for name, render in [('BytesIO + getvalue()', buffered_pdf), ('streamed pages', streamed_pdf)]:
+                first_byte, elapsed, size, peak = self.run(render)
+                self.stdout.write(
+                    f"{name:<22} first byte {first_byte:6.2f}s, total {elapsed:6.2f}s, "
+                    f"{size / 2 ** 20:6.1f} MiB PDF, peak Python memory {peak / 2 ** 20:7.1f} MiB"
+                )
+            transaction.set_rollback(True)
+
+    def run(self, render):
+        queryset = Checkout.get_issued_books_report()
+        tracemalloc.start()
+        started = time.perf_counter()
+        first_byte = None
+        size = 0
+        for chunk in render(queryset):
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)  # what the server would write to the socket, then drop
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return first_byte, elapsed, size, peak
@@ -0,0 +1,74 @@
+import itertools
+import random
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from accounts.models import Book
+from accounts.search import icontains_search, search_books
+
+SYLLABLES = ['ka', 'lo', 'mer', 'ri', 'ven', 'sha', 'dow', 'em', 'pi', 'tor',
+             'qua', 'ntu', 'gar', 'den', 'win', 'ste', 'ocu', 'lan', 'bri', 'zo']
+# 8000 made-up words gives realistic selectivity, unlike a handful of real ones
+WORDS = [''.join(parts) for parts in itertools.product(SYLLABLES, repeat=3)]
+
+
+class Command(BaseCommand):
+    help = 'Compare full-text catalog search against the old icontains search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('terms', nargs='*', default=['kalomer', 'rivensha dowempi', 'quantu'])
+        parser.add_argument('--repeat', type=int, default=5, help='Runs per search term')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Insert this many synthetic books first (rolled back afterwards)')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed']:
+                self.seed_books(options['seed'])
+
+            self.stdout.write(f"{'term':<20} {'icontains ms':>14} {'full-text ms':>14} {'hits':>12}")
+            for term in options['terms']:
+                old_ms, old_hits = self.time_search(icontains_search, term, options['repeat'])
+                new_ms, new_hits = self.time_search(search_books, term, options['repeat'])
+                self.stdout.write(
+                    f"{term:<20} {old_ms:>14.2f} {new_ms:>14.2f} {old_hits:>5} / {new_hits:<5}"
+                )
+
+            # Never leave the synthetic rows behind
+            transaction.set_rollback(True)
+
+    def time_search(self, search, term, repeat):
+        """Average time for what book_list does per page: a count plus the first page"""
+        started = time.perf_counter()
+        for _ in range(repeat):
+            books = search(Book.objects.all(), term)
+            hits = books.count()
+            list(books[:10])
+        return (time.perf_counter() - started) * 1000 / repeat, hits
+
+    def seed_books(self, count):
+        rng = random.Random(42)
+        batch = []
+        for i in range(count):
+            batch.append(Book(
+                title=' '.join(rng.sample(WORDS, 3)).title(),
+                author=f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}",
+                publisher=f"{rng.choice(WORDS).title()} Press",
+                genre=rng.choice(Book.GENRE_CHOICES)[0],
+                isbn=f"B{i:012d}",
+                publication_date=date(rng.randint(1950, 2024), 1, 1),
+                description=' '.join(rng.choices(WORDS, k=20)),
+                notify_subscribers=False,
+            ))
+            if len(batch) == 5000:
+                Book.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        Book.objects.bulk_create(batch, ignore_conflicts=True)
+
+        # Fresh statistics so the planner actually considers the GIN index
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE accounts_book')
+        self.stdout.write(f"Seeded {count} books")
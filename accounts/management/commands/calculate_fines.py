@@ -1,20 +1,209 @@
-from datetime import timedelta
-from django.core.management.base import BaseCommand
-from django.utils import timezone
-from accounts.models import Checkout
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone as dt_timezone
+
 from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Max, Min, Sum
+from django.utils import timezone
+
+from accounts.models import FINE_SQL, Checkout, FineRun, FineRunRange
+
+# One chunk of overdue loans with their fine as of %(as_of)s, walked by primary
+# key so each statement touches at most `limit` rows and the locks are short-lived.
+# %(since)s bounds due_date from below, which is what makes incremental runs cheap.
+OVERDUE_CHUNK_SQL = f"""
+    SELECT id, total_fine, {FINE_SQL} AS fine
+    FROM accounts_checkout
+    WHERE id > %(after)s AND id <= %(last)s AND NOT returned
+      AND due_date < %(until)s AND due_date >= %(since)s
+    ORDER BY id
+    LIMIT %(limit)s
+"""
+
+# Members are locked before their loans, the same order as issues and returns
+LOCK_MEMBERS_SQL = f"""
+    SELECT id FROM accounts_customuser
+    WHERE id IN (
+        SELECT member_id FROM accounts_checkout WHERE id IN (SELECT id FROM ({OVERDUE_CHUNK_SQL}) AS chunk)
+    )
+    ORDER BY id
+    FOR UPDATE
+"""
+
+# Only rows whose fine actually moved are written, and their members' counters follow
+UPDATE_FINES_SQL = f"""
+    WITH chunk AS ({OVERDUE_CHUNK_SQL}),
+    updated AS (
+        UPDATE accounts_checkout AS checkout
+        SET total_fine = chunk.fine
+        FROM chunk
+        WHERE checkout.id = chunk.id AND chunk.total_fine IS DISTINCT FROM chunk.fine
+        RETURNING checkout.member_id, chunk.fine - chunk.total_fine AS change,
+                  (chunk.fine > 0)::int - (chunk.total_fine > 0)::int AS started_accruing
+    ),
+    members AS (
+        UPDATE accounts_customuser AS member
+        SET overdue_loans = member.overdue_loans + delta.overdue,
+            fine_balance = member.fine_balance + delta.fines
+        FROM (
+            SELECT member_id, SUM(started_accruing) AS overdue, SUM(change) AS fines
+            FROM updated GROUP BY member_id
+        ) AS delta
+        WHERE member.id = delta.member_id
+    )
+    SELECT (SELECT MAX(id) FROM chunk), (SELECT COUNT(*) FROM chunk),
+           COUNT(*), COALESCE(SUM(change), 0)
+    FROM updated
+"""
+
+PREVIEW_FINES_SQL = f"""
+    WITH chunk AS ({OVERDUE_CHUNK_SQL})
+    SELECT MAX(id), COUNT(*),
+           COUNT(*) FILTER (WHERE total_fine IS DISTINCT FROM fine),
+           COALESCE(SUM(fine - total_fine), 0)
+    FROM chunk
+"""
+
+
+def process_range(sql, params, first_id, last_id, run_id=None):
+    """
+    Fine every loan with first_id <= id <= last_id, one short transaction per chunk.
+    Runs in a pool worker (on that worker's own connection) or inline. Once the
+    whole range is done it's recorded against the run, so a restart skips it;
+    a range cut off halfway is simply redone, which is harmless as `as_of` is fixed.
+    """
+    params = {**params, 'after': first_id - 1, 'last': last_id}
+    checked, updated, change = 0, 0, 0
+    started = time.perf_counter()
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if sql == UPDATE_FINES_SQL:
+                cursor.execute(LOCK_MEMBERS_SQL, params)
+            cursor.execute(sql, params)
+            last_seen, chunk_checked, chunk_updated, chunk_change = cursor.fetchone()
+        if not chunk_checked:
+            break
+        params['after'] = last_seen
+        checked += chunk_checked
+        updated += chunk_updated
+        change += chunk_change
+
+    if run_id is not None:
+        FineRunRange.objects.create(
+            run_id=run_id, first_id=first_id, last_id=last_id, updated=updated, skipped=checked - updated,
+        )
+    return first_id, last_id, checked, updated, change, time.perf_counter() - started
+
 
 class Command(BaseCommand):
     help = 'Calculate fines for overdue books'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Loans checked per statement')
+        parser.add_argument('--dry-run', action='store_true', help="Show what would be charged without saving it")
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help='Only check loans whose fine can have changed since the last finished run',
+        )
+        parser.add_argument('--workers', type=int, default=1, help='Processes working through id ranges in parallel')
+        parser.add_argument('--range-size', type=int, default=100_000, help='Checkout ids per unit of work')
+        parser.add_argument('--resume', action='store_true', help='Carry on the last unfinished run, skipping ranges it finished')
+
     def handle(self, *args, **options):
-        overdue_checkouts = Checkout.objects.filter(returned=False,due_date__lt=timezone.now() - timedelta(days=settings.GRACE_PERIOD_DAYS))
-        
-        for checkout in overdue_checkouts:
-            days_late = (timezone.now() - checkout.due_date).days - settings.GRACE_PERIOD_DAYS
-            days_late = min(days_late, settings.MAX_FINE_DAYS)  # Cap at max days
-            checkout.total_fine = days_late * checkout.daily_fine_rate
-            checkout.save()
-        
+        if options['resume']:
+            if options['dry_run']:
+                raise CommandError('--resume and --dry-run make no sense together')
+            run = FineRun.last_unfinished()
+            if run is None:
+                raise CommandError('No unfinished run to resume')
+            # Same clock and window as the original attempt, so the two halves agree
+            as_of = run.as_of
+            window = self.window(as_of, run.incremental)
+            done = set(run.ranges.values_list('first_id', flat=True))
+            self.stdout.write(f'Resuming {run}, {len(done)} ranges already done')
+        else:
+            # One clock for the whole run, so every loan is fined as of the same moment
+            as_of = timezone.now()
+            window = self.window(as_of, options['incremental'])
+            run = None
+            if not options['dry_run']:
+                run = FineRun.objects.create(as_of=as_of, incremental=window['since'] is not None)
+            done = set()
+
+        sql = PREVIEW_FINES_SQL if options['dry_run'] else UPDATE_FINES_SQL
+        params = {
+            'as_of': as_of,
+            'limit': options['batch_size'],
+            'until': window['until'],
+            'since': window['since'] or datetime.min.replace(tzinfo=dt_timezone.utc),
+        }
+        bounds = Checkout.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        ranges = []
+        if bounds['first'] is not None:
+            ranges = [
+                (first_id, min(first_id + options['range_size'] - 1, bounds['last']))
+                for first_id in range(bounds['first'], bounds['last'] + 1, options['range_size'])
+                if first_id not in done
+            ]
+        run_id = run.pk if run else None
+
+        checked, updated, change = 0, 0, 0
+        started = time.perf_counter()
+
+        def report(result, finished):
+            nonlocal checked, updated, change
+            first_id, last_id, range_checked, range_updated, range_change, range_elapsed = result
+            checked += range_checked
+            updated += range_updated
+            change += range_change
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"[{finished}/{len(ranges)}] #{first_id}-#{last_id}: {range_checked} loans, "
+                f"{range_updated} changed in {range_elapsed:.2f}s; "
+                f"{checked:,} so far at {checked / elapsed:,.0f} rows/s"
+            )
+
+        if options['workers'] > 1 and len(ranges) > 1:
+            # Forked workers must not share the parent's socket; each opens its own connection
+            connections.close_all()
+            with ProcessPoolExecutor(options['workers'], mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = [pool.submit(process_range, sql, params, first_id, last_id, run_id)
+                           for first_id, last_id in ranges]
+                for finished, future in enumerate(as_completed(futures), 1):
+                    report(future.result(), finished)
+        else:
+            for finished, (first_id, last_id) in enumerate(ranges, 1):
+                report(process_range(sql, params, first_id, last_id, run_id), finished)
+
+        elapsed = time.perf_counter() - started
+        if run:
+            totals = run.ranges.aggregate(updated=Sum('updated'), skipped=Sum('skipped'))
+            run.finished_at = timezone.now()
+            run.updated = totals['updated'] or 0
+            run.skipped = totals['skipped'] or 0
+            run.save(update_fields=['finished_at', 'updated', 'skipped'])
+
+        verb = 'Would update' if options['dry_run'] else 'Updated'
         self.stdout.write(self.style.SUCCESS(
-            f'Successfully updated fines for {overdue_checkouts.count()} checkouts'))
\ No newline at end of file
+            f'{verb} fines for {updated} of {checked} checkouts checked (net change {change:+.2f}) in {elapsed:.2f}s'
+            + (f' = {checked / elapsed:,.0f} rows/s' if checked else '')
+        ))
+
+    def window(self, as_of, incremental):
+        """
+        Range of due dates worth looking at. A fine only moves while a loan is
+        past the grace period and not yet capped, so if the last run finished at
+        `last`, anything due before last - (grace + cap) was already capped then.
+        """
+        if incremental:
+            last = FineRun.last_finished()
+            if last is not None:
+                return {
+                    'since': last.as_of - timedelta(days=settings.GRACE_PERIOD_DAYS + settings.MAX_FINE_DAYS),
+                    'until': as_of - timedelta(days=settings.GRACE_PERIOD_DAYS),
+                }
+            self.stdout.write('No finished run to start from, checking every overdue loan')
+        return {'since': None, 'until': as_of}
@@ -0,0 +1,84 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.book_cache import invalidate_books
+from accounts.models import Reservation
+from accounts.services import INCREMENT_AVAILABLE_SQL, LOCK_BOOKS_SQL
+
+# A batch of holds whose pickup deadline has passed. The reservation and its
+# copy are locked together with SKIP LOCKED, so a desk in the middle of issuing
+# the held copy to its member is left alone rather than waited on.
+LAPSED_HOLDS_SQL = """
+    SELECT reservation.id, copy.id, copy.book_id
+    FROM accounts_reservation AS reservation
+    JOIN accounts_bookcopy AS copy ON copy.id = reservation.copy_id
+    WHERE NOT reservation.fulfilled AND reservation.copy_id IS NOT NULL
+      AND reservation.expiry_date <= %(now)s
+    ORDER BY reservation.expiry_date
+    LIMIT %(limit)s
+    FOR UPDATE OF reservation, copy SKIP LOCKED
+"""
+
+EXPIRE_SQL = """
+    UPDATE accounts_reservation SET expired = true, copy_id = NULL
+    WHERE id = ANY(%(reservations)s)
+"""
+
+SHELVE_SQL = """
+    UPDATE accounts_bookcopy SET status = 'AVAILABLE'
+    WHERE id = ANY(%(copies)s) AND status = 'ON_HOLD'
+    RETURNING book_id
+"""
+
+
+def expire_batch(now, limit):
+    """
+    Expire up to `limit` lapsed holds and pass their copies straight on to the
+    next reservation in line. Returns (holds expired, holds handed on).
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(LAPSED_HOLDS_SQL, {'now': now, 'limit': limit})
+        lapsed = cursor.fetchall()
+        if not lapsed:
+            return 0, 0
+        cursor.execute(EXPIRE_SQL, {'reservations': [reservation_id for reservation_id, _, _ in lapsed]})
+        cursor.execute(SHELVE_SQL, {'copies': [copy_id for _, copy_id, _ in lapsed]})
+        shelved = {}
+        for book_id, in cursor.fetchall():
+            shelved[book_id] = shelved.get(book_id, 0) + 1
+
+        ordered = sorted(shelved)
+        if ordered:
+            cursor.execute(LOCK_BOOKS_SQL, {'books': ordered})
+            cursor.execute(INCREMENT_AVAILABLE_SQL, {
+                'books': ordered, 'quantities': [shelved[book_id] for book_id in ordered],
+            })
+            invalidate_books(*ordered)
+        handed_on = Reservation.allocate_holds(ordered)
+    return len(lapsed), handed_on
+
+
+class Command(BaseCommand):
+    help = 'Expire reservation holds past their pickup deadline and pass the copies to the next in line'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Holds expired per transaction')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expired = handed_on = 0
+        started = time.perf_counter()
+        while True:
+            batch_expired, batch_handed_on = expire_batch(now, options['batch_size'])
+            expired += batch_expired
+            handed_on += batch_handed_on
+            if batch_expired < options['batch_size']:
+                break
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Expired {expired} holds in {elapsed:.2f}s, {handed_on} copies passed to the next reservation"
+        ))
@@ -0,0 +1,82 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+# What each member's counters should be, straight from their checkouts
+# (same rule as Checkout.counter_state)
+ACTUAL_COUNTERS_SQL = """
+    SELECT member.id,
+           COALESCE(SUM(loan.quantity) FILTER (WHERE NOT loan.returned), 0) AS active_loans,
+           COUNT(loan.id) FILTER (WHERE NOT loan.returned AND loan.total_fine > 0) AS overdue_loans,
+           COALESCE(SUM(loan.total_fine), 0) AS fine_balance
+    FROM accounts_customuser AS member
+    LEFT JOIN accounts_checkout AS loan ON loan.member_id = member.id
+    WHERE member.id > %(after)s AND member.id <= %(last)s
+    GROUP BY member.id
+"""
+
+DRIFTED_SQL = f"""
+    SELECT member.id, member.username,
+           member.active_loans, actual.active_loans,
+           member.overdue_loans, actual.overdue_loans,
+           member.fine_balance, actual.fine_balance
+    FROM accounts_customuser AS member
+    JOIN ({ACTUAL_COUNTERS_SQL}) AS actual ON actual.id = member.id
+    WHERE (member.active_loans, member.overdue_loans, member.fine_balance)
+          IS DISTINCT FROM (actual.active_loans, actual.overdue_loans, actual.fine_balance)
+    ORDER BY member.id
+"""
+
+REBUILD_SQL = f"""
+    UPDATE accounts_customuser AS member
+    SET active_loans = actual.active_loans,
+        overdue_loans = actual.overdue_loans,
+        fine_balance = actual.fine_balance
+    FROM ({ACTUAL_COUNTERS_SQL}) AS actual
+    WHERE actual.id = member.id
+      AND (member.active_loans, member.overdue_loans, member.fine_balance)
+          IS DISTINCT FROM (actual.active_loans, actual.overdue_loans, actual.fine_balance)
+"""
+
+
+class Command(BaseCommand):
+    help = "Check members' loan and fine counters against their checkouts, and optionally fix them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['verify', 'rebuild'])
+        parser.add_argument('--batch-size', type=int, default=10_000, help='Members per statement')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM accounts_customuser')
+            last_member = cursor.fetchone()[0]
+
+        started = time.perf_counter()
+        drifted = 0
+        for after in range(0, last_member, options['batch_size']):
+            params = {'after': after, 'last': after + options['batch_size']}
+            # Row locks keep issues and returns from moving the counters mid-rebuild
+            with transaction.atomic(), connection.cursor() as cursor:
+                if options['action'] == 'rebuild':
+                    cursor.execute(
+                        'SELECT id FROM accounts_customuser WHERE id > %(after)s AND id <= %(last)s ORDER BY id FOR UPDATE',
+                        params,
+                    )
+                    cursor.execute(REBUILD_SQL, params)
+                    drifted += cursor.rowcount
+                else:
+                    cursor.execute(DRIFTED_SQL, params)
+                    for row in cursor.fetchall():
+                        drifted += 1
+                        self.stdout.write(self.style.WARNING(
+                            '#{} {}: active {} (actual {}), overdue {} (actual {}), fines {} (actual {})'.format(*row)
+                        ))
+
+        elapsed = time.perf_counter() - started
+        if options['action'] == 'rebuild':
+            self.stdout.write(self.style.SUCCESS(f'Rebuilt counters for {drifted} members in {elapsed:.2f}s'))
+        elif drifted:
+            self.stdout.write(self.style.ERROR(f'{drifted} members have drifted counters ({elapsed:.2f}s)'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'All member counters match their checkouts ({elapsed:.2f}s)'))
@@ -0,0 +1,180 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.models import Book, Checkout, CustomUser, Digest, OutboxMessage, Reservation
+from accounts.notifications import BATCH_SIZE, NotificationSender
+from accounts.sms import SmsDispatcher
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 60  # seconds before the first retry, doubled after each failure
+LEASE = 300  # seconds a claimed row is left alone before another worker may retry it
+
+# Take the next due rows, skipping any another worker holds. Claiming pushes
+# next_attempt_at out by the lease, so rows from a worker that died mid-send
+# come back on their own once it runs out.
+CLAIM_SQL = """
+    UPDATE accounts_outboxmessage AS message
+    SET attempts = message.attempts + 1,
+        next_attempt_at = %(now)s + make_interval(secs => %(lease)s)
+    FROM (
+        SELECT id FROM accounts_outboxmessage
+        WHERE status = 'pending' AND next_attempt_at <= %(now)s
+        ORDER BY next_attempt_at, id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ) AS claimed
+    WHERE message.id = claimed.id
+    RETURNING message.id, message.kind, message.member_id, message.object_id, message.attempts
+"""
+
+# Rows that used their last attempt on a worker that died before recording the
+# outcome would otherwise come back after every lease, forever
+ABANDONED_SQL = """
+    UPDATE accounts_outboxmessage
+    SET status = 'dead', last_error = 'Gave up after ' || attempts || ' attempts without a result'
+    WHERE status = 'pending' AND attempts >= %(max_attempts)s AND next_attempt_at <= %(now)s
+"""
+
+RETRY_SQL = """
+    UPDATE accounts_outboxmessage
+    SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'dead' ELSE 'pending' END,
+        next_attempt_at = %(now)s + make_interval(secs => %(backoff)s * power(2, attempts - 1)),
+        last_error = %(error)s
+    WHERE id = ANY(%(ids)s)
+"""
+
+
+def render_messages(claimed):
+    """
+    Build the email for every claimed row, loading what they refer to in one query
+    per kind. Returns {outbox id: message}, the ids of rows whose checkout,
+    reservation, book or digest no longer exists, {outbox id: error} for rows
+    that couldn't be rendered, and the loaded checkouts.
+    """
+    ids = {kind: {row[3] for row in claimed if row[1] == kind} for kind, _ in OutboxMessage.KIND_CHOICES}
+    checkouts = Checkout.objects.select_related('book', 'member').in_bulk(ids[OutboxMessage.DUE])
+    reservations = Reservation.objects.select_related('book', 'member').in_bulk(ids[OutboxMessage.AVAILABLE])
+    books = Book.objects.in_bulk(ids[OutboxMessage.NEW_BOOK])
+    members = CustomUser.objects.in_bulk({row[2] for row in claimed if row[1] == OutboxMessage.NEW_BOOK})
+    digests = Digest.objects.select_related('member').prefetch_related('entries__book').in_bulk(ids[OutboxMessage.DIGEST])
+
+    messages, gone, broken = {}, [], {}
+    for outbox_id, kind, member_id, object_id, _ in claimed:
+        # One bad row (a template error, say) is retried on its own, not the whole round
+        try:
+            if kind == OutboxMessage.DUE and object_id in checkouts:
+                messages[outbox_id] = checkouts[object_id].due_message()
+            elif kind == OutboxMessage.AVAILABLE and object_id in reservations:
+                messages[outbox_id] = reservations[object_id].available_message()
+            elif kind == OutboxMessage.NEW_BOOK and object_id in books and member_id in members:
+                messages[outbox_id] = books[object_id].new_book_message(members[member_id])
+            elif kind == OutboxMessage.DIGEST and object_id in digests:
+                messages[outbox_id] = digests[object_id].message()
+            else:
+                gone.append(outbox_id)
+        except Exception as e:
+            broken[outbox_id] = f"Rendering failed: {e!r}"
+    return messages, gone, broken, checkouts
+
+
+class Command(BaseCommand):
+    help = 'Send queued notifications from the outbox, with retries and dead-lettering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows claimed per round')
+        parser.add_argument('--send-batch-size', type=int, default=BATCH_SIZE, help='Emails per send_messages() call')
+        parser.add_argument('--connections', type=int, default=2, help='Concurrent SMTP connections (per worker)')
+        parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help='Attempts before a row is dead-lettered')
+        parser.add_argument('--backoff', type=float, default=RETRY_BACKOFF, help='Seconds before the first retry')
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting once the outbox is drained')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        sender = NotificationSender(
+            batch_size=options['send_batch_size'], connections=options['connections'], retries=1, backoff=1,
+        )
+        totals = {'sent': 0, 'retrying': 0, 'dead': 0}
+        started = time.perf_counter()
+        while True:
+            round_totals = self.process(sender, options)
+            for key, value in round_totals.items():
+                totals[key] += value
+            if not any(round_totals.values()):
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {totals['sent']} notifications in {elapsed:.2f}s, "
+            f"{totals['retrying']} to retry, {totals['dead']} dead-lettered"
+        ))
+
+    def process(self, sender, options):
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(ABANDONED_SQL, {'now': now, 'max_attempts': options['max_attempts']})
+            abandoned = cursor.rowcount
+            cursor.execute(CLAIM_SQL, {'now': now, 'lease': LEASE, 'limit': options['batch_size']})
+            claimed = cursor.fetchall()
+        if not claimed:
+            return {'sent': 0, 'retrying': 0, 'dead': abandoned}
+
+        messages, gone, broken, checkouts = render_messages(claimed)
+        stats = sender.send(messages.values())
+        failed_messages = {id(message) for message in stats['failed']}
+        failed = [outbox_id for outbox_id, message in messages.items() if id(message) in failed_messages]
+        sent = {outbox_id for outbox_id, message in messages.items() if id(message) not in failed_messages}
+
+        now = timezone.now()
+        OutboxMessage.objects.filter(pk__in=sent).update(status=OutboxMessage.SENT, sent_at=now, last_error='')
+        OutboxMessage.objects.filter(pk__in=gone).update(
+            status=OutboxMessage.DEAD, last_error='Object no longer exists',
+        )
+        retries = [(failed, 'SMTP batch failed')] if failed else []
+        retries += [([outbox_id], error) for outbox_id, error in broken.items()]
+        with connection.cursor() as cursor:
+            for ids, error in retries:
+                cursor.execute(RETRY_SQL, {
+                    'ids': ids,
+                    'now': now,
+                    'backoff': options['backoff'],
+                    'max_attempts': options['max_attempts'],
+                    'error': error,
+                })
+        for outbox_id, error in broken.items():
+            self.stderr.write(f"Outbox message {outbox_id}: {error}")
+
+        # SMS goes alongside the due reminder email, best effort as before, but
+        # all of a round's texts go out together over one pooled session
+        if hasattr(settings, 'SMS_API_KEY'):
+            texts = [
+                (checkouts[object_id].member.phone, checkouts[object_id].sms_body())
+                for outbox_id, kind, _, object_id, _ in claimed
+                if kind == OutboxMessage.DUE and outbox_id in sent and checkouts[object_id].member.phone
+            ]
+            if texts:
+                dispatcher = SmsDispatcher()
+                try:
+                    sms = dispatcher.send(texts)
+                finally:
+                    dispatcher.close()
+                self.stdout.write(
+                    f"{sms['sent']}/{sms['messages']} SMS sent, latency p50 {sms['latency_p50'] * 1000:.0f}ms "
+                    f"p95 {sms['latency_p95'] * 1000:.0f}ms"
+                )
+                for result in sms['failed']:
+                    self.stderr.write(f"SMS to {result['to']} failed ({result['status']}): {result['error']}")
+
+        attempts = {row[0]: row[4] for row in claimed}
+        retried = failed + list(broken)
+        gave_up = sum(1 for outbox_id in retried if attempts[outbox_id] >= options['max_attempts'])
+        self.stdout.write(
+            f"{len(claimed)} claimed: {len(sent)} sent, {len(failed)} failed, {len(broken)} unrenderable, "
+            f"{len(gone)} gone ({stats['per_second']:.0f} emails/s)"
+        )
+        return {'sent': len(sent), 'retrying': len(retried) - gave_up, 'dead': len(gone) + gave_up + abandoned}
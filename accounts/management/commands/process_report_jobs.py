@@ -0,0 +1,96 @@
+import os
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.models import ReportJob
+from accounts.report_jobs import run_job
+
+MAX_ATTEMPTS = 3
+LEASE = 600  # seconds without a heartbeat (see report_jobs.HEARTBEAT) before a running job counts as abandoned
+PURGE_EVERY = 600  # seconds between sweeps for old reports when looping
+
+# The oldest queued job, or one whose worker died mid-render and stopped
+# sending heartbeats. SKIP LOCKED lets several workers pull from the queue at once.
+CLAIM_SQL = """
+    UPDATE accounts_reportjob AS job
+    SET status = 'running', started_at = %(now)s, attempts = job.attempts + 1
+    FROM (
+        SELECT id FROM accounts_reportjob
+        WHERE status = 'pending'
+           OR (status = 'running' AND started_at < %(now)s - make_interval(secs => %(lease)s))
+        ORDER BY created_at, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    ) AS claimed
+    WHERE job.id = claimed.id
+    RETURNING job.id
+"""
+
+# Jobs that keep killing their worker stop being retried
+GIVE_UP_SQL = """
+    UPDATE accounts_reportjob
+    SET status = 'failed', finished_at = %(now)s, error = 'Gave up after ' || attempts || ' attempts'
+    WHERE status = 'running' AND attempts >= %(max_attempts)s
+      AND started_at < %(now)s - make_interval(secs => %(lease)s)
+"""
+
+
+def claim_job():
+    now = timezone.now()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(GIVE_UP_SQL, {'now': now, 'lease': LEASE, 'max_attempts': MAX_ATTEMPTS})
+        cursor.execute(CLAIM_SQL, {'now': now, 'lease': LEASE})
+        row = cursor.fetchone()
+    return ReportJob.objects.get(pk=row[0]) if row else None
+
+
+def purge_jobs(older_than):
+    """Delete finished jobs and their files once nobody should still be downloading them"""
+    stale = ReportJob.objects.filter(
+        status__in=[ReportJob.DONE, ReportJob.FAILED], finished_at__lt=timezone.now() - older_than,
+    )
+    for job in stale.exclude(file=''):
+        if os.path.exists(job.file.path):
+            os.remove(job.file.path)
+    return stale.delete()[0]
+
+
+class Command(BaseCommand):
+    help = 'Render queued reports into REPORTS_ROOT for the report pages to hand out'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting once the queue is empty')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds between polls with --loop')
+        parser.add_argument('--keep-hours', type=float, default=24, help='Hours finished reports are kept before purging')
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        started = time.perf_counter()
+        keep = timedelta(hours=options['keep_hours'])
+        purged, last_purge = purge_jobs(keep), time.monotonic()
+        while True:
+            job = claim_job()
+            if job is None:
+                if not options['loop']:
+                    break
+                if time.monotonic() - last_purge > PURGE_EVERY:
+                    purged, last_purge = purged + purge_jobs(keep), time.monotonic()
+                time.sleep(options['sleep'])
+                continue
+            job_started = time.perf_counter()
+            label = f"{job.get_report_display()} {job.get_format_display()} (job {job.pk})"
+            if run_job(job):
+                done += 1
+                self.stdout.write(f"{label} rendered in {time.perf_counter() - job_started:.2f}s")
+            else:
+                failed += 1
+                self.stderr.write(f"{label} failed")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Rendered {done} reports in {elapsed:.2f}s, {failed} failed, {purged} old jobs purged"
+        ))
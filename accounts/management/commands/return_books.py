@@ -0,0 +1,60 @@
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+
+from accounts.services import return_checkouts
+
+
+def scanned_items(files):
+    """Whitespace separated tokens from each file, lazily, so a huge book-drop dump isn't read in one go"""
+    for handle in files:
+        for line in handle:
+            yield from line.split()
+
+
+class Command(BaseCommand):
+    help = (
+        'Return a stack of loans by checkout id or copy barcode (e.g. the overnight book drop). '
+        'Plain numbers are checkout ids, anything else is a barcode.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('items', nargs='*', help='Checkout ids or barcodes; read from --file/stdin if none given')
+        parser.add_argument('--file', help="File of ids/barcodes, one or more per line ('-' for stdin)")
+        parser.add_argument('--batch-size', type=int, default=1000, help='Items returned per transaction')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        if options['items']:
+            totals = self.return_items(iter(options['items']), options['batch_size'])
+        elif options['file'] and options['file'] != '-':
+            with open(options['file']) as handle:
+                totals = self.return_items(scanned_items([handle]), options['batch_size'])
+        else:
+            totals = self.return_items(scanned_items([sys.stdin]), options['batch_size'])
+
+        elapsed = time.perf_counter() - started
+        for item in totals['already_returned']:
+            self.stdout.write(self.style.WARNING(f'Already returned: {item}'))
+        for item in totals['not_found']:
+            self.stdout.write(self.style.ERROR(f'Not found: {item}'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Returned {totals['returned']} loans in {elapsed:.2f}s "
+            f"({len(totals['already_returned'])} already returned, {len(totals['not_found'])} not found, "
+            f"{totals['holds']} held for reservations)"
+        ))
+
+    def return_items(self, items, batch_size):
+        totals = {'returned': 0, 'already_returned': [], 'not_found': [], 'holds': 0}
+        while batch := list(islice(items, batch_size)):
+            checkout_ids = [item for item in batch if item.isdigit()]
+            barcodes = [item for item in batch if not item.isdigit()]
+            report = return_checkouts(checkout_ids, barcodes)
+            totals['returned'] += len(report['returned'])
+            totals['already_returned'] += report['already_returned']
+            totals['not_found'] += report['not_found']
+            totals['holds'] += report['holds']
+            self.stdout.write(f"{len(batch)} scanned, {len(report['returned'])} returned, {report['holds']} put on hold")
+        return totals
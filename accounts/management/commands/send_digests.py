@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.models import BookSubscription, OutboxMessage
+
+# One pass over the waiting entries grouped by member: each member with anything
+# waiting (and no digest yet this period) gets a digest, their entries are
+# attached to it and one outbox row is queued for it, all in one statement.
+BUILD_DIGESTS_SQL = """
+    WITH due AS (
+        SELECT entry.member_id
+        FROM accounts_digestentry AS entry
+        WHERE entry.digest_id IS NULL AND entry.frequency = %(frequency)s
+        GROUP BY entry.member_id
+        HAVING NOT EXISTS (
+            SELECT 1 FROM accounts_digest AS digest
+            WHERE digest.member_id = entry.member_id
+              AND digest.frequency = %(frequency)s
+              AND digest.created_at >= %(period_start)s
+        )
+    ), digests AS (
+        INSERT INTO accounts_digest (member_id, frequency, created_at)
+        SELECT member_id, %(frequency)s, %(now)s FROM due
+        RETURNING id, member_id
+    ), attached AS (
+        UPDATE accounts_digestentry AS entry
+        SET digest_id = digests.id
+        FROM digests
+        WHERE entry.member_id = digests.member_id
+          AND entry.digest_id IS NULL AND entry.frequency = %(frequency)s
+          AND entry.created_at <= %(now)s
+        RETURNING entry.id
+    )
+    INSERT INTO accounts_outboxmessage (kind, member_id, object_id)
+    SELECT %(kind)s, member_id, id FROM digests
+    RETURNING (SELECT COUNT(*) FROM attached)
+"""
+
+PERIOD_DAYS = {BookSubscription.DAILY: 1, BookSubscription.WEEKLY: 7}
+
+
+class Command(BaseCommand):
+    help = 'Roll waiting new-book notifications into one digest email per member (run daily/weekly from cron)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('frequency', choices=list(PERIOD_DAYS))
+
+    def handle(self, *args, **options):
+        frequency = options['frequency']
+        now = timezone.now()
+        # "Once a day" means once per calendar day, so a cron job that runs a
+        # few seconds early tomorrow still counts as tomorrow
+        today = timezone.localtime(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        period_start = today - timedelta(days=PERIOD_DAYS[frequency] - 1)
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Two overlapping runs would otherwise both see the same members as due
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('send_digests'))")
+            cursor.execute(BUILD_DIGESTS_SQL, {
+                'frequency': frequency,
+                'period_start': period_start,
+                'now': now,
+                'kind': OutboxMessage.DIGEST,
+            })
+            rows = cursor.fetchall()
+
+        books = rows[0][0] if rows else 0
+        self.stdout.write(self.style.SUCCESS(
+            f"Queued {len(rows)} {frequency} digests covering {books} new-book notifications"
+        ))
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        # Clamp rows that drifted above their total before the constraint goes on
+        migrations.RunSQL(
+            "UPDATE accounts_book SET available = quantity WHERE available > quantity",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='book',
+            constraint=models.CheckConstraint(condition=models.Q(('available__lte', models.F('quantity'))), name='book_available_lte_quantity', violation_error_message='Available copies cannot exceed total copies.'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# One row per physical copy, all in one statement: the first `available`
+# copies of each book are on the shelf, the rest are out on loan.
+EXPLODE_COPIES_SQL = """
+    INSERT INTO accounts_bookcopy (book_id, copy_number, barcode, status, checkout_id)
+    SELECT b.id, n,
+           -- Same as BookCopy.make_barcode: zero-padded, but never cut short
+           lpad(b.id::text, greatest(7, length(b.id::text)), '0') || '-' || lpad(n::text, greatest(4, length(n::text)), '0'),
+           CASE WHEN n <= b.available THEN 'AVAILABLE' ELSE 'ON_LOAN' END, NULL
+    FROM accounts_book b
+    CROSS JOIN LATERAL generate_series(1, b.quantity) AS n
+"""
+
+# Pair the lent copies of each book with the copies its open checkouts hold
+LINK_LOANS_SQL = """
+    UPDATE accounts_bookcopy c
+    SET checkout_id = loans.checkout_id
+    FROM (
+        SELECT id, book_id, row_number() OVER (PARTITION BY book_id ORDER BY copy_number) AS slot
+        FROM accounts_bookcopy
+        WHERE status = 'ON_LOAN'
+    ) AS lent
+    JOIN (
+        SELECT co.id AS checkout_id, co.book_id,
+               row_number() OVER (PARTITION BY co.book_id ORDER BY co.id, n) AS slot
+        FROM accounts_checkout co
+        CROSS JOIN LATERAL generate_series(1, co.quantity) AS n
+        WHERE NOT co.returned
+    ) AS loans ON loans.book_id = lent.book_id AND loans.slot = lent.slot
+    WHERE c.id = lent.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_book_available_lte_quantity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookCopy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('copy_number', models.PositiveIntegerField()),
+                ('barcode', models.CharField(max_length=32, unique=True)),
+                ('status', models.CharField(choices=[('AVAILABLE', 'Available'), ('ON_LOAN', 'On Loan')], default='AVAILABLE', max_length=10)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='copies', to='accounts.book')),
+                ('checkout', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='copies', to='accounts.checkout')),
+            ],
+            options={
+                'ordering': ['book', 'copy_number'],
+                'indexes': [models.Index(condition=models.Q(('status', 'AVAILABLE')), fields=['book'], name='bookcopy_available_idx')],
+                'constraints': [models.UniqueConstraint(fields=('book', 'copy_number'), name='bookcopy_unique_number')],
+            },
+        ),
+        migrations.RunSQL(EXPLODE_COPIES_SQL, migrations.RunSQL.noop),
+        migrations.RunSQL(LINK_LOANS_SQL, migrations.RunSQL.noop),
+    ]
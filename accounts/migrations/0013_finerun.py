@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:14
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_bookcopy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FineRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('as_of', models.DateTimeField(help_text='Moment the fines were calculated for')),
+                ('incremental', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated', models.PositiveIntegerField(default=0, help_text='Loans whose fine changed')),
+                ('skipped', models.PositiveIntegerField(default=0, help_text='Loans checked whose fine was already right')),
+            ],
+            options={
+                'ordering': ['-as_of'],
+                'indexes': [models.Index(condition=models.Q(('finished_at__isnull', False)), fields=['-as_of'], name='finerun_finished_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:15
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_finerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FineRunRange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('updated', models.PositiveIntegerField(default=0)),
+                ('skipped', models.PositiveIntegerField(default=0)),
+                ('finished_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranges', to='accounts.finerun')),
+            ],
+            options={
+                'ordering': ['run', 'first_id'],
+                'constraints': [models.UniqueConstraint(fields=('run', 'first_id'), name='finerunrange_unique_start')],
+            },
+        ),
+    ]
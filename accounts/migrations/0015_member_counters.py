@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:23
+
+from django.db import migrations, models
+
+
+BACKFILL_SQL = """
+    UPDATE accounts_customuser AS member
+    SET active_loans = actual.active_loans,
+        overdue_loans = actual.overdue_loans,
+        fine_balance = actual.fine_balance
+    FROM (
+        SELECT member_id,
+               COALESCE(SUM(quantity) FILTER (WHERE NOT returned), 0) AS active_loans,
+               COUNT(*) FILTER (WHERE NOT returned AND total_fine > 0) AS overdue_loans,
+               SUM(total_fine) AS fine_balance
+        FROM accounts_checkout
+        GROUP BY member_id
+    ) AS actual
+    WHERE actual.member_id = member.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_finerunrange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='active_loans',
+            field=models.IntegerField(default=0, help_text='Copies currently checked out'),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='fine_balance',
+            field=models.DecimalField(decimal_places=2, default=0, help_text="Fines on all of this member's loans", max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='customuser',
+            name='overdue_loans',
+            field=models.IntegerField(default=0, help_text='Loans out and accruing a fine'),
+        ),
+        migrations.RunSQL(BACKFILL_SQL, migrations.RunSQL.noop),
+    ]
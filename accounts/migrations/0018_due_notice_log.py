@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Open loans count as having had every reminder whose time has already passed,
+# so deploying this doesn't send them all again
+BACKFILL_SQL = """
+    UPDATE accounts_checkout AS checkout
+    SET notice_stage = reached.stage,
+        next_notice_at = checkout.due_date + make_interval(days => (%(offsets)s::int[])[reached.stage + 1])
+    FROM (
+        SELECT id, (SELECT COUNT(*)::int FROM unnest(%(offsets)s::int[]) AS days
+                    WHERE due_date + make_interval(days => days) <= now()) AS stage
+        FROM accounts_checkout
+        WHERE NOT returned
+    ) AS reached
+    WHERE checkout.id = reached.id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_digests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='checkout',
+            name='next_notice_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='notice_stage',
+            field=models.PositiveSmallIntegerField(db_default=0, default=0),
+        ),
+        migrations.AddField(
+            model_name='checkout',
+            name='noticed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='checkout',
+            index=models.Index(condition=models.Q(('next_notice_at__isnull', False)), fields=['next_notice_at'], name='checkout_next_notice_idx'),
+        ),
+        migrations.RunSQL(
+            [(BACKFILL_SQL, {'offsets': sorted(settings.DUE_NOTICE_STAGES)})],
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_due_notice_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reservation',
+            name='copy',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='holds', to='accounts.bookcopy'),
+        ),
+        migrations.AlterField(
+            model_name='bookcopy',
+            name='status',
+            field=models.CharField(choices=[('AVAILABLE', 'Available'), ('ON_LOAN', 'On Loan'), ('ON_HOLD', 'On Hold')], default='AVAILABLE', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('copy__isnull', True), ('fulfilled', False)), fields=['book', 'id'], name='reservation_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:37
+
+import accounts.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_hold_queue'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='reservation',
+            name='reservation_queue_idx',
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='expired',
+            field=models.BooleanField(db_default=False, default=False),
+        ),
+        migrations.AlterField(
+            model_name='reservation',
+            name='expiry_date',
+            field=models.DateTimeField(default=accounts.models.hold_expiry),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('copy__isnull', True), ('expired', False), ('fulfilled', False)), fields=['book', 'id'], name='reservation_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(condition=models.Q(('copy__isnull', False)), fields=['fulfilled', 'expiry_date'], name='reservation_expiry_idx'),
+        ),
+    ]
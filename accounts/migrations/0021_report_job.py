@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:46
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0020_reservation_expiry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report', models.CharField(choices=[('issued', 'Issued books'), ('overdue', 'Overdue books')], max_length=20)),
+                ('format', models.CharField(choices=[('pdf', 'PDF'), ('csv', 'CSV'), ('xlsx', 'Excel')], max_length=10)),
+                ('columns', models.JSONField(blank=True, default=list)),
+                ('key', models.CharField(editable=False, max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'Queued'), ('running', 'Running'), ('done', 'Ready'), ('failed', 'Failed')], db_default='pending', default='pending', max_length=10)),
+                ('requests', models.PositiveIntegerField(default=1)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('file', models.FileField(blank=True, upload_to='reports/')),
+                ('error', models.TextField(blank=True)),
+                ('requested_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='report_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['key', '-created_at'], name='reportjob_key_idx'), models.Index(condition=models.Q(('status', 'pending')), fields=['created_at', 'id'], name='reportjob_pending_idx')],
+            },
+        ),
+    ]
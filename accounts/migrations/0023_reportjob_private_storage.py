@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:04
+
+import accounts.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0022_customuser_prefix_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportjob',
+            name='file',
+            field=models.FileField(blank=True, storage=accounts.storage.ReportStorage(), upload_to=''),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db import migrations
+
+# Open loans' next reminder, rescheduled from the start of the due day (as
+# models.notice_at_sql now does); any that are now already due go out on the
+# next send_notifications run
+RESCHEDULE_SQL = """
+    UPDATE accounts_checkout
+    SET next_notice_at = (date_trunc('day', due_date AT TIME ZONE %(tz)s)
+                          + make_interval(days => (%(offsets)s::int[])[notice_stage + 1])) AT TIME ZONE %(tz)s
+    WHERE NOT returned AND next_notice_at IS NOT NULL
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0023_reportjob_private_storage'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            [(RESCHEDULE_SQL, {'offsets': sorted(settings.DUE_NOTICE_STAGES), 'tz': settings.TIME_ZONE})],
+            migrations.RunSQL.noop,
+        ),
+    ]
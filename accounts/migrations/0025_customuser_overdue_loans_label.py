@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0024_due_notice_day_start'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customuser',
+            name='overdue_loans',
+            field=models.IntegerField(default=0, help_text='Loans out past their grace period and accruing a fine', verbose_name='loans accruing fines'),
+        ),
+    ]
@@ -1,23 +1,115 @@
 from venv import logger
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.db import models
+from django.db.models.functions import Coalesce, Least, Now, Upper
 from django.forms import ValidationError
 from django.urls import reverse
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.conf import settings
-from datetime import timedelta
-from django.core.mail import send_mail
+from datetime import datetime, timedelta
+from decimal import Decimal
+import hashlib
+import json
 from django.conf import settings
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
 from psutil import users
-import requests
 
-from library_management.settings import DEFAULT_DAILY_FINE_RATE, GRACE_PERIOD_DAYS, MAX_FINE_DAYS  # For SMS API integration
+from .book_cache import invalidate_books
+from .notifications import render_email
+from .storage import ReportStorage
+
+from library_management.settings import DEFAULT_DAILY_FINE_RATE, DUE_NOTICE_STAGES, GRACE_PERIOD_DAYS, HOLD_DAYS, MAX_ACTIVE_LOANS, MAX_FINE_DAYS, REPORT_FRESHNESS  # For SMS API integration
+
+
+# Lock `quantity` free copies (skipping ones another desk is taking), lend them
+# only if there were enough, and keep the cached Book.available count in step.
+# The book row is touched once, at the very end, so its lock is held only briefly.
+ALLOCATE_COPIES_SQL = """
+    WITH picked AS (
+        -- The borrower's own held copies first, then any on the shelf
+        SELECT id, status = 'ON_HOLD' AS held FROM accounts_bookcopy
+        WHERE book_id = %(book)s AND (status = 'AVAILABLE' OR id IN (
+            SELECT copy_id FROM accounts_reservation
+            WHERE member_id = %(member)s AND book_id = %(book)s AND NOT fulfilled AND copy_id IS NOT NULL
+        ))
+        ORDER BY status = 'AVAILABLE'
+        LIMIT %(quantity)s
+        FOR UPDATE SKIP LOCKED
+    ), enough AS (
+        SELECT COUNT(*) = %(quantity)s AS ok FROM picked
+    ), lent AS (
+        UPDATE accounts_bookcopy AS copy
+        SET status = 'ON_LOAN', checkout_id = %(checkout)s
+        FROM picked
+        WHERE copy.id = picked.id AND (SELECT ok FROM enough)
+        RETURNING copy.id
+    ), collected AS (
+        UPDATE accounts_reservation SET fulfilled = true
+        WHERE copy_id IN (SELECT id FROM picked WHERE held) AND NOT fulfilled AND (SELECT ok FROM enough)
+    )
+    UPDATE accounts_book
+    SET available = available - (SELECT COUNT(*) FROM picked WHERE NOT held)
+    WHERE id = %(book)s AND (SELECT ok FROM enough)
+"""
+
+# Same order everywhere: members, then copies, then book rows by ascending id
+LOCK_BOOKS_SQL = "SELECT id FROM accounts_book WHERE id = ANY(%(books)s) ORDER BY id FOR UPDATE"
+
+# Hand shelf copies of these books to the oldest waiting reservations, one copy
+# each, and queue their "ready for pickup" emails. Everything is taken with SKIP
+# LOCKED (book rows aside, which allocate_holds locks first with LOCK_BOOKS_SQL),
+# so it never waits on another desk. Held copies leave the shelf, so they no
+# longer count as available.
+ALLOCATE_HOLDS_SQL = """
+    WITH free AS (
+        SELECT id, book_id, row_number() OVER (PARTITION BY book_id ORDER BY id) AS n
+        FROM (
+            SELECT id, book_id FROM accounts_bookcopy
+            WHERE book_id = ANY(%(books)s) AND status = 'AVAILABLE'
+            FOR UPDATE SKIP LOCKED
+        ) AS shelf
+    ), waiting AS (
+        SELECT next.id, next.book_id, next.member_id,
+               row_number() OVER (PARTITION BY next.book_id ORDER BY next.id) AS n
+        FROM unnest(%(books)s::bigint[]) AS book(id)
+        CROSS JOIN LATERAL (
+            SELECT id, book_id, member_id FROM accounts_reservation
+            WHERE book_id = book.id AND NOT fulfilled AND NOT expired AND copy_id IS NULL
+            ORDER BY id
+            LIMIT (SELECT COUNT(*) FROM free WHERE free.book_id = book.id)
+            FOR UPDATE SKIP LOCKED
+        ) AS next
+    ), matched AS (
+        SELECT waiting.id AS reservation_id, waiting.member_id, waiting.book_id, free.id AS copy_id
+        FROM waiting JOIN free USING (book_id, n)
+    ), held AS (
+        UPDATE accounts_bookcopy AS copy SET status = 'ON_HOLD'
+        FROM matched WHERE copy.id = matched.copy_id
+    ), reserved AS (
+        UPDATE accounts_reservation AS reservation
+        SET copy_id = matched.copy_id, notified = true, expiry_date = %(expires)s
+        FROM matched WHERE reservation.id = matched.reservation_id
+    ), shelved AS (
+        UPDATE accounts_book AS book SET available = book.available - taken.count
+        FROM (SELECT book_id, COUNT(*) AS count FROM matched GROUP BY book_id) AS taken
+        WHERE book.id = taken.book_id
+    )
+    INSERT INTO accounts_outboxmessage (kind, member_id, object_id)
+    SELECT %(kind)s, member_id, reservation_id FROM matched
+    RETURNING member_id
+"""
+
+# Fine as of %(as_of)s in SQL, same rule as Checkout.save: whole days late
+# beyond the grace period, capped at MAX_FINE_DAYS, times the loan's daily rate
+FINE_SQL = (
+    f"LEAST(GREATEST(FLOOR(EXTRACT(EPOCH FROM %(as_of)s - due_date) / 86400)::int - {GRACE_PERIOD_DAYS}, 0), "
+    f"{MAX_FINE_DAYS}) * daily_fine_rate"
+)
 
 
 class CustomUser(AbstractUser):
@@ -30,9 +122,44 @@ class CustomUser(AbstractUser):
     user_type = models.PositiveSmallIntegerField(choices=USER_TYPE_CHOICES, default=3)
     phone = models.CharField(max_length=20, blank=True)
     address = models.TextField(blank=True)
+    # Running totals over this member's checkouts (see Checkout.counter_state), kept
+    # in step by everything that changes a checkout; `member_counters` reconciles them
+    active_loans = models.IntegerField(default=0, help_text="Copies currently checked out")
+    overdue_loans = models.IntegerField("loans accruing fines", default=0, help_text="Loans out past their grace period and accruing a fine")
+    fine_balance = models.DecimalField(
+        max_digits=12,
+        decimal_places=2,
+        default=0,
+        help_text="Fines on all of this member's loans"
+    )
+
+    class Meta(AbstractUser.Meta):
+        # The member typeahead's istartswith lookups run as UPPER(col) LIKE 'PREFIX%'
+        indexes = [
+            models.Index(OpClass(Upper(field), name='text_pattern_ops'), name=f'user_{field}_prefix_idx')
+            for field in ['username', 'first_name', 'last_name', 'email']
+        ]
     
     def __str__(self):
         return self.username
+
+    def can_borrow(self, quantity=1):
+        return self.active_loans + quantity <= MAX_ACTIVE_LOANS
+
+    @classmethod
+    def adjust_counters(cls, pk, active=0, overdue=0, fines=0, enforce_limit=False):
+        """
+        Add to a member's counters in one conditional UPDATE. With enforce_limit the
+        update only happens if it keeps them within MAX_ACTIVE_LOANS; returns whether it did.
+        """
+        members = cls.objects.filter(pk=pk)
+        if enforce_limit and active > 0:
+            members = members.filter(active_loans__lte=MAX_ACTIVE_LOANS - active)
+        return members.update(
+            active_loans=models.F('active_loans') + active,
+            overdue_loans=models.F('overdue_loans') + overdue,
+            fine_balance=models.F('fine_balance') + fines,
+        ) == 1
     
     def is_admin(self):
         return self.user_type == 1
@@ -69,103 +196,237 @@ class Book(models.Model):
         default=True,
         help_text="Send notifications to genre subscribers when this book is added"
     )
+    # Kept up to date by Postgres itself, so bulk updates never leave it stale
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('title', weight='A', config='english')
+            + SearchVector('author', 'isbn', weight='B', config='english')
+            + SearchVector('publisher', weight='C', config='english')
+            + SearchVector('description', weight='D', config='english')
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='book_search_vector_idx'),
+            # Trigram indexes back the typo-tolerant autocomplete
+            GinIndex(fields=['title'], name='book_title_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['author'], name='book_author_trgm_idx', opclasses=['gin_trgm_ops']),
+            # Keyset pagination sort key for the catalog
+            models.Index(fields=['title', 'id'], name='book_title_id_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(available__lte=models.F('quantity')),
+                name='book_available_lte_quantity',
+                violation_error_message='Available copies cannot exceed total copies.',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.title} by {self.author}"
     
     def save(self, *args, **kwargs):
         is_new = self.pk is None  # Check if this is a new book
-        super().save(*args, **kwargs)
-        if is_new and self.notify_subscribers:
-            self.notify_subscribers_about_new_book()
+        if is_new:
+            self.available = self.quantity  # every new copy starts on the shelf
+        elif kwargs.get('update_fields') is None:
+            # available is maintained by UPDATEs and sync_copies; writing back an
+            # in-memory value here would undo checkouts made since it was loaded
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and not field.generated and field.name != 'available'
+            ]
+        with transaction.atomic():
+            if not is_new:
+                # Keep the check constraint happy if quantity shrinks; sync_copies recounts it right after
+                Book.objects.filter(pk=self.pk).update(available=Least('available', self.quantity))
+            super().save(*args, **kwargs)
+            self.sync_copies()
+            if is_new and self.notify_subscribers:
+                # Queued in this transaction, sent by the process_outbox worker
+                self.notify_subscribers_about_new_book()
+        invalidate_books(self.pk)
 
     def notify_subscribers_about_new_book(self):
-        """Send notifications to subscribers of this book's genre"""
-        from .models import BookSubscription  # Import here to avoid circular imports
-        
-        subscriptions = BookSubscription.objects.filter(
-            genre=self.genre,
-            is_active=True
-        ).select_related('member')
-        
-        for subscription in subscriptions:
-            self.send_new_book_notification(subscription.member)
+        """Queue a notification for every subscriber of this book's genre; returns how many"""
+        return OutboxMessage.enqueue_new_book(self)
 
-    def send_new_book_notification(self, member):
-        """Send email notification to a single member"""
+    def new_book_message(self, member):
         subject = f"New Book in {self.get_genre_display()}: {self.title}"
         context = {
             'book': self,
             'member': member,
+            'genre': self.get_genre_display(),
             'site_url': settings.SITE_URL
         }
-        
-        html_message = render_to_string('accounts/emails/new_book_notification.html', context)
-        plain_message = strip_tags(html_message)
-        
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[member.email],
-            fail_silently=False
-        )
+        return render_email(subject, 'accounts/emails/new_book_notification.html', context, member.email)
+
+    def send_new_book_notification(self, member):
+        """Queue an email notification to a single member"""
+        OutboxMessage.enqueue(OutboxMessage.NEW_BOOK, [(member.pk, self.pk)])
 
     def can_checkout(self):
         """Check if book is available for checkout"""
         return self.available > 0
+
+    def available_to(self, member_id):
+        """Copies this member could take home now: the shelf, plus any held for their reservations"""
+        if not member_id:
+            return self.available
+        return self.available + Reservation.objects.filter(
+            book=self, member_id=member_id, fulfilled=False, copy__isnull=False,
+        ).count()
+
+    @staticmethod
+    def lendable_filter(member_id=None):
+        """
+        Filter for books with a copy to lend: one on the shelf, or one held for
+        `member_id` (for anyone, if no member is given yet)
+        """
+        held = Reservation.objects.filter(book=models.OuterRef('pk'), fulfilled=False, copy__isnull=False)
+        if member_id:
+            held = held.filter(member_id=member_id)
+        return models.Q(available__gt=0) | models.Exists(held)
     
     @transaction.atomic
-    def checkout_copy(self):
+    def sync_copies(self):
+        """
+        Make the physical copy rows match `quantity` and refresh the cached `available` count.
+        Surplus copies are only ever taken off the shelf, never out of a loan.
         """
-        Atomically checks out one copy with database-level locking
+        copies = BookCopy.objects.filter(book=self)
+        missing = self.quantity - copies.count()
+        if missing > 0:
+            last = copies.aggregate(last=models.Max('copy_number'))['last'] or 0
+            BookCopy.objects.bulk_create(
+                BookCopy(book=self, copy_number=n, barcode=BookCopy.make_barcode(self.pk, n))
+                for n in range(last + 1, last + missing + 1)
+            )
+        elif missing < 0:
+            surplus = copies.filter(status=BookCopy.AVAILABLE).order_by('-copy_number')[:-missing]
+            BookCopy.objects.filter(pk__in=list(surplus.values_list('pk', flat=True))).delete()
+
+        Book.recount_available([self.pk])
+        self.refresh_from_db(fields=['available'])
+
+    @staticmethod
+    def recount_available(pks):
+        """Set `available` for these books to their copies on the shelf. Returns how many books"""
+        return Book.objects.filter(pk__in=pks).update(available=Coalesce(models.Subquery(
+            BookCopy.objects.filter(book=models.OuterRef('pk'), status=BookCopy.AVAILABLE)
+            .values('book').annotate(count=models.Count('pk')).values('count')[:1]
+        ), 0))
+
+    def checkout_copy(self, checkout=None):
+        """
+        Atomically checks out one copy
         Returns True if successful, False if no copies available
         """
-        # Refresh with lock to prevent race conditions
-        book = Book.objects.select_for_update().get(pk=self.pk)
-        if book.available <= 0:
-            return False
-        book.available -= 1
-        book.save()
-        return True
+        return self.checkout_copies(1, checkout)
     
-    @transaction.atomic
-    def checkout_copies(self, quantity):
+    def checkout_copies(self, quantity, checkout=None):
         """
-        Atomically checks out multiple copies
+        Allocates free physical copies with FOR UPDATE SKIP LOCKED, so concurrent
+        desks each grab different copies instead of queueing on one lock.
+        One statement, so it's atomic without a transaction of its own.
         Returns True if successful, False if not enough copies available
         """
-        book = Book.objects.select_for_update().get(pk=self.pk)
-        if book.available < quantity:
+        with connection.cursor() as cursor:
+            cursor.execute(ALLOCATE_COPIES_SQL, {
+                'book': self.pk,
+                'quantity': quantity,
+                'checkout': checkout.pk if checkout else None,
+                'member': checkout.member_id if checkout else None,
+            })
+            allocated = cursor.rowcount == 1
+        if not allocated:
             return False
-        book.available -= quantity
-        book.save()
+        invalidate_books(self.pk)
         return True
     
-    @transaction.atomic
-    def return_copy(self):
+    def return_copy(self, checkout=None):
         """Return one copy if not already at max"""
-        book = Book.objects.select_for_update().get(pk=self.pk)
-        if book.available < book.quantity:
-            book.available += 1
-            book.save()
-            return True
-        return False
+        return self.return_copies(1, checkout)
     
-    @transaction.atomic
-    def return_copies(self, quantity):
-        """Return multiple copies if possible"""
-        book = Book.objects.select_for_update().get(pk=self.pk)
-        if (book.available + quantity) <= book.quantity:
-            book.available += quantity
-            book.save()
-            return True
-        return False
+    def return_copies(self, quantity, checkout=None):
+        """
+        Put copies back on the shelf, never going above the total.
+        Copies lent to `checkout` go back first; loans from before per-copy
+        tracking have no linked copies, so any unlinked lent copy is used instead.
+        """
+        with transaction.atomic():
+            lent = BookCopy.objects.filter(book_id=self.pk, status=BookCopy.ON_LOAN)
+            copy_ids = []
+            if checkout is not None:
+                copy_ids = list(lent.filter(checkout=checkout).values_list('pk', flat=True)[:quantity])
+            if len(copy_ids) < quantity:
+                copy_ids += list(
+                    lent.filter(checkout__isnull=True)
+                    .select_for_update(skip_locked=True)
+                    .values_list('pk', flat=True)[:quantity - len(copy_ids)]
+                )
+            if len(copy_ids) < quantity:
+                return False
+            BookCopy.objects.filter(pk__in=copy_ids).update(status=BookCopy.AVAILABLE, checkout=None)
+            updated = Book.objects.filter(
+                pk=self.pk, available__lte=models.F('quantity') - quantity
+            ).update(available=models.F('available') + quantity)
+            if not updated:
+                transaction.set_rollback(True)
+                return False
+            # Anyone waiting gets first call on what just came back
+            Reservation.allocate_holds([self.pk])
+        invalidate_books(self.pk)
+        return True
     
     def get_absolute_url(self):
         return reverse('book-detail', kwargs={'pk': self.pk})
 
+@receiver(post_delete, sender=Book)
+def invalidate_deleted_book(sender, instance, **kwargs):
+    invalidate_books(instance.pk)
+
+# When a reminder stage starts: midnight, library time, of the due date plus the
+# stage's offset in days. Counting from the start of the day rather than the due
+# moment lets the due-day (offset 0) reminder go out before the book is late.
+def notice_at_sql(due_date, days):
+    return (
+        f"((date_trunc('day', {due_date} AT TIME ZONE %(tz)s) + make_interval(days => {days})) "
+        f"AT TIME ZONE %(tz)s)"
+    )
+
+
+# Loans whose next reminder is due, each moved to the latest stage it has reached
+# (a run that was missed for a while sends one notice, not the ones in between)
+# and rescheduled for the stage after that. The partial index on next_notice_at
+# means a run only ever reads the loans it has to notify.
+QUEUE_DUE_NOTICES_SQL = f"""
+    WITH due AS (
+        SELECT id, member_id, notice_stage AS sent_stage,
+               (SELECT max(stage) FROM unnest(%(offsets)s::int[]) WITH ORDINALITY AS stages(days, stage)
+                WHERE {notice_at_sql('due_date', 'days')} <= %(now)s) AS reached
+        FROM accounts_checkout
+        WHERE next_notice_at <= %(now)s AND NOT returned
+        FOR UPDATE SKIP LOCKED
+    ), staged AS (
+        UPDATE accounts_checkout AS checkout
+        SET notice_stage = GREATEST(due.sent_stage, due.reached),
+            noticed_at = CASE WHEN due.reached > due.sent_stage THEN %(now)s ELSE checkout.noticed_at END,
+            next_notice_at = {notice_at_sql(
+                'checkout.due_date', '(%(offsets)s::int[])[GREATEST(due.sent_stage, due.reached) + 1]'
+            )}
+        FROM due
+        WHERE checkout.id = due.id
+        RETURNING checkout.id, checkout.member_id, due.reached > due.sent_stage AS notify
+    )
+    INSERT INTO accounts_outboxmessage (kind, member_id, object_id)
+    SELECT %(kind)s, member_id, id FROM staged WHERE notify
+"""
+
+
 class Checkout(models.Model):
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
     member = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -186,6 +447,24 @@ class Checkout(models.Model):
         default=0.00,
         help_text="Total fine accumulated"
     )
+    # Due-date reminders: how many of DUE_NOTICE_STAGES have gone out, when the
+    # last one did, and when the next is due (null once there are none left)
+    notice_stage = models.PositiveSmallIntegerField(default=0, db_default=0)
+    noticed_at = models.DateTimeField(null=True, blank=True)
+    next_notice_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination sort keys for the loan listings and reports
+            models.Index(fields=['-checkout_date', '-id'], name='checkout_date_id_idx'),
+            models.Index(fields=['due_date', 'id'], name='checkout_due_date_id_idx'),
+            # Only loans still waiting on a reminder
+            models.Index(
+                fields=['next_notice_at'],
+                name='checkout_next_notice_idx',
+                condition=models.Q(next_notice_at__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         status = "Returned" if self.returned else "Checked Out"
@@ -193,8 +472,54 @@ class Checkout(models.Model):
 
     def clean(self):
         """Validate before saving"""
-        if not self.pk and (not self.book.can_checkout() or self.quantity > self.book.available):
-            raise ValidationError(f'Not enough available copies (only {self.book.available} left)')
+        # A copy held for this member's reservation is theirs to take, though it's off the shelf
+        if not self.pk and self.book_id:
+            available = self.book.available_to(self.member_id)
+            if self.quantity > available:
+                raise ValidationError(f'Not enough available copies (only {available} left)')
+        if not self.pk and self.member_id and not self.member.can_borrow(self.quantity):
+            raise ValidationError(
+                f'{self.member.username} already has {self.member.active_loans} copies out '
+                f'(limit {MAX_ACTIVE_LOANS})'
+            )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this row adds to its member's counters, so save() can apply the difference
+        if {'member_id', 'returned', 'quantity', 'total_fine'}.issubset(field_names):
+            instance._counted = (instance.member_id, instance.counter_state())
+        return instance
+
+    def counter_state(self):
+        """This loan's share of its member's counters: (copies out, accruing a fine, fine)"""
+        fine = Decimal(str(self.total_fine or 0))
+        if self.returned:
+            return 0, 0, fine
+        return self.quantity, int(fine > 0), fine
+
+    def update_member_counters(self):
+        """
+        Move the member counters from what this row contributed when loaded to what it
+        contributes now. Call inside the transaction that saves it, before touching
+        copies or books: members are always locked first.
+        """
+        if not self.pk:
+            before_member, before = self.member_id, (0, 0, 0)
+        elif hasattr(self, '_counted'):
+            before_member, before = self._counted
+        else:
+            row = Checkout.objects.get(pk=self.pk)
+            before_member, before = row.member_id, row.counter_state()
+        after = self.counter_state()
+
+        if before_member != self.member_id:
+            CustomUser.adjust_counters(before_member, *(-value for value in before))
+            before = (0, 0, 0)
+        delta = [now - then for now, then in zip(after, before)]
+        if any(delta) and not CustomUser.adjust_counters(self.member_id, *delta, enforce_limit=True):
+            raise ValidationError(f'Borrowing limit of {MAX_ACTIVE_LOANS} copies reached')
+        self._counted = (self.member_id, after)
     
     def save(self, *args, **kwargs):
         """Handle checkout/return logic"""
@@ -212,9 +537,12 @@ class Checkout(models.Model):
 
     def delete(self, *args, **kwargs):
         """Handle book return when checkout record is deleted"""
-        if not self.returned:
-            self.book.return_copies(self.quantity)
-        super().delete(*args, **kwargs)
+        with transaction.atomic():
+            # Member first, like every other path (the counters are fixed up in post_delete)
+            CustomUser.objects.select_for_update().filter(pk=self.member_id).exists()
+            if not self.returned:
+                self.return_copies(self.quantity)
+            return super().delete(*args, **kwargs)
 
     def mark_returned(self):
         """Mark this checkout as returned and update book availability"""
@@ -223,7 +551,7 @@ class Checkout(models.Model):
                 self.returned = True
                 self.return_date = timezone.now()
                 self.save()
-                self.book.return_copies(self.quantity)
+                self.return_copies(self.quantity)
                 return True
         return False
     
@@ -245,15 +573,9 @@ class Checkout(models.Model):
             return "Overdue ({} days)".format((timezone.now() - self.due_date).days)
         return "Checked Out"
     
-    @transaction.atomic
     def return_copies(self, quantity):
         """Return multiple copies to available stock"""
-        book = Book.objects.select_for_update().get(pk=self.pk)
-        if (book.available + quantity) <= book.quantity:
-            book.available += quantity
-            book.save()
-            return True
-        return False
+        return self.book.return_copies(quantity, checkout=self)
     
     @classmethod
     def get_issued_books_report(cls):
@@ -293,9 +615,10 @@ class Checkout(models.Model):
     
     
     def calculate_fine(self):
-        """Calculate fine based on grace period and max cap"""
-        if not self.returned and self.due_date < timezone.now():
-            days_late = (timezone.now().date() - self.due_date).days - GRACE_PERIOD_DAYS
+        """Calculate fine based on grace period and max cap (FINE_SQL is the same rule for bulk updates)"""
+        now = timezone.now()
+        if not self.returned and self.due_date < now:
+            days_late = (now - self.due_date).days - GRACE_PERIOD_DAYS
             days_late = min(max(days_late, 0), MAX_FINE_DAYS)  # Clamp to 0...30
             return days_late * self.daily_fine_rate
         return 0.0
@@ -314,7 +637,31 @@ class Checkout(models.Model):
             # Ongoing checkout, update fine
             self.total_fine = self.calculate_fine()
 
-        super().save(*args, **kwargs)
+        self.next_notice_at = self.scheduled_notice()
+
+        with transaction.atomic():
+            self.update_member_counters()
+            super().save(*args, **kwargs)
+
+    def scheduled_notice(self):
+        """When the next due-date reminder should go out, or None if there are no more"""
+        if self.returned or self.notice_stage >= len(DUE_NOTICE_STAGES):
+            return None
+        # Same as notice_at_sql: from the start of the due day, library time
+        day = timezone.localdate(self.due_date) + timedelta(days=sorted(DUE_NOTICE_STAGES)[self.notice_stage])
+        return timezone.make_aware(datetime.combine(day, datetime.min.time()))
+
+    @classmethod
+    def queue_due_notices(cls, now=None):
+        """Queue the next reminder for every loan that has one due; returns how many"""
+        with connection.cursor() as cursor:
+            cursor.execute(QUEUE_DUE_NOTICES_SQL, {
+                'offsets': sorted(DUE_NOTICE_STAGES),
+                'now': now or timezone.now(),
+                'tz': settings.TIME_ZONE,
+                'kind': OutboxMessage.DUE,
+            })
+            return cursor.rowcount
         
     @classmethod
     def get_issued_books_report(cls):
@@ -331,54 +678,144 @@ class Checkout(models.Model):
         return overdue.select_related('book', 'member')
     
 
-    def send_due_notification(self):
-        """Send notification about upcoming due date"""
-        subject = f"Reminder: {self.book.title} due soon"
-        context = {
+    def due_context(self):
+        return {
             'book': self.book,
             'due_date': self.due_date,
             'member': self.member,
             'days_remaining': (self.due_date - timezone.now()).days
         }
-        
-        # Email notification
-        html_message = render_to_string('accounts/emails/due_notification.html', context)
-        plain_message = strip_tags(html_message)
-        
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[self.member.email],
-            fail_silently=False
+
+    def due_message(self):
+        overdue = self.due_date < timezone.now()
+        return render_email(
+            f"Overdue: {self.book.title}" if overdue else f"Reminder: {self.book.title} due soon",
+            'accounts/emails/due_notification.html',
+            self.due_context(),
+            self.member.email,
         )
-        
-        # SMS notification (optional)
-        if hasattr(settings, 'SMS_API_KEY') and self.member.phone:
-            self.send_sms_notification(context)
 
-    def send_sms_notification(self, context):
-        """Send SMS using external API (Twilio example)"""
-        message = (
+    def send_due_notification(self):
+        """Queue notification about upcoming due date (email, plus SMS if configured)"""
+        OutboxMessage.enqueue(OutboxMessage.DUE, [(self.member_id, self.pk)])
+
+    def sms_body(self, context=None):
+        context = context or self.due_context()
+        return (
             f"Hi {context['member'].first_name}, "
             f"'{context['book'].title}' is due on {context['due_date'].strftime('%b %d')}. "
             f"Please return or renew it soon."
         )
-        
+
+    def send_sms_notification(self, context):
+        """Send SMS using external API (Twilio example); process_outbox batches these through SmsDispatcher"""
+        from .sms import SmsDispatcher
+
+        dispatcher = SmsDispatcher(concurrency=1)
         try:
-            response = requests.post(
-                "https://api.twilio.com/2010-04-01/Accounts/ACXXXXXX/Messages.json",
-                auth=(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN),
-                data={
-                    'From': settings.TWILIO_PHONE_NUMBER,
-                    'To': self.member.phone,
-                    'Body': message
-                }
-            )
-            response.raise_for_status()
-        except Exception as e:
-            logger.error(f"SMS sending failed: {str(e)}")
+            result = dispatcher.send_one(self.member.phone, self.sms_body(context))
+        finally:
+            dispatcher.close()
+        return result['ok']
+
+@receiver(post_delete, sender=Checkout)
+def uncount_deleted_checkout(sender, instance, **kwargs):
+    """Also catches checkouts deleted along with their book"""
+    member_id, counted = getattr(instance, '_counted', (instance.member_id, instance.counter_state()))
+    CustomUser.adjust_counters(member_id, *(-value for value in counted))
+
+class BookCopy(models.Model):
+    """One physical item on the shelf; Book.available is a cached count of these"""
+    AVAILABLE = 'AVAILABLE'
+    ON_LOAN = 'ON_LOAN'
+    ON_HOLD = 'ON_HOLD'
+    STATUS_CHOICES = [
+        (AVAILABLE, 'Available'),
+        (ON_LOAN, 'On Loan'),
+        (ON_HOLD, 'On Hold'),  # kept behind the desk for a reservation
+    ]
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='copies')
+    copy_number = models.PositiveIntegerField()
+    barcode = models.CharField(max_length=32, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=AVAILABLE)
+    checkout = models.ForeignKey(
+        Checkout,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='copies'
+    )
+
+    class Meta:
+        ordering = ['book', 'copy_number']
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'copy_number'], name='bookcopy_unique_number'),
+        ]
+        indexes = [
+            # Only shelf copies are ever allocated, so only they need indexing
+            models.Index(
+                fields=['book'],
+                condition=models.Q(status='AVAILABLE'),
+                name='bookcopy_available_idx'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.barcode} ({self.book.title})"
+
+    @staticmethod
+    def make_barcode(book_id, copy_number):
+        return f"{book_id:07d}-{copy_number:04d}"
+
+class FineRun(models.Model):
+    """
+    Ledger of calculate_fines runs. An incremental run only looks at loans whose
+    fine could have moved since the last finished run's `as_of`.
+    """
+    as_of = models.DateTimeField(help_text="Moment the fines were calculated for")
+    incremental = models.BooleanField(default=False)
+    started_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated = models.PositiveIntegerField(default=0, help_text="Loans whose fine changed")
+    skipped = models.PositiveIntegerField(default=0, help_text="Loans checked whose fine was already right")
+
+    class Meta:
+        ordering = ['-as_of']
+        indexes = [
+            models.Index(fields=['-as_of'], name='finerun_finished_idx', condition=models.Q(finished_at__isnull=False)),
+        ]
+
+    def __str__(self):
+        kind = 'Incremental' if self.incremental else 'Full'
+        return f"{kind} fine run as of {self.as_of:%Y-%m-%d %H:%M}"
+
+    @classmethod
+    def last_finished(cls):
+        return cls.objects.filter(finished_at__isnull=False).order_by('-as_of').first()
+
+    @classmethod
+    def last_unfinished(cls):
+        return cls.objects.filter(finished_at__isnull=True).order_by('-started_at').first()
+
+
+class FineRunRange(models.Model):
+    """A primary-key range of checkouts a FineRun has finished, so a restarted run can skip it"""
+    run = models.ForeignKey(FineRun, on_delete=models.CASCADE, related_name='ranges')
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    updated = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    finished_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['run', 'first_id']
+        constraints = [
+            models.UniqueConstraint(fields=['run', 'first_id'], name='finerunrange_unique_start'),
+        ]
+
+    def __str__(self):
+        return f"#{self.first_id}-#{self.last_id} of {self.run}"
 
 class BookRequest(models.Model):
     STATUS_CHOICES = [
@@ -404,6 +841,10 @@ class BookRequest(models.Model):
         ordering = ['-request_date']
 
 
+def hold_expiry():
+    return timezone.now() + timedelta(days=HOLD_DAYS)
+
+
 class Reservation(models.Model):
     member = models.ForeignKey(
         CustomUser, 
@@ -418,40 +859,133 @@ class Reservation(models.Model):
     reservation_date = models.DateTimeField(auto_now_add=True)
     notified = models.BooleanField(default=False)
     fulfilled = models.BooleanField(default=False)
-    expiry_date = models.DateTimeField(
-        default=timezone.now() + timezone.timedelta(days=3)
+    # Pickup deadline; reset when a copy is put on hold for them
+    expiry_date = models.DateTimeField(default=hold_expiry)
+    expired = models.BooleanField(default=False, db_default=False)
+    # The copy kept aside for this member once they reach the front of the queue
+    copy = models.ForeignKey(
+        BookCopy,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='holds'
     )
 
-    def send_available_notification(self):
-        """Send notification when reserved book becomes available"""
-        subject = f"Your reserved book '{self.book.title}' is available"
+    def save(self, *args, **kwargs):
+        is_new = self.pk is None
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                # A copy may already be on the shelf
+                Reservation.allocate_holds([self.book_id])
+
+    @classmethod
+    def allocate_holds(cls, book_ids=None):
+        """
+        Give free copies of these books (default: every book someone is waiting
+        for) to the front of each queue. Returns how many holds were placed.
+        """
+        if book_ids is None:
+            book_ids = cls.objects.filter(
+                fulfilled=False, expired=False, copy__isnull=True, book__available__gt=0,
+            ).values_list('book_id', flat=True).distinct()
+        book_ids = sorted(set(book_ids))
+        if not book_ids:
+            return 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            # The statement updates book rows in join order, so take them in id order first
+            cursor.execute(LOCK_BOOKS_SQL, {'books': book_ids})
+            cursor.execute(ALLOCATE_HOLDS_SQL, {
+                'books': book_ids,
+                'expires': timezone.now() + timedelta(days=HOLD_DAYS),
+                'kind': OutboxMessage.AVAILABLE,
+            })
+            placed = cursor.rowcount
+        if placed:
+            invalidate_books(*book_ids)
+        return placed
+
+    @property
+    def queue_position(self):
+        """Their place in line (1 is next), or 0 once they're out of it: holding a copy, collected or lapsed"""
+        if self.fulfilled or self.expired or self.copy_id:
+            return 0
+        return Reservation.objects.filter(
+            book_id=self.book_id, fulfilled=False, expired=False, copy__isnull=True, pk__lte=self.pk,
+        ).count()
+
+    def available_message(self):
         context = {
             'book': self.book,
             'member': self.member,
-            'pickup_deadline': timezone.now() + timedelta(days=3),
+            'pickup_deadline': self.expiry_date,
             'site_name': settings.SITE_NAME,
             'site_url': settings.SITE_URL
         }
-        
-        html_message = render_to_string('accounts/emails/reservation_available.html', context)
-        plain_message = strip_tags(html_message)
-        
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[self.member.email],
-            fail_silently=False
+        return render_email(
+            f"Your reserved book '{self.book.title}' is available",
+            'accounts/emails/reservation_available.html',
+            context,
+            self.member.email,
         )
 
+    def send_available_notification(self):
+        """Queue notification when reserved book becomes available"""
+        OutboxMessage.enqueue(OutboxMessage.AVAILABLE, [(self.member_id, self.pk)])
+
     def __str__(self):
         return f"{self.member.username}'s reservation for {self.book.title}"
 
     class Meta:
         ordering = ['reservation_date']
+        indexes = [
+            # The hold queue: who's still waiting for each book, in order
+            models.Index(
+                fields=['book', 'id'],
+                name='reservation_queue_idx',
+                condition=models.Q(fulfilled=False, expired=False, copy__isnull=True),
+            ),
+            # Holds waiting for pickup, by deadline, for expire_reservations
+            models.Index(
+                fields=['fulfilled', 'expiry_date'],
+                name='reservation_expiry_idx',
+                condition=models.Q(copy__isnull=False),
+            ),
+        ]
+
+@receiver(post_delete, sender=Reservation)
+def release_deleted_hold(sender, instance, **kwargs):
+    """
+    A deleted reservation (by hand, or along with its member) gives up the copy
+    it was holding: back on the shelf and on to the next in line, like a lapsed hold
+    """
+    if not instance.copy_id or instance.fulfilled:
+        return
+    with transaction.atomic():
+        released = BookCopy.objects.filter(pk=instance.copy_id, status=BookCopy.ON_HOLD).update(
+            status=BookCopy.AVAILABLE,
+        )
+        if not released:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_BOOKS_SQL, {'books': [instance.book_id]})
+        Book.objects.filter(pk=instance.book_id).update(
+            available=Least(models.F('available') + 1, models.F('quantity')),
+        )
+        invalidate_books(instance.book_id)
+        Reservation.allocate_holds([instance.book_id])
+
 
 class BookSubscription(models.Model):
+    IMMEDIATE = 'immediate'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    FREQUENCY_CHOICES = [
+        (IMMEDIATE, 'Immediately'),
+        (DAILY, 'Daily digest'),
+        (WEEKLY, 'Weekly digest'),
+    ]
+
     member = models.ForeignKey(
         CustomUser, 
         on_delete=models.CASCADE,
@@ -462,25 +996,234 @@ class BookSubscription(models.Model):
         choices=Book.GENRE_CHOICES
     )
     is_active = models.BooleanField(default=True)
+    frequency = models.CharField(max_length=10, choices=FREQUENCY_CHOICES, default=IMMEDIATE, db_default=IMMEDIATE)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def send_new_book_notification(self, book):
-        subject = f"New Book in {self.get_genre_display()}: {book.title}"
+        if self.frequency == self.IMMEDIATE:
+            OutboxMessage.enqueue(OutboxMessage.NEW_BOOK, [(self.member_id, book.pk)])
+        else:
+            DigestEntry.objects.create(member_id=self.member_id, book=book, frequency=self.frequency)
+
+
+# Every active subscriber of the genre, in one statement however many there are.
+# Immediate subscribers get an email each; the rest get a line in their next digest.
+ENQUEUE_NEW_BOOK_SQL = """
+    INSERT INTO accounts_outboxmessage (kind, member_id, object_id)
+    SELECT %(kind)s, member_id, %(book)s
+    FROM accounts_booksubscription
+    WHERE genre = %(genre)s AND is_active AND frequency = 'immediate'
+"""
+
+ENQUEUE_DIGEST_ENTRY_SQL = """
+    INSERT INTO accounts_digestentry (member_id, book_id, frequency, created_at)
+    SELECT member_id, %(book)s, frequency, now()
+    FROM accounts_booksubscription
+    WHERE genre = %(genre)s AND is_active AND frequency <> 'immediate'
+"""
+
+
+class Digest(models.Model):
+    """One member's daily or weekly roundup of new books; its entries are the books"""
+    member = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='digests')
+    frequency = models.CharField(max_length=10, choices=BookSubscription.FREQUENCY_CHOICES)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['member', 'frequency', '-created_at'], name='digest_member_recent_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_frequency_display()} for {self.member} ({self.created_at:%Y-%m-%d})"
+
+    def message(self):
+        books = [entry.book for entry in self.entries.all()]
         context = {
-            'book': book,
             'member': self.member,
-            'genre': self.get_genre_display(),
-            'site_url': settings.SITE_URL
+            'books': books,
+            'frequency': self.get_frequency_display(),
+            'site_url': settings.SITE_URL,
         }
-        
-        html_message = render_to_string('accounts/emails/new_book_notification.html', context)
-        plain_message = strip_tags(html_message)
-        
-        send_mail(
-            subject=subject,
-            message=plain_message,
-            html_message=html_message,
-            from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[self.member.email],
-            fail_silently=False
-        )
\ No newline at end of file
+        subject = f"{len(books)} new book{'s' if len(books) != 1 else ''} in your subscribed genres"
+        return render_email(subject, 'accounts/emails/new_book_digest.html', context, self.member.email)
+
+
+class DigestEntry(models.Model):
+    """A new book waiting for a member's next digest (digest is null until then)"""
+    member = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='digest_entries')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+')
+    frequency = models.CharField(max_length=10, choices=BookSubscription.FREQUENCY_CHOICES)
+    digest = models.ForeignKey(Digest, on_delete=models.CASCADE, null=True, blank=True, related_name='entries')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            # send_digests only ever reads entries not yet in a digest
+            models.Index(
+                fields=['frequency', 'member'],
+                name='digestentry_pending_idx',
+                condition=models.Q(digest__isnull=True),
+            ),
+        ]
+
+
+class OutboxMessage(models.Model):
+    """
+    A notification waiting to be sent. Rows are written in the same transaction as
+    whatever triggered them, so nothing is sent for a change that rolled back and
+    nothing is lost if sending fails; the process_outbox worker delivers them.
+    """
+    DUE = 'due'
+    AVAILABLE = 'available'
+    NEW_BOOK = 'new_book'
+    DIGEST = 'digest'
+    KIND_CHOICES = [
+        (DUE, 'Due date reminder'),  # object_id is a Checkout
+        (AVAILABLE, 'Reservation available'),  # object_id is a Reservation
+        (NEW_BOOK, 'New book in subscribed genre'),  # object_id is a Book
+        (DIGEST, 'New book digest'),  # object_id is a Digest
+    ]
+    PENDING = 'pending'
+    SENT = 'sent'
+    DEAD = 'dead'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (DEAD, 'Dead letter'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    member = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='outbox_messages')
+    object_id = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_default=PENDING)
+    attempts = models.PositiveIntegerField(default=0, db_default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_default=Now())
+    last_error = models.TextField(blank=True, default='', db_default='')
+    created_at = models.DateTimeField(default=timezone.now, db_default=Now())
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['next_attempt_at', 'id']
+        indexes = [
+            # The worker's queue: only pending rows, in the order they're due
+            models.Index(
+                fields=['next_attempt_at', 'id'],
+                name='outbox_pending_idx',
+                condition=models.Q(status='pending'),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.member} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, kind, recipients):
+        """Queue one `kind` notification per (member_id, object_id)"""
+        return cls.objects.bulk_create(
+            cls(kind=kind, member_id=member_id, object_id=object_id) for member_id, object_id in recipients
+        )
+
+    @classmethod
+    def enqueue_new_book(cls, book):
+        """Returns how many subscribers will hear about it, now or in a digest"""
+        with connection.cursor() as cursor:
+            cursor.execute(ENQUEUE_NEW_BOOK_SQL, {'kind': cls.NEW_BOOK, 'book': book.pk, 'genre': book.genre})
+            queued = cursor.rowcount
+            cursor.execute(ENQUEUE_DIGEST_ENTRY_SQL, {'book': book.pk, 'genre': book.genre})
+            return queued + cursor.rowcount
+
+
+class ReportJob(models.Model):
+    """
+    A report rendered by the process_report_jobs worker into a file under
+    REPORTS_ROOT, instead of inside a web request. Identical requests made while
+    a job is queued, running, or finished less than REPORT_FRESHNESS seconds
+    ago all get that same job back.
+    """
+    ISSUED = 'issued'
+    OVERDUE = 'overdue'
+    REPORT_CHOICES = [
+        (ISSUED, 'Issued books'),
+        (OVERDUE, 'Overdue books'),
+    ]
+    FORMAT_CHOICES = [
+        ('pdf', 'PDF'),
+        ('csv', 'CSV'),
+        ('xlsx', 'Excel'),
+    ]
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
+    report = models.CharField(max_length=20, choices=REPORT_CHOICES)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    columns = models.JSONField(default=list, blank=True)  # export columns; empty for PDFs
+    key = models.CharField(max_length=64, editable=False)  # what makes two requests the same
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_default=PENDING)
+    requested_by = models.ForeignKey(
+        CustomUser, on_delete=models.SET_NULL, null=True, blank=True, related_name='report_jobs',
+    )
+    requests = models.PositiveIntegerField(default=1)  # how many clicks this one job answered
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    file = models.FileField(storage=ReportStorage(), blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['key', '-created_at'], name='reportjob_key_idx'),
+            # The worker's queue
+            models.Index(
+                fields=['created_at', 'id'],
+                name='reportjob_pending_idx',
+                condition=models.Q(status='pending'),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_report_display()} {self.get_format_display()} ({self.status})"
+
+    @property
+    def filename(self):
+        return f"{self.report}_books.{self.format}"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    @staticmethod
+    def request_key(report, format, columns):
+        return hashlib.sha256(json.dumps([report, format, list(columns)]).encode()).hexdigest()
+
+    @classmethod
+    def request(cls, report, format, columns=(), user=None):
+        """
+        The job for this report: one that's queued or running, one that finished
+        within REPORT_FRESHNESS, or else a new one. Requests for the same key are
+        serialised on an advisory lock so a burst of clicks can't queue two.
+        """
+        key = cls.request_key(report, format, columns)
+        fresh = timezone.now() - timedelta(seconds=REPORT_FRESHNESS)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [key])
+            job = cls.objects.filter(
+                models.Q(status__in=[cls.PENDING, cls.RUNNING]) | models.Q(status=cls.DONE, finished_at__gte=fresh),
+                key=key,
+            ).first()
+            if job:
+                cls.objects.filter(pk=job.pk).update(requests=models.F('requests') + 1)
+                return job
+            return cls.objects.create(report=report, format=format, columns=list(columns), key=key, requested_by=user)
@@ -0,0 +1,119 @@
+import logging
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import render_to_string
+from django.utils.html import strip_tags
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100  # messages per send_messages() call
+RETRIES = 3
+BACKOFF = 1.0  # seconds, doubled after each failed attempt
+
+
+def render_email(subject, template, context, to):
+    """An HTML email with a plain-text alternative, ready to go out in a batch"""
+    html_message = render_to_string(template, context)
+    message = EmailMultiAlternatives(
+        subject=subject,
+        body=strip_tags(html_message),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[to] if isinstance(to, str) else list(to),
+    )
+    message.attach_alternative(html_message, 'text/html')
+    return message
+
+
+class NotificationSender:
+    """
+    Sends emails in batches over a few long-lived connections instead of one SMTP
+    session (and TLS handshake) per message. A batch that fails is retried whole
+    with backoff on a fresh connection, so delivery is at-least-once; batches that
+    still fail are reported back rather than raised.
+
+        stats = NotificationSender().send(messages)
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, connections=1, retries=RETRIES, backoff=BACKOFF, backend=None):
+        self.batch_size = batch_size
+        self.connections = connections
+        self.retries = retries
+        self.backoff = backoff
+        self.backend = backend
+        self._local = threading.local()
+        self._opened = []
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = get_connection(self.backend, fail_silently=False)
+            connection.open()
+            self._opened.append(connection)
+        return connection
+
+    def _reconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            try:
+                connection.close()
+            except (smtplib.SMTPException, OSError):
+                pass  # it's already broken, which is why we're here
+            self._opened.remove(connection)
+            self._local.connection = None
+
+    def _send_batch(self, batch):
+        """Returns (sent, retries, error); error is None once the batch has gone out"""
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                return self._connection().send_messages(batch) or 0, attempt, None
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                logger.warning(f"Email batch of {len(batch)} failed (attempt {attempt + 1}): {e}")
+                self._reconnect()
+        return 0, self.retries, error
+
+    def send(self, messages):
+        """
+        Send every message. Returns a dict with counts, timing and `failed`,
+        the messages whose batch never got through.
+        """
+        messages = list(messages)
+        batches = [messages[i:i + self.batch_size] for i in range(0, len(messages), self.batch_size)]
+        stats = {'messages': len(messages), 'sent': 0, 'batches': len(batches), 'retries': 0, 'failed': []}
+        started = time.perf_counter()
+        try:
+            if self.connections > 1 and len(batches) > 1:
+                with ThreadPoolExecutor(self.connections) as pool:
+                    results = list(pool.map(self._send_batch, batches))
+            else:
+                results = [self._send_batch(batch) for batch in batches]
+        finally:
+            for connection in self._opened:
+                connection.close()
+            self._opened.clear()
+
+        for batch, (sent, retries, error) in zip(batches, results):
+            stats['sent'] += sent
+            stats['retries'] += retries
+            if error is not None:
+                logger.error(f"Giving up on {len(batch)} emails: {error}")
+                stats['failed'] += batch
+        stats['seconds'] = time.perf_counter() - started
+        stats['per_second'] = stats['sent'] / stats['seconds'] if stats['seconds'] else 0
+        logger.info(
+            f"Sent {stats['sent']}/{stats['messages']} emails in {stats['batches']} batches, "
+            f"{stats['retries']} retries, {stats['seconds']:.2f}s ({stats['per_second']:.0f}/s)"
+        )
+        return stats
+
+
+def send_batched(messages, **options):
+    return NotificationSender(**options).send(messages)
@@ -0,0 +1,109 @@
+import zlib
+
+from django.http import StreamingHttpResponse
+from reportlab.lib.pagesizes import letter
+
+# Object numbers fixed up front; pages are numbered from FIRST_PAGE_OBJECT on
+CATALOG, PAGES = 1, 2
+FONTS = {'Helvetica': 3, 'Helvetica-Bold': 4}
+FIRST_PAGE_OBJECT = 5
+
+
+def escape(text):
+    """A PDF literal string in WinAnsi, which covers what the standard fonts can show"""
+    data = str(text).encode('cp1252', 'replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+class PdfStream:
+    """
+    A text-only PDF writer that gives back each page's bytes as soon as the page
+    is finished, so a report can go out while it's still being drawn and only
+    one page is ever held in memory. The drawing calls follow reportlab's canvas
+    (drawString, setFont, setFillColorRGB, showPage); the page tree and xref
+    table, which need every page's position, are written last by finish().
+
+        pdf = PdfStream()
+        yield pdf.begin()
+        pdf.drawString(100, 750, "Hello")
+        yield pdf.showPage()
+        yield pdf.finish()
+    """
+
+    def __init__(self, pagesize=letter):
+        self.width, self.height = pagesize
+        self.position = 0
+        self.offsets = {}  # object number -> byte offset in the file
+        self.page_objects = []
+        self.operations = []
+        self.drawn = False  # anything on the current page yet
+        self.next_object = FIRST_PAGE_OBJECT
+
+    def _object(self, number, body):
+        self.offsets[number] = self.position
+        data = b'%d 0 obj\n' % number + body + b'\nendobj\n'
+        self.position += len(data)
+        return data
+
+    def begin(self):
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self.position = len(header)
+        fonts = b''.join(
+            self._object(number, b'<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>' % name.encode())
+            for name, number in FONTS.items()
+        )
+        self.setFont('Helvetica', 12)
+        return header + fonts
+
+    def setFont(self, name, size):
+        self.operations.append(b'/F%d %g Tf' % (FONTS[name], size))
+
+    def setFillColorRGB(self, r, g, b):
+        self.operations.append(b'%g %g %g rg' % (r, g, b))
+
+    def drawString(self, x, y, text):
+        self.operations.append(b'BT %g %g Td %s Tj ET' % (x, y, escape(text)))
+        self.drawn = True
+
+    def showPage(self):
+        """Finish the current page and return its bytes; the next page starts in Helvetica 12, black"""
+        content = zlib.compress(b'\n'.join(self.operations))
+        stream_number, page_number = self.next_object, self.next_object + 1
+        self.next_object += 2
+        self.page_objects.append(page_number)
+        self.operations = []
+        self.drawn = False
+        self.setFont('Helvetica', 12)
+
+        fonts = b' '.join(b'/F%d %d 0 R' % (number, number) for number in FONTS.values())
+        return self._object(
+            stream_number,
+            b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream',
+        ) + self._object(
+            page_number,
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %g %g] /Contents %d 0 R /Resources << /Font << %s >> >> >>'
+            % (PAGES, self.width, self.height, stream_number, fonts),
+        )
+
+    def finish(self):
+        """Page tree, catalog, cross-reference table and trailer"""
+        tail = b''
+        if self.drawn or not self.page_objects:
+            tail += self.showPage()
+        kids = b' '.join(b'%d 0 R' % number for number in self.page_objects)
+        tail += self._object(PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(self.page_objects)))
+        tail += self._object(CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % PAGES)
+
+        xref_at = self.position
+        count = self.next_object
+        xref = [b'xref\n0 %d\n' % count, b'0000000000 65535 f \n']
+        xref += [b'%010d 00000 n \n' % self.offsets[number] for number in range(1, count)]
+        trailer = b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (count, CATALOG, xref_at)
+        return tail + b''.join(xref) + trailer
+
+
+def pdf_response(filename, chunks):
+    """Stream the bytes from `chunks` to the client as a PDF download"""
+    response = StreamingHttpResponse(chunks, content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
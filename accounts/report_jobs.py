@@ -0,0 +1,76 @@
+import os
+import secrets
+import time
+
+from django.utils import timezone
+
+from .exports import csv_stream, export_rows, xlsx_stream
+from .models import Checkout, ReportJob
+from .reports import issued_books_pdf, overdue_books_pdf, report_rows
+
+# Report name -> (its checkouts, its PDF)
+REPORTS = {
+    ReportJob.ISSUED: (Checkout.get_issued_books_report, issued_books_pdf),
+    ReportJob.OVERDUE: (Checkout.get_overdue_books_report, overdue_books_pdf),
+}
+
+HEARTBEAT = 60  # seconds between "still working" updates to a running job
+
+CONTENT_TYPES = {
+    'pdf': 'application/pdf',
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+class LostJob(Exception):
+    pass
+
+
+def render_report(report, format, columns=()):
+    """The same bytes the report URL would stream, a chunk at a time"""
+    checkouts, pdf = REPORTS[report]
+    if format == 'pdf':
+        return pdf(report_rows(checkouts()))
+    rows = export_rows(checkouts().order_by('due_date', 'id'), columns)
+    if format == 'csv':
+        return (line.encode() for line in csv_stream(rows))
+    return xlsx_stream(rows)
+
+
+def run_job(job):
+    """
+    Write the job's report into REPORTS_ROOT and mark it done. The file goes in
+    under a temporary name and is renamed once complete, so a download never
+    sees half a report. Names carry a random token rather than just the job id,
+    in case the directory is ever exposed by mistake, and so two attempts at
+    one job never write to the same file.
+
+    While rendering, the job's started_at is moved up every HEARTBEAT seconds so
+    a long export isn't taken for abandoned. Every write back is conditional on
+    `attempts` being unchanged: if another worker did take the job over anyway,
+    this attempt stops and leaves the job to it. Returns True if done.
+    """
+    name = f"{job.report}_books_{job.pk}_{secrets.token_urlsafe(16)}.{job.format}"
+    path = job.file.storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    attempt = ReportJob.objects.filter(pk=job.pk, status=ReportJob.RUNNING, attempts=job.attempts)
+    try:
+        beat = time.monotonic()
+        with open(path + '.part', 'wb') as output:
+            for chunk in render_report(job.report, job.format, job.columns):
+                output.write(chunk)
+                if time.monotonic() - beat > HEARTBEAT:
+                    if not attempt.update(started_at=timezone.now()):
+                        raise LostJob(f"Job {job.pk} was taken over by another worker")
+                    beat = time.monotonic()
+        os.replace(path + '.part', path)
+    except Exception as e:
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        attempt.update(status=ReportJob.FAILED, finished_at=timezone.now(), error=str(e))
+        return False
+    if not attempt.update(status=ReportJob.DONE, finished_at=timezone.now(), file=name, error=''):
+        os.remove(path)
+        return False
+    return True
@@ -1,32 +1,121 @@
 from django.utils import timezone
-from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
-from django.http import HttpResponse
 from .models import Checkout
+from .pdf import PdfStream, pdf_response
+
+CHUNK_SIZE = 2000  # rows per fetch from the server-side cursor
+
+# Everything the PDF reports print, and nothing else
+REPORT_FIELDS = ('due_date', 'returned', 'total_fine', 'book__title', 'member__first_name', 'member__last_name')
+
+
+def report_rows(queryset):
+    """Stream a report's checkouts in due-date order without loading them all at once"""
+    return queryset.only(*REPORT_FIELDS).order_by('due_date', 'id').iterator(chunk_size=CHUNK_SIZE)
+
+
+def issued_books_pdf(checkouts):
+    """Yields the issued books report a page at a time"""
+    p = PdfStream()
+    yield p.begin()
+
+    # Header
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(100, 750, "Currently Issued Books Report")
+    p.setFont("Helvetica", 12)
+    p.drawString(100, 730, f"Generated on: {timezone.now().strftime('%Y-%m-%d %H:%M')}")
+
+    # Table Header
+    p.drawString(100, 700, "Book Title")
+    p.drawString(300, 700, "Member")
+    p.drawString(450, 700, "Due Date")
+    p.drawString(550, 700, "Status")
+
+    # Table Content
+    y = 680
+    p.setFont("Helvetica", 10)
+    for checkout in checkouts:
+        p.drawString(100, y, checkout.book.title[:30])  # Limit title length
+        p.drawString(300, y, checkout.member.get_full_name())
+        p.drawString(450, y, checkout.due_date.strftime('%Y-%m-%d'))
+
+        if checkout.is_overdue:
+            status = f"Overdue ({checkout.days_overdue} days)"
+            p.setFillColorRGB(1, 0, 0)  # Red
+        elif checkout.due_soon:
+            status = "Due Soon"
+            p.setFillColorRGB(1, 0.5, 0)  # Orange
+        else:
+            status = "On Time"
+            p.setFillColorRGB(0, 0.5, 0)  # Green
+
+        p.drawString(550, y, status)
+        p.setFillColorRGB(0, 0, 0)  # Reset to black
+        y -= 20
+
+        if y < 50:  # New page if running out of space
+            yield p.showPage()
+            y = 750
+
+    yield p.finish()
+
+
+def overdue_books_pdf(checkouts):
+    """Yields the overdue books report a page at a time"""
+    p = PdfStream()
+    yield p.begin()
+
+    # Header
+    p.setFont("Helvetica-Bold", 16)
+    p.drawString(100, 750, "Overdue Books Report")
+    p.setFont("Helvetica", 12)
+    p.drawString(100, 730, f"Generated on: {timezone.now().strftime('%Y-%m-%d %H:%M')}")
+
+    # Table Header
+    p.drawString(100, 700, "Book Title")
+    p.drawString(300, 700, "Member")
+    p.drawString(450, 700, "Due Date")
+    p.drawString(550, 700, "Days Overdue")
+    p.drawString(650, 700, "Fine")
+
+    # Table Content
+    y = 680
+    p.setFont("Helvetica", 10)
+    for checkout in checkouts:
+        p.drawString(100, y, checkout.book.title[:30])
+        p.drawString(300, y, checkout.member.get_full_name())
+        p.drawString(450, y, checkout.due_date.strftime('%Y-%m-%d'))
+        p.drawString(550, y, str(checkout.days_overdue))
+        p.drawString(650, y, f"${checkout.total_fine:.2f}")
+        y -= 20
+
+        if y < 50:
+            yield p.showPage()
+            y = 750
+
+    yield p.finish()
+
+
+def issued_list_pdf(checkouts):
+    """Yields the plain issued books list a page at a time"""
+    p = PdfStream()
+    yield p.begin()
 
-def generate_issued_pdf(request):
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="issued_books.pdf"'
-    
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    
     # Draw things on the PDF
     p.drawString(100, 750, "Currently Issued Books Report")
     p.drawString(100, 730, "Generated on: " + timezone.now().strftime("%Y-%m-%d"))
-    
+
     # Add table data
     y = 700
-    checkouts = Checkout.get_issued_books_report()
     for checkout in checkouts:
         p.drawString(100, y, f"{checkout.book.title} - {checkout.member.get_full_name()}")
         y -= 20
-    
-    p.showPage()
-    p.save()
-    
-    pdf = buffer.getvalue()
-    buffer.close()
-    response.write(pdf)
-    return response
\ No newline at end of file
+        if y < 50:
+            yield p.showPage()
+            y = 750
+
+    yield p.finish()
+
+
+def generate_issued_pdf(request):
+    checkouts = report_rows(Checkout.get_issued_books_report())
+    return pdf_response("issued_books.pdf", issued_list_pdf(checkouts))
@@ -0,0 +1,85 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramWordSimilarity
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast, Greatest
+
+SEARCH_CONFIG = 'english'
+AUTOCOMPLETE_MIN_LENGTH = 2
+AUTOCOMPLETE_MAX_RESULTS = 25
+
+PHRASE_RE = re.compile(r'"([^"]+)"')
+TERM_RE = re.compile(r'\w+')
+
+
+def build_search_query(text):
+    """
+    Turn free text into a tsquery.
+    Quoted parts are matched as phrases, every other word as a prefix
+    so half-typed words still find something. Returns None if nothing usable.
+    """
+    parts = [
+        SearchQuery(phrase, search_type='phrase', config=SEARCH_CONFIG)
+        for phrase in PHRASE_RE.findall(text)
+        if TERM_RE.search(phrase)
+    ]
+    # Only word characters reach the raw query, so user input can't break the tsquery syntax
+    parts += [
+        SearchQuery(f'{term}:*', search_type='raw', config=SEARCH_CONFIG)
+        for term in TERM_RE.findall(PHRASE_RE.sub(' ', text))
+    ]
+
+    query = None
+    for part in parts:
+        query = part if query is None else query & part
+    return query
+
+
+def search_books(queryset, text):
+    """Full-text search over the book search vector, best matches first"""
+    query = build_search_query(text)
+    if query is None:
+        return queryset
+    # ts_rank is a float4; as a double it round-trips exactly through pagination cursors
+    return queryset.filter(search_vector=query).annotate(
+        rank=Cast(SearchRank(F('search_vector'), query), FloatField())
+    ).order_by('-rank', 'title', 'id')
+
+
+def icontains_search(queryset, text):
+    """The old substring search, kept around to benchmark against"""
+    return queryset.filter(
+        Q(title__icontains=text) |
+        Q(author__icontains=text) |
+        Q(publisher__icontains=text)
+    ).order_by('title', 'id')
+
+
+def autocomplete_books(queryset, text, limit=10):
+    """
+    Typeahead over titles and authors.
+    Uses trigram word similarity, so prefixes and small typos both match
+    and the trigram indexes do the work.
+    """
+    if len(text) < AUTOCOMPLETE_MIN_LENGTH:
+        return queryset.none()
+    return queryset.filter(
+        Q(title__trigram_word_similar=text) | Q(author__trigram_word_similar=text)
+    ).annotate(
+        similarity=Greatest(
+            TrigramWordSimilarity(text, 'title'),
+            TrigramWordSimilarity(text, 'author'),
+        )
+    ).order_by('-similarity', 'title')[:limit]
+
+
+def autocomplete_members(queryset, text, limit=10):
+    """Typeahead for members by username, name or email prefix"""
+    if len(text) < AUTOCOMPLETE_MIN_LENGTH:
+        return queryset.none()
+    return queryset.filter(
+        Q(username__istartswith=text) |
+        Q(first_name__istartswith=text) |
+        Q(last_name__istartswith=text) |
+        Q(email__istartswith=text)
+    ).order_by('username')[:limit]
@@ -0,0 +1,290 @@
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .book_cache import invalidate_books
+from .models import FINE_SQL, LOCK_BOOKS_SQL, Book, BookCopy, Checkout, CustomUser, Reservation
+
+# Up to `quantity` free copies per requested book, the member's own held copies
+# first. SKIP LOCKED means a desk serving someone else never makes this wait,
+# and the LIMIT keeps us from locking copies we won't use.
+LOCK_FREE_COPIES_SQL = """
+    SELECT wanted.book_id, copy.id, copy.held
+    FROM unnest(%(books)s::bigint[], %(quantities)s::int[]) AS wanted(book_id, quantity)
+    CROSS JOIN LATERAL (
+        SELECT id, status = 'ON_HOLD' AS held FROM accounts_bookcopy
+        WHERE book_id = wanted.book_id AND (status = 'AVAILABLE' OR id IN (
+            SELECT copy_id FROM accounts_reservation
+            WHERE member_id = %(member)s AND book_id = wanted.book_id AND NOT fulfilled AND copy_id IS NOT NULL
+        ))
+        ORDER BY status = 'AVAILABLE'
+        LIMIT wanted.quantity
+        FOR UPDATE SKIP LOCKED
+    ) AS copy
+"""
+
+COLLECT_HOLDS_SQL = """
+    UPDATE accounts_reservation SET fulfilled = true
+    WHERE copy_id = ANY(%(copies)s) AND NOT fulfilled
+"""
+
+LEND_COPIES_SQL = """
+    UPDATE accounts_bookcopy AS copy
+    SET status = 'ON_LOAN', checkout_id = lent.checkout_id
+    FROM unnest(%(copies)s::bigint[], %(checkouts)s::bigint[]) AS lent(copy_id, checkout_id)
+    WHERE copy.id = lent.copy_id
+"""
+
+DECREMENT_AVAILABLE_SQL = """
+    UPDATE accounts_book AS book
+    SET available = book.available - taken.quantity
+    FROM unnest(%(books)s::bigint[], %(quantities)s::int[]) AS taken(book_id, quantity)
+    WHERE book.id = taken.book_id
+"""
+
+LOCK_BORROWERS_SQL = """
+    SELECT id FROM accounts_customuser
+    WHERE id IN (SELECT member_id FROM accounts_checkout WHERE id = ANY(%(checkouts)s) AND NOT returned)
+    ORDER BY id
+    FOR UPDATE
+"""
+
+# Every open loan scanned in this batch, closed with its final fine. Row locks
+# on the checkouts make a second desk scanning the same item a no-op.
+CLOSE_LOANS_SQL = f"""
+    WITH open AS (
+        SELECT id, total_fine FROM accounts_checkout
+        WHERE id = ANY(%(checkouts)s) AND NOT returned
+        FOR UPDATE
+    )
+    UPDATE accounts_checkout AS checkout
+    SET returned = true, return_date = %(as_of)s, total_fine = {FINE_SQL}, next_notice_at = NULL
+    FROM open
+    WHERE checkout.id = open.id AND NOT checkout.returned
+    RETURNING checkout.id, checkout.book_id, checkout.quantity,
+              checkout.member_id, open.total_fine, checkout.total_fine
+"""
+
+SHELVE_LINKED_COPIES_SQL = """
+    UPDATE accounts_bookcopy
+    SET status = 'AVAILABLE', checkout_id = NULL
+    WHERE checkout_id = ANY(%(checkouts)s)
+    RETURNING book_id
+"""
+
+# Loans from before per-copy tracking have no linked copies; shelve any lent
+# copy without a loan instead, as many per book as are still missing
+SHELVE_UNLINKED_COPIES_SQL = """
+    UPDATE accounts_bookcopy AS copy
+    SET status = 'AVAILABLE'
+    FROM (
+        SELECT picked.id
+        FROM unnest(%(books)s::bigint[], %(missing)s::int[]) AS short(book_id, missing)
+        CROSS JOIN LATERAL (
+            SELECT id FROM accounts_bookcopy
+            WHERE book_id = short.book_id AND status = 'ON_LOAN' AND checkout_id IS NULL
+            LIMIT short.missing
+            FOR UPDATE SKIP LOCKED
+        ) AS picked
+    ) AS picked
+    WHERE copy.id = picked.id
+    RETURNING copy.book_id
+"""
+
+ADJUST_MEMBER_COUNTERS_SQL = """
+    UPDATE accounts_customuser AS member
+    SET active_loans = member.active_loans + delta.active,
+        overdue_loans = member.overdue_loans + delta.overdue,
+        fine_balance = member.fine_balance + delta.fines
+    FROM unnest(%(members)s::bigint[], %(active)s::int[], %(overdue)s::int[], %(fines)s::numeric[])
+        AS delta(member_id, active, overdue, fines)
+    WHERE member.id = delta.member_id
+"""
+
+INCREMENT_AVAILABLE_SQL = """
+    UPDATE accounts_book AS book
+    SET available = LEAST(book.available + shelved.quantity, book.quantity)
+    FROM unnest(%(books)s::bigint[], %(quantities)s::int[]) AS shelved(book_id, quantity)
+    WHERE book.id = shelved.book_id
+"""
+
+
+def issue_books(member, items, due_date=None):
+    """
+    Issue several books to one member in a single transaction and a fixed number of statements.
+    `items` is a list of (book_id, quantity); repeats of a book are added together.
+    Returns one result dict per distinct book, in request order. Items that can't be
+    filled are reported and skipped, the rest are still issued.
+    """
+    due_date = due_date or timezone.now() + timezone.timedelta(weeks=2)
+    requested = Counter()
+    for book_id, quantity in items:
+        requested[int(book_id)] += int(quantity)
+
+    results = {
+        book_id: {'book': book_id, 'quantity': quantity, 'issued': False, 'checkout': None, 'error': None}
+        for book_id, quantity in requested.items()
+    }
+    wanted = {}
+    for book_id, quantity in requested.items():
+        if quantity < 1:
+            results[book_id]['error'] = 'Quantity must be at least 1'
+        else:
+            wanted[book_id] = quantity
+
+    with transaction.atomic():
+        # Lock the member first and hold their allowance for the rest of the batch
+        active_loans = CustomUser.objects.select_for_update().values_list('active_loans', flat=True).get(pk=member.pk)
+        allowance = settings.MAX_ACTIVE_LOANS - active_loans
+        existing = set(Book.objects.filter(pk__in=list(wanted)).values_list('pk', flat=True))
+        for book_id in list(wanted):
+            if book_id not in existing:
+                results[book_id]['error'] = 'No such book'
+                del wanted[book_id]
+            elif wanted[book_id] > allowance:
+                results[book_id]['error'] = f'Borrowing limit of {settings.MAX_ACTIVE_LOANS} copies reached'
+                del wanted[book_id]
+            else:
+                allowance -= wanted[book_id]
+
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_FREE_COPIES_SQL, {
+                'books': list(wanted), 'quantities': list(wanted.values()), 'member': member.pk,
+            })
+            free_copies = defaultdict(list)
+            held_copies = Counter()
+            for book_id, copy_id, held in cursor.fetchall():
+                free_copies[book_id].append(copy_id)
+                held_copies[book_id] += held
+
+        for book_id in list(wanted):
+            if len(free_copies[book_id]) < wanted[book_id]:
+                results[book_id]['error'] = (
+                    f"Only {len(free_copies[book_id])} copy(s) available - you requested {wanted[book_id]}"
+                )
+                del wanted[book_id]
+
+        if wanted:
+            # bulk_create skips Checkout.save, so fill in what it would have set
+            checkouts = [
+                Checkout(
+                    book_id=book_id,
+                    member=member,
+                    quantity=quantity,
+                    due_date=due_date,
+                    daily_fine_rate=settings.DEFAULT_DAILY_FINE_RATE,
+                    total_fine=0,
+                )
+                for book_id, quantity in wanted.items()
+            ]
+            for checkout in checkouts:
+                checkout.next_notice_at = checkout.scheduled_notice()
+            Checkout.objects.bulk_create(checkouts)
+            copy_ids, checkout_ids = [], []
+            for checkout in checkouts:
+                for copy_id in free_copies[checkout.book_id]:
+                    copy_ids.append(copy_id)
+                    checkout_ids.append(checkout.pk)
+                results[checkout.book_id].update(issued=True, checkout=checkout.pk)
+
+            ordered = sorted(wanted)
+            with connection.cursor() as cursor:
+                cursor.execute(LEND_COPIES_SQL, {'copies': copy_ids, 'checkouts': checkout_ids})
+                if any(held_copies[book_id] for book_id in wanted):
+                    cursor.execute(COLLECT_HOLDS_SQL, {'copies': copy_ids})
+                cursor.execute(LOCK_BOOKS_SQL, {'books': ordered})
+                # Held copies were already off the shelf
+                cursor.execute(DECREMENT_AVAILABLE_SQL, {
+                    'books': ordered, 'quantities': [wanted[book_id] - held_copies[book_id] for book_id in ordered],
+                })
+            CustomUser.adjust_counters(member.pk, active=sum(wanted.values()))
+            invalidate_books(*ordered)
+
+    return [results[book_id] for book_id in requested]
+
+
+def return_checkouts(checkout_ids=(), barcodes=(), returned_at=None):
+    """
+    Return a pile of loans at once, by checkout id and/or copy barcode.
+    A loan goes back as a whole, so scanning any one of its copies returns all of them.
+    Runs a fixed number of statements in one transaction however many items there are.
+    Returns a dict with the checkouts returned plus anything that was already
+    returned or couldn't be found.
+    """
+    returned_at = returned_at or timezone.now()
+    report = {'returned': [], 'already_returned': [], 'not_found': [], 'holds': 0}
+    wanted = {int(checkout_id) for checkout_id in checkout_ids}
+
+    with transaction.atomic():
+        if barcodes:
+            copies = dict(
+                BookCopy.objects.filter(barcode__in=barcodes).values_list('barcode', 'checkout_id')
+            )
+            for barcode in barcodes:
+                if barcode not in copies:
+                    report['not_found'].append(barcode)
+                elif copies[barcode] is None:
+                    report['already_returned'].append(barcode)  # copy's on the shelf
+                else:
+                    wanted.add(copies[barcode])
+        if not wanted:
+            return report
+
+        with connection.cursor() as cursor:
+            cursor.execute(LOCK_BORROWERS_SQL, {'checkouts': list(wanted)})
+            cursor.execute(CLOSE_LOANS_SQL, {'checkouts': list(wanted), 'as_of': returned_at})
+            closed = cursor.fetchall()
+            closed_ids = [checkout_id for checkout_id, *_ in closed]
+
+            # Each loan stops counting as out (and as accruing), and its fine becomes final
+            counters = defaultdict(lambda: [0, 0, 0])
+            for _, _, quantity, member_id, fine_before, fine in closed:
+                counters[member_id][0] -= quantity
+                counters[member_id][1] -= int(fine_before > 0)
+                counters[member_id][2] += fine - fine_before
+            if counters:
+                cursor.execute(ADJUST_MEMBER_COUNTERS_SQL, {
+                    'members': list(counters),
+                    'active': [delta[0] for delta in counters.values()],
+                    'overdue': [delta[1] for delta in counters.values()],
+                    'fines': [delta[2] for delta in counters.values()],
+                })
+
+            # Copies come back from the loans' linked copies first...
+            cursor.execute(SHELVE_LINKED_COPIES_SQL, {'checkouts': closed_ids})
+            shelved = Counter(book_id for book_id, in cursor.fetchall())
+            lent = Counter()
+            for _, book_id, quantity, *_ in closed:
+                lent[book_id] += quantity
+
+            # ...then from untracked ones for whatever's left
+            missing = {book_id: lent[book_id] - shelved[book_id] for book_id in lent if lent[book_id] > shelved[book_id]}
+            if missing:
+                cursor.execute(SHELVE_UNLINKED_COPIES_SQL, {
+                    'books': list(missing), 'missing': list(missing.values()),
+                })
+                shelved.update(book_id for book_id, in cursor.fetchall())
+
+            ordered = sorted(shelved)
+            if ordered:
+                cursor.execute(LOCK_BOOKS_SQL, {'books': ordered})
+                cursor.execute(INCREMENT_AVAILABLE_SQL, {
+                    'books': ordered, 'quantities': [shelved[book_id] for book_id in ordered],
+                })
+                invalidate_books(*ordered)
+
+        if ordered:
+            # Copies go to whoever is waiting for them before they reach the shelf
+            report['holds'] = Reservation.allocate_holds(ordered)
+
+        report['returned'] = sorted(closed_ids)
+        unreturned = wanted.difference(closed_ids)
+        if unreturned:
+            # Scanned twice, returned at another desk, or never existed
+            already = set(Checkout.objects.filter(pk__in=unreturned).values_list('pk', flat=True))
+            report['already_returned'] += sorted(already)
+            report['not_found'] += sorted(unreturned - already)
+
+    return report
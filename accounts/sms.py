@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+def messages_url():
+    base = getattr(settings, 'TWILIO_API_BASE', 'https://api.twilio.com')
+    return f"{base}/2010-04-01/Accounts/{settings.TWILIO_ACCOUNT_SID}/Messages.json"
+
+
+class RateLimiter:
+    """Spaces calls at least 1/per_second apart across all threads"""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SmsDispatcher:
+    """
+    Sends SMS through the Twilio messages API over one pooled requests.Session,
+    `concurrency` requests at a time and no faster than `rate_limit` per second.
+    A 429 or 5xx is retried after a pause; anything else counts as failed.
+
+        stats = SmsDispatcher().send([('+15550100', 'Hello'), ...])
+    """
+
+    def __init__(self, concurrency=None, rate_limit=None, timeout=None, retries=2):
+        self.concurrency = concurrency or getattr(settings, 'SMS_CONCURRENCY', 8)
+        self.rate_limiter = RateLimiter(rate_limit or getattr(settings, 'SMS_RATE_LIMIT', 10))
+        self.timeout = timeout or getattr(settings, 'SMS_TIMEOUT', 10)
+        self.retries = retries
+        self.url = messages_url()
+        self.session = requests.Session()
+        self.session.auth = (settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def send_one(self, to, body):
+        """Returns a result dict: to, ok, status, latency (seconds, last attempt), sid, error"""
+        result = {'to': to, 'ok': False, 'status': None, 'latency': 0.0, 'sid': None, 'error': None}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30))
+            self.rate_limiter.wait()
+            started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.url,
+                    data={'From': settings.TWILIO_PHONE_NUMBER, 'To': to, 'Body': body},
+                    timeout=self.timeout,
+                )
+            except requests.RequestException as e:
+                result.update(latency=time.perf_counter() - started, error=str(e))
+                continue
+            result.update(latency=time.perf_counter() - started, status=response.status_code)
+            if response.ok:
+                result.update(ok=True, sid=response.json().get('sid'), error=None)
+                return result
+            result['error'] = response.text[:200]
+            if response.status_code != 429 and response.status_code < 500:
+                break  # our fault (bad number, auth); retrying won't help
+        logger.error(f"SMS to {to} failed: {result['error']}")
+        return result
+
+    def send(self, messages):
+        """Send (to, body) pairs concurrently. Returns counts, latency percentiles and every result."""
+        messages = list(messages)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(pool.map(lambda message: self.send_one(*message), messages))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(result['latency'] for result in results)
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] if latencies else 0.0
+        stats = {
+            'messages': len(messages),
+            'sent': sum(1 for result in results if result['ok']),
+            'failed': [result for result in results if not result['ok']],
+            'seconds': elapsed,
+            'per_second': len(messages) / elapsed if elapsed else 0,
+            'latency_p50': percentile(0.5),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else 0.0,
+            'results': results,
+        }
+        logger.info(
+            f"Sent {stats['sent']}/{stats['messages']} SMS in {elapsed:.2f}s ({stats['per_second']:.1f}/s), "
+            f"latency p50 {stats['latency_p50'] * 1000:.0f}ms p95 {stats['latency_p95'] * 1000:.0f}ms"
+        )
+        return stats
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+
+
+@deconstructible
+class ReportStorage(FileSystemStorage):
+    """
+    Where background report files are kept: REPORTS_ROOT, outside MEDIA_ROOT,
+    so nothing serves them except the permission-checked download view.
+    """
+
+    @cached_property
+    def base_location(self):
+        return self._value_or_setting(self._location, settings.REPORTS_ROOT)
+
+    def _clear_cached_properties(self, setting, **kwargs):
+        super()._clear_cached_properties(setting, **kwargs)
+        if setting == 'REPORTS_ROOT':
+            self.__dict__.pop('base_location', None)
+            self.__dict__.pop('location', None)
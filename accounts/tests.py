@@ -1,3 +1,917 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock
+from urllib.parse import parse_qs
+from datetime import date, datetime, timedelta
 
-# Create your tests here.
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import (
+    FINE_SQL, Book, BookCopy, BookSubscription, Checkout, CustomUser, FineRun, FineRunRange, OutboxMessage,
+    ReportJob, Reservation,
+)
+from .book_cache import get_book, get_catalog, invalidate_books
+from .facets import compute_book_facets
+from .forms import CheckoutForm
+from .management.commands import calculate_fines
+from .management.commands.process_report_jobs import claim_job
+from .notifications import NotificationSender, render_email
+from .pagination import KeysetPaginator
+from .report_jobs import run_job
+from .search import search_books
+from .services import issue_books, return_checkouts
+from .sms import SmsDispatcher
+
+
+class BookListQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        BookSubscription.objects.create(member=self.member, genre='FIC')
+        self.client.force_login(self.member)
+
+    def add_books(self, count):
+        Book.objects.bulk_create(
+            Book(
+                title=f'Book {Book.objects.count() + i}',
+                author='Author',
+                publisher='Publisher',
+                genre='FIC' if i % 2 else 'SCI',
+                isbn=f'{Book.objects.count() + i:013d}',
+                publication_date=date(2000, 1, 1),
+                notify_subscribers=False,
+            )
+            for i in range(count)
+        )
+
+    def count_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('book-list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.add_books(2)
+        small_page, _ = self.count_queries()
+        self.add_books(8)
+        full_page, response = self.count_queries()
+
+        self.assertEqual(len(response.context['page_obj']), 10)
+        self.assertEqual(small_page, full_page)
+
+    def test_out_of_range_decade_is_ignored(self):
+        self.add_books(2)
+        for decade in ['0', '-10', '9990', '2000']:
+            response = self.client.get(reverse('book-list'), {'decade': decade})
+            self.assertEqual(len(response.context['page_obj']), 2)
+
+    def test_subscription_state_rendered_per_genre(self):
+        self.add_books(2)
+        _, response = self.count_queries()
+
+        self.assertContains(response, reverse('unsubscribe-genre', args=['FIC']))
+        self.assertContains(response, reverse('subscribe-genre', args=['SCI']))
+
+
+class CatalogSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for isbn, title, author, genre, year, description in [
+            ('9990000000801', 'Dune', 'Frank Herbert', 'SCI', 1965, ''),
+            ('9990000000802', 'Children of Dune', 'Frank Herbert', 'SCI', 1976, ''),
+            ('9990000000803', 'Desert Atlas', 'Ann Cartographer', 'FIC', 1991, 'Maps of every dune sea'),
+            ('9990000000804', 'Emma', 'Jane Austen', 'FIC', 1815, ''),
+        ]:
+            Book.objects.create(
+                title=title, author=author, publisher='Publisher', genre=genre, isbn=isbn,
+                publication_date=date(year, 1, 1), description=description, notify_subscribers=False,
+            )
+        self.client.force_login(CustomUser.objects.create_user(username='reader', password='pw', user_type=3))
+
+    def titles(self, **params):
+        return [book.title for book in self.client.get(reverse('book-list'), params).context['page_obj']]
+
+    def test_ranked_prefix_and_phrase_search(self):
+        self.assertEqual(self.titles(q='dune')[-1], 'Desert Atlas')  # a description match ranks last
+        self.assertEqual(sorted(self.titles(q='dun')), ['Children of Dune', 'Desert Atlas', 'Dune'])
+        self.assertEqual(self.titles(q='"children of dune"'), ['Children of Dune'])
+        self.assertEqual(self.titles(q='herb dune', genre='SCI', decade='1970'), ['Children of Dune'])
+        self.assertEqual(self.titles(q='austen'), ['Emma'])
+
+    def test_facets_follow_the_search_in_one_query(self):
+        Book.objects.filter(title='Dune').update(available=0)
+        with self.assertNumQueries(1):
+            facets = compute_book_facets(search_books(Book.objects.all(), 'dune'))
+        self.assertEqual(facets['genre'], [('SCI', 'Science', 2), ('FIC', 'Fiction', 1)])
+        self.assertEqual(facets['availability'], [('no', 'Checked out', 1), ('yes', 'Available', 2)])
+        self.assertEqual([(decade, count) for decade, _, count in facets['decade']], [(1990, 1), (1970, 1), (1960, 1)])
+
+        response = self.client.get(reverse('book-list'), {'q': 'austen'})
+        self.assertEqual(response.context['facets']['publisher'], [('Publisher', 'Publisher', 1)])
+
+    def test_member_autocomplete_matches_prefixes_only(self):
+        for username, first_name, email in [('alice', '', 'a@example.com'), ('bob', 'Alan', 'b@example.com'),
+                                            ('carol', '', 'al@example.com'), ('dave', 'Sal', 'd@example.com')]:
+            CustomUser.objects.create_user(username=username, first_name=first_name, email=email, password='pw')
+        CustomUser.objects.create_user(username='alma', password='pw', user_type=2)  # staff aren't borrowers
+        self.client.force_login(CustomUser.objects.create_user(username='desk', password='pw', user_type=2))
+
+        def usernames(**params):
+            response = self.client.get(reverse('member-autocomplete'), params)
+            return [result['text'] for result in response.json()['results']]
+
+        self.assertEqual(usernames(q='AL'), ['alice', 'bob', 'carol'])
+        self.assertEqual(usernames(q='al', limit=2), ['alice', 'bob'])
+        self.assertEqual(usernames(q='a'), [])
+
+        # The issue form's select holds just the chosen member, the rest come from the endpoint
+        field = str(CheckoutForm(initial={'member': CustomUser.objects.get(username='bob').pk})['member'])
+        self.assertEqual(field.count('<option'), 2)
+        self.assertIn(f'data-autocomplete-url="{reverse("member-autocomplete")}"', field)
+
+
+class BookCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.book = Book.objects.create(
+            title='Cached', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000701', publication_date=date(2000, 1, 1), quantity=2, notify_subscribers=False,
+        )
+
+    def test_change_retires_cached_book(self):
+        self.assertEqual(get_book(self.book.pk).available, 2)
+        Book.objects.filter(pk=self.book.pk).update(available=1)
+        self.assertEqual(get_book(self.book.pk).available, 2)  # still cached
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_books(self.book.pk)
+        self.assertEqual(get_book(self.book.pk).available, 1)
+
+    def test_search_key_ignores_case_but_not_cursor_case(self):
+        load = mock.Mock(side_effect=lambda: load.call_count)
+        self.assertEqual(get_catalog('test', {'q': 'Dune', 'cursor': 'aB'}, load), 1)
+        self.assertEqual(get_catalog('test', {'q': ' dune ', 'cursor': 'aB'}, load), 1)
+        self.assertEqual(get_catalog('test', {'q': 'dune', 'cursor': 'Ab'}, load), 2)
+
+    def test_issue_retires_cached_detail_page(self):
+        member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        self.client.force_login(CustomUser.objects.create_user(username='admin', password='pw', user_type=1, is_staff=True))
+
+        def available():
+            return self.client.get(reverse('book-detail', args=[self.book.pk])).context['book'].available
+
+        self.assertEqual((available(), available()), (2, 2))
+        self.assertEqual(self.client.get(reverse('book-cache-metrics')).json(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+        with self.captureOnCommitCallbacks(execute=True):
+            issue_books(member, [(self.book.pk, 1)])
+        self.assertEqual(available(), 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_bypassed(self):
+        load = mock.Mock(return_value=[])
+        get_catalog('test', {}, load)
+        get_catalog('test', {}, load)
+        self.assertEqual(load.call_count, 2)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        # Equal titles so pages have to break ties on id
+        Book.objects.bulk_create(
+            Book(title=f'Book {i // 3}', author='Author', publisher='Publisher', genre='FIC',
+                 isbn=f'{i:013d}', publication_date=date(2000, 1, 1), notify_subscribers=False)
+            for i in range(23)
+        )
+        self.paginator = KeysetPaginator(Book.objects.all(), ('title', 'id'), per_page=5)
+
+    def test_cursors_walk_every_row_once_both_ways(self):
+        pages, page = [], self.paginator.get_page()
+        while True:
+            pages.append([book.pk for book in page])
+            if not page.has_next():
+                break
+            page = self.paginator.get_page(page.next_cursor)
+        self.assertEqual(sum(pages, []), list(Book.objects.order_by('title', 'id').values_list('pk', flat=True)))
+        self.assertEqual([len(p) for p in pages], [5, 5, 5, 5, 3])
+
+        page = self.paginator.get_page(page.previous_cursor)
+        self.assertEqual([book.pk for book in page], pages[-2])
+        self.assertTrue(page.has_next())
+        self.assertEqual(self.paginator.get_page('not-a-cursor').object_list, self.paginator.get_page().object_list)
+
+    def test_total_is_only_estimated_where_opted_in(self):
+        cache.clear()
+        self.client.force_login(CustomUser.objects.create_user(username='reader', password='pw', user_type=3))
+        self.assertIsNone(self.client.get(reverse('book-list')).context['page_obj'].total)
+        with override_settings(ESTIMATED_TOTALS={'book_list'}):
+            cache.clear()
+            self.assertIsInstance(self.client.get(reverse('book-list')).context['page_obj'].total, int)
+
+
+class FlakyBackend(EmailBackend):
+    """locmem backend whose first few batches drop the connection"""
+    failures = 0
+
+    def send_messages(self, messages):
+        if FlakyBackend.failures:
+            FlakyBackend.failures -= 1
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super().send_messages(messages)
+
+
+class NotificationSenderTests(TestCase):
+    def messages(self, count):
+        return [
+            render_email('Hello', 'accounts/emails/due_notification.html', {}, f'member{i}@example.com')
+            for i in range(count)
+        ]
+
+    def test_sends_in_batches(self):
+        stats = NotificationSender(batch_size=100).send(self.messages(250))
+
+        self.assertEqual(len(mail.outbox), 250)
+        self.assertEqual((stats['sent'], stats['batches'], stats['failed']), (250, 3, []))
+        self.assertEqual(mail.outbox[0].alternatives[0].mimetype, 'text/html')
+
+    def test_failed_batch_is_retried_then_reported(self):
+        backend = 'accounts.tests.FlakyBackend'
+        FlakyBackend.failures = 1
+        stats = NotificationSender(batch_size=10, backoff=0, backend=backend).send(self.messages(20))
+        self.assertEqual((stats['sent'], stats['retries'], stats['failed']), (20, 1, []))
+
+        FlakyBackend.failures = 3  # every attempt at the first batch
+        stats = NotificationSender(batch_size=10, retries=2, backoff=0, backend=backend).send(self.messages(20))
+        self.assertEqual(stats['sent'], 10)
+        self.assertEqual(len(stats['failed']), 10)
+
+
+class OutboxTests(TestCase):
+    def test_new_book_is_queued_then_sent_by_worker(self):
+        member = CustomUser.objects.create_user(username='fan', email='fan@example.com', password='pw', user_type=3)
+        BookSubscription.objects.create(member=member, genre='FIC')
+        Book.objects.create(
+            title='Queued', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000001', publication_date=date(2000, 1, 1),
+        )
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.PENDING).count(), 1)
+
+        call_command('process_outbox', stdout=StringIO())
+
+        self.assertEqual(mail.outbox[0].to, ['fan@example.com'])
+        self.assertEqual(OutboxMessage.objects.get().status, OutboxMessage.SENT)
+
+    def test_unrenderable_row_is_retried_alone_then_dead_lettered(self):
+        readers = [
+            CustomUser.objects.create_user(username=f'fan{i}', email=f'fan{i}@example.com', password='pw', user_type=3)
+            for i in range(2)
+        ]
+        for reader in readers:
+            BookSubscription.objects.create(member=reader, genre='FIC')
+        Book.objects.create(
+            title='Poison', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000011', publication_date=date(2000, 1, 1),
+        )
+        original = Book.new_book_message
+
+        def render(book, member):
+            if member == readers[0]:
+                raise ValueError('bad template')
+            return original(book, member)
+
+        with mock.patch.object(Book, 'new_book_message', render):
+            call_command('process_outbox', '--max-attempts', '1', stdout=StringIO(), stderr=StringIO())
+
+        self.assertEqual([message.to for message in mail.outbox], [['fan1@example.com']])
+        poison = OutboxMessage.objects.get(member=readers[0])
+        self.assertEqual(poison.status, OutboxMessage.DEAD)
+        self.assertIn('bad template', poison.last_error)
+
+        # A row whose worker died on its last attempt isn't claimed again
+        OutboxMessage.objects.filter(pk=poison.pk).update(
+            status=OutboxMessage.PENDING, attempts=5, next_attempt_at=timezone.now() - timedelta(minutes=1),
+        )
+        call_command('process_outbox', stdout=StringIO())
+        poison.refresh_from_db()
+        self.assertEqual((poison.status, poison.attempts), (OutboxMessage.DEAD, 5))
+
+    def test_daily_subscribers_get_one_digest(self):
+        member = CustomUser.objects.create_user(username='fan', email='fan@example.com', password='pw', user_type=3)
+        BookSubscription.objects.create(member=member, genre='FIC', frequency=BookSubscription.DAILY)
+        BookSubscription.objects.create(member=member, genre='SCI', frequency=BookSubscription.DAILY)
+        for i, genre in enumerate(['FIC', 'FIC', 'SCI']):
+            Book.objects.create(
+                title=f'Digest {i}', author='Author', publisher='Publisher', genre=genre,
+                isbn=f'999000000010{i}', publication_date=date(2000, 1, 1),
+            )
+        self.assertFalse(OutboxMessage.objects.exists())
+
+        call_command('send_digests', 'daily', stdout=StringIO())
+        call_command('send_digests', 'daily', stdout=StringIO())  # already had today's
+        self.assertEqual(OutboxMessage.objects.filter(kind=OutboxMessage.DIGEST).count(), 1)
+
+        call_command('process_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['fan@example.com'])
+        for i in range(3):
+            self.assertIn(f'Digest {i}', mail.outbox[0].body)
+
+
+class DueNoticeTests(TestCase):
+    def test_each_stage_is_queued_once(self):
+        member = CustomUser.objects.create_user(username='reader', email='reader@example.com', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Due', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000201', publication_date=date(2000, 1, 1),
+        )
+        now = timezone.now()
+        [result] = issue_books(member, [(book.pk, 1)], due_date=now + timedelta(days=2))
+        due_notices = OutboxMessage.objects.filter(kind=OutboxMessage.DUE)
+
+        self.assertEqual(Checkout.queue_due_notices(now), 1)  # three days before
+        self.assertEqual(Checkout.queue_due_notices(now + timedelta(hours=1)), 0)
+        self.assertEqual(Checkout.queue_due_notices(now + timedelta(days=2, hours=1)), 1)  # due day
+        self.assertEqual(Checkout.queue_due_notices(now + timedelta(days=30)), 1)  # skips straight to the last
+        self.assertEqual(Checkout.queue_due_notices(now + timedelta(days=60)), 0)
+        self.assertEqual(due_notices.count(), 3)
+
+        checkout = Checkout.objects.get(pk=result['checkout'])
+        self.assertEqual(checkout.notice_stage, 4)
+        self.assertIsNone(checkout.next_notice_at)
+
+    def test_due_day_reminder_goes_out_before_the_book_is_late(self):
+        member = CustomUser.objects.create_user(username='reader', email='reader@example.com', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Due Today', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000203', publication_date=date(2000, 1, 1),
+        )
+        due = timezone.make_aware(datetime(2030, 3, 10, 17, 0))
+        [result] = issue_books(member, [(book.pk, 1)], due_date=due)
+        Checkout.queue_due_notices(due - timedelta(days=3))  # the three-day reminder
+        self.assertEqual(Checkout.queue_due_notices(due - timedelta(hours=8)), 1)  # 09:00 on the due day
+
+        checkout = Checkout.objects.get(pk=result['checkout'])
+        self.assertEqual(checkout.next_notice_at, timezone.make_aware(datetime(2030, 3, 11)))
+        with mock.patch('django.utils.timezone.now', return_value=due - timedelta(hours=8)):
+            message = checkout.due_message()
+        self.assertEqual(message.subject, 'Reminder: Due Today due soon')
+
+    def test_returned_loans_are_not_reminded(self):
+        member = CustomUser.objects.create_user(username='reader', email='reader@example.com', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Due', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000202', publication_date=date(2000, 1, 1),
+        )
+        [result] = issue_books(member, [(book.pk, 1)], due_date=timezone.now() + timedelta(days=1))
+        return_checkouts(checkout_ids=[result['checkout']])
+        self.assertIsNone(Checkout.objects.get(pk=result['checkout']).next_notice_at)
+        self.assertEqual(Checkout.queue_due_notices(timezone.now() + timedelta(days=30)), 0)
+
+
+class FineTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(
+            title='Late', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000501', publication_date=date(2000, 1, 1), quantity=20, notify_subscribers=False,
+        )
+        self.members = [
+            CustomUser.objects.create_user(username=f'reader{i}', password='pw', user_type=3) for i in range(2)
+        ]
+        self.as_of = timezone.now()
+
+    def lend(self, *late, member=0):
+        """One loan per offset, due that long before self.as_of"""
+        return [
+            issue_books(self.members[member], [(self.book.pk, 1)], due_date=self.as_of - offset)[0]['checkout']
+            for offset in late
+        ]
+
+    def python_fines(self, now):
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            return {checkout.pk: checkout.calculate_fine() for checkout in Checkout.objects.all()}
+
+    def test_sql_fine_matches_model_at_grace_and_cap(self):
+        grace, cap = timedelta(days=3), timedelta(days=33)
+        second, day = timedelta(seconds=1), timedelta(days=1)
+        self.lend(-day, day / 2, grace - second, grace, grace + second, grace + day, cap - second, cap, cap + 7 * day)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id, {FINE_SQL} FROM accounts_checkout ORDER BY id', {'as_of': self.as_of})
+            sql_fines = dict(cursor.fetchall())
+        python_fines = self.python_fines(self.as_of)
+
+        self.assertEqual([sql_fines[pk] for pk in sorted(sql_fines)], [0, 0, 0, 0, 0, 10, 290, 300, 300])
+        self.assertEqual(sql_fines, python_fines)
+
+    def run_fines(self, *args, now):
+        output = StringIO()
+        with mock.patch('django.utils.timezone.now', return_value=now):
+            call_command('calculate_fines', *args, stdout=output)
+        return output.getvalue()
+
+    def assert_matches_full_run(self, now):
+        fines = dict(Checkout.objects.values_list('pk', 'total_fine'))
+        self.assertEqual(fines, self.python_fines(now))
+        self.assertIn(f'Updated fines for 0 of {len(fines)} checkouts', self.run_fines(now=now))
+        verify = StringIO()
+        call_command('member_counters', 'verify', stdout=verify)
+        self.assertIn('All member counters match', verify.getvalue())
+
+    def test_incremental_run_matches_a_full_run(self):
+        self.lend(*(timedelta(days=n) for n in (1, 3, 5, 20)))
+        self.lend(*(timedelta(days=n) for n in (31, 32, 50)), member=1)
+        self.run_fines(now=self.as_of)
+
+        # Four days on, the loan that was already capped isn't looked at again
+        later = self.as_of + timedelta(days=4)
+        self.assertIn('Updated fines for 6 of 6 checkouts', self.run_fines('--incremental', now=later))
+        self.assertEqual(
+            sorted(Checkout.objects.values_list('total_fine', flat=True)), [20, 40, 60, 210, 300, 300, 300],
+        )
+        self.assert_matches_full_run(later)
+
+    def test_resumed_run_matches_a_full_run(self):
+        self.lend(*(timedelta(days=n) for n in (1, 5, 20, 40)))
+        self.lend(*(timedelta(days=n) for n in (4, 32)), member=1)
+        process_range = calculate_fines.process_range
+
+        def dies_after_one_range(*args):
+            if FineRunRange.objects.exists():
+                raise RuntimeError('Worker killed')
+            return process_range(*args)
+
+        with mock.patch.object(calculate_fines, 'process_range', side_effect=dies_after_one_range):
+            with self.assertRaises(RuntimeError):
+                self.run_fines('--range-size', '2', now=self.as_of)
+        self.assertEqual(FineRun.last_unfinished().ranges.count(), 1)
+
+        # The resumed half fines as of the original run's clock, not its own
+        self.run_fines('--resume', '--range-size', '2', now=self.as_of + timedelta(days=1))
+        self.assertIsNone(FineRun.last_unfinished())
+        self.assert_matches_full_run(self.as_of)
+
+
+class MemberCounterTests(TestCase):
+    def setUp(self):
+        self.books = [
+            Book.objects.create(
+                title=f'Counted {i}', author='Author', publisher='Publisher', genre='FIC',
+                isbn=f'99900000006{i:02d}', publication_date=date(2000, 1, 1), quantity=3, notify_subscribers=False,
+            )
+            for i in range(2)
+        ]
+        self.member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+
+    def assert_counters(self, active, overdue, fines):
+        self.member.refresh_from_db()
+        self.assertEqual((self.member.active_loans, self.member.overdue_loans, self.member.fine_balance),
+                         (active, overdue, fines))
+        verify = StringIO()
+        call_command('member_counters', 'verify', stdout=verify)
+        self.assertIn('All member counters match', verify.getvalue())
+
+    def test_counters_follow_issue_return_and_delete(self):
+        late, on_time = issue_books(self.member, [(self.books[0].pk, 2), (self.books[1].pk, 1)],
+                                    due_date=timezone.now() - timedelta(days=10))
+        call_command('calculate_fines', stdout=StringIO())
+        self.assert_counters(3, 2, 140)
+
+        [loan] = issue_books(self.member, [(self.books[1].pk, 1)])
+        self.assert_counters(4, 2, 140)
+
+        Checkout.objects.get(pk=late['checkout']).mark_returned()
+        self.assert_counters(2, 1, 140)  # paid or not, a returned fine stays on the balance
+        return_checkouts(checkout_ids=[on_time['checkout']])
+        self.assert_counters(1, 0, 140)
+
+        Checkout.objects.get(pk=late['checkout']).delete()
+        self.assert_counters(1, 0, 70)
+        Checkout.objects.get(pk=loan['checkout']).delete()
+        self.assert_counters(0, 0, 70)
+
+        issue_books(self.member, [(self.books[1].pk, 2)])
+        self.books[1].delete()
+        self.assert_counters(0, 0, 0)
+        self.assertEqual(
+            (Book.objects.get(pk=self.books[0].pk).available, BookCopy.objects.filter(status=BookCopy.AVAILABLE).count()),
+            (3, 3),
+        )
+
+
+class CopyInventoryTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(
+            title='Bestseller', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000901', publication_date=date(2000, 1, 1), quantity=2, notify_subscribers=False,
+        )
+
+    def test_conditional_updates_never_oversell(self):
+        self.assertFalse(self.book.checkout_copies(3))
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 2)
+        self.assertFalse(BookCopy.objects.exclude(status=BookCopy.AVAILABLE).exists())
+
+        self.assertTrue(self.book.checkout_copies(2))
+        self.assertFalse(self.book.checkout_copy())
+        self.assertFalse(self.book.return_copies(3))  # only two are out
+        self.assertTrue(self.book.return_copies(2))
+        self.assertFalse(self.book.return_copy())
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 2)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Book.objects.filter(pk=self.book.pk).update(available=F('quantity') + 1)
+
+    def test_book_drop_returns_whole_loans_by_barcode(self):
+        member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        [loan] = issue_books(member, [(self.book.pk, 2)])
+        barcode = BookCopy.objects.filter(checkout=loan['checkout']).values_list('barcode', flat=True)[0]
+
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as scans:
+            scans.write(f'{barcode} NOPE-1\n{barcode}\n999999\n')
+            scans.flush()
+            output = StringIO()
+            call_command('return_books', '--file', scans.name, '--batch-size', '2', stdout=output)
+
+        self.assertIn('Returned 1 loans', output.getvalue())
+        self.assertIn(f'Already returned: {barcode}', output.getvalue())
+        self.assertIn('Not found: NOPE-1', output.getvalue())
+        self.assertIn('Not found: 999999', output.getvalue())
+        self.book.refresh_from_db()
+        member.refresh_from_db()
+        self.assertEqual((self.book.available, member.active_loans), (2, 0))
+        self.assertTrue(Checkout.objects.get(pk=loan['checkout']).returned)
+
+
+class CopyContentionTests(TransactionTestCase):
+    def test_parallel_desks_each_get_their_own_copies(self):
+        book = Book.objects.create(
+            title='Term Start', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000902', publication_date=date(2000, 1, 1), quantity=5, notify_subscribers=False,
+        )
+        members = [CustomUser.objects.create_user(username=f'reader{i}', password='pw') for i in range(8)]
+        results, start = {}, threading.Barrier(len(members))
+
+        def desk(member):
+            try:
+                start.wait()
+                [results[member.pk]] = issue_books(member, [(book.pk, 1)])
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=desk, args=(member,)) for member in members]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        issued = [result['checkout'] for result in results.values() if result['issued']]
+        self.assertEqual((len(results), len(issued)), (8, 5))
+        lent = BookCopy.objects.filter(book=book, status=BookCopy.ON_LOAN)
+        self.assertEqual(sorted(lent.values_list('checkout', flat=True)), sorted(issued))
+        book.refresh_from_db()
+        self.assertEqual(book.available, 0)
+
+
+class BatchLoanTests(TestCase):
+    def setUp(self):
+        self.books = [
+            Book.objects.create(
+                title=f'Stack {i}', author='Author', publisher='Publisher', genre='FIC',
+                isbn=f'99900000004{i:02d}', publication_date=date(2000, 1, 1), quantity=2, notify_subscribers=False,
+            )
+            for i in range(2)
+        ]
+        self.member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        self.client.force_login(CustomUser.objects.create_user(username='desk', password='pw', user_type=2))
+
+    def post(self, name, payload):
+        return self.client.post(reverse(name), json.dumps(payload), content_type='application/json')
+
+    def test_issue_then_return_a_stack(self):
+        response = self.post('issue-books-batch', {
+            'member': self.member.pk, 'due_date': '2030-05-01T12:00:00Z',
+            'items': [{'book': self.books[0].pk, 'quantity': 2}, {'book': self.books[1].pk}, {'book': 0}],
+        })
+        body = response.json()
+        self.assertEqual(body['issued'], 2)
+        self.assertEqual([result['error'] for result in body['results']], [None, None, 'No such book'])
+        self.assertEqual(BookCopy.objects.filter(status=BookCopy.ON_LOAN).count(), 3)
+        self.assertEqual(Checkout.objects.get(pk=body['results'][0]['checkout']).due_date.year, 2030)
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.active_loans, 3)
+
+        checkouts = [result['checkout'] for result in body['results'][:2]]
+        self.assertEqual(self.post('return-books-batch', {'checkouts': checkouts}).status_code, 200)
+        self.assertEqual(list(Book.objects.order_by('pk').values_list('available', flat=True)), [2, 2])
+        self.assertFalse(BookCopy.objects.exclude(status=BookCopy.AVAILABLE).exists())
+        self.member.refresh_from_db()
+        self.assertEqual(self.member.active_loans, 0)
+
+    def test_unparseable_due_date_is_rejected(self):
+        response = self.post('issue-books-batch', {
+            'member': self.member.pk, 'due_date': 'next tuesday', 'items': [{'book': self.books[0].pk}],
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], 'Malformed request')
+        self.assertFalse(Checkout.objects.exists())
+
+
+class HoldQueueTests(TestCase):
+    def setUp(self):
+        self.book = Book.objects.create(
+            title='Popular', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000301', publication_date=date(2000, 1, 1), quantity=1,
+        )
+        self.members = [
+            CustomUser.objects.create_user(username=f'reader{i}', email=f'reader{i}@example.com', password='pw', user_type=3)
+            for i in range(3)
+        ]
+
+    def test_returned_copy_goes_to_oldest_reservation(self):
+        [loan] = issue_books(self.members[0], [(self.book.pk, 1)])
+        first = Reservation.objects.create(member=self.members[1], book=self.book)
+        second = Reservation.objects.create(member=self.members[2], book=self.book)
+        self.assertEqual((first.queue_position, second.queue_position), (1, 2))
+
+        report = return_checkouts(checkout_ids=[loan['checkout']])
+
+        self.assertEqual(report['holds'], 1)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.copy.status, BookCopy.ON_HOLD)
+        self.assertEqual((first.queue_position, second.queue_position), (0, 1))
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+        self.assertEqual(
+            list(OutboxMessage.objects.filter(kind=OutboxMessage.AVAILABLE).values_list('member_id', 'object_id')),
+            [(self.members[1].pk, first.pk)],
+        )
+
+        # Nobody else can take it, but the member it's held for can
+        self.assertFalse(issue_books(self.members[2], [(self.book.pk, 1)])[0]['issued'])
+        self.assertTrue(issue_books(self.members[1], [(self.book.pk, 1)])[0]['issued'])
+        first.refresh_from_db()
+        self.assertTrue(first.fulfilled)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+
+    def test_lapsed_hold_passes_to_next_in_line(self):
+        [loan] = issue_books(self.members[0], [(self.book.pk, 1)])
+        first = Reservation.objects.create(member=self.members[1], book=self.book)
+        second = Reservation.objects.create(member=self.members[2], book=self.book)
+        return_checkouts(checkout_ids=[loan['checkout']])
+        first.refresh_from_db()
+        copy_id = first.copy_id
+
+        call_command('expire_reservations', stdout=StringIO())  # not lapsed yet
+        Reservation.objects.filter(pk=first.pk).update(expiry_date=timezone.now() - timedelta(minutes=1))
+        call_command('expire_reservations', stdout=StringIO())
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertTrue(first.expired)
+        self.assertIsNone(first.copy_id)
+        self.assertEqual(second.copy_id, copy_id)
+        self.assertGreater(second.expiry_date, timezone.now())
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+
+    def test_mark_returned_places_hold(self):
+        [loan] = issue_books(self.members[0], [(self.book.pk, 1)])
+        reservation = Reservation.objects.create(member=self.members[1], book=self.book)
+        Checkout.objects.get(pk=loan['checkout']).mark_returned()
+        reservation.refresh_from_db()
+        self.assertIsNotNone(reservation.copy_id)
+        self.book.refresh_from_db()
+        self.assertEqual(self.book.available, 0)
+
+    def test_deleting_a_hold_passes_the_copy_on(self):
+        [loan] = issue_books(self.members[0], [(self.book.pk, 1)])
+        first = Reservation.objects.create(member=self.members[1], book=self.book)
+        second = Reservation.objects.create(member=self.members[2], book=self.book)
+        return_checkouts(checkout_ids=[loan['checkout']])
+        first.refresh_from_db()
+        copy = first.copy
+
+        first.delete()
+        second.refresh_from_db()
+        self.assertEqual(second.copy, copy)
+
+        # With nobody left waiting it goes back on the shelf, here via the member's deletion
+        self.members[2].delete()
+        copy.refresh_from_db()
+        self.book.refresh_from_db()
+        self.assertEqual((copy.status, self.book.available), (BookCopy.AVAILABLE, 1))
+
+    def test_issue_form_lends_held_copy_to_its_member(self):
+        [loan] = issue_books(self.members[0], [(self.book.pk, 1)])
+        reservation = Reservation.objects.create(member=self.members[1], book=self.book)
+        return_checkouts(checkout_ids=[loan['checkout']])
+        self.client.force_login(CustomUser.objects.create_user(username='desk', password='pw', user_type=2))
+        due = (timezone.now() + timedelta(days=14)).strftime('%Y-%m-%dT%H:%M')
+
+        # What the issue form and the book autocomplete offer
+        self.assertFalse(Book.objects.filter(Book.lendable_filter(self.members[2].pk)).exists())
+        self.assertTrue(Book.objects.filter(Book.lendable_filter(self.members[1].pk)).exists())
+
+        form = {'book': self.book.pk, 'quantity': 1, 'due_date': due}
+        self.client.post(reverse('issue-book'), {**form, 'member': self.members[2].pk})
+        self.assertFalse(Checkout.objects.filter(member=self.members[2]).exists())
+        response = self.client.post(reverse('issue-book'), {**form, 'member': self.members[1].pk})
+        self.assertRedirects(response, reverse('active-loans'), fetch_redirect_response=False)
+
+        reservation.refresh_from_db()
+        self.assertTrue(reservation.fulfilled)
+        self.assertEqual(reservation.copy.status, BookCopy.ON_LOAN)
+        self.assertEqual(reservation.copy.checkout.member, self.members[1])
+
+
+class ReportPdfTests(TestCase):
+    def test_issued_pdf_streams_a_page_at_a_time(self):
+        librarian = CustomUser.objects.create_user(username='desk', password='pw', user_type=2)
+        member = CustomUser.objects.create_user(username='reader', first_name='Ann', last_name='Reader', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Report (draft)', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000401', publication_date=date(2000, 1, 1), quantity=100, notify_subscribers=False,
+        )
+        Checkout.objects.bulk_create(
+            Checkout(book=book, member=member, due_date=timezone.now() + timedelta(days=i % 20 - 10)) for i in range(100)
+        )
+        self.client.force_login(librarian)
+
+        response = self.client.get(reverse('generate-issued-pdf'))
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 4)  # fonts, two full pages, last page with the trailer
+        pdf = b''.join(chunks)
+        self.assertTrue(pdf.startswith(b'%PDF-1.4'))
+        self.assertTrue(pdf.endswith(b'%%EOF\n'))
+        self.assertIn(b'/Count 3', pdf)  # 32 rows under the header, then 35 a page
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        librarian = CustomUser.objects.create_user(username='desk', password='pw', user_type=2)
+        member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Exported, "quoted"', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000501', publication_date=date(2000, 1, 1), quantity=10, notify_subscribers=False,
+        )
+        now = timezone.now()
+        Checkout.objects.bulk_create([
+            Checkout(book=book, member=member, due_date=now - timedelta(days=5), total_fine=20),
+            Checkout(book=book, member=member, due_date=now + timedelta(days=5)),
+            Checkout(book=book, member=member, due_date=now - timedelta(days=9), returned=True),
+        ])
+        self.client.force_login(librarian)
+
+    def test_csv_uses_report_filter_and_columns(self):
+        response = self.client.get(reverse('overdue-books-report'), {'export': 'csv', 'columns': 'book,member,total_fine,bogus'})
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows, [['Book', 'Member', 'Fine'], ['Exported, "quoted"', 'reader', '20.00']])
+
+    def test_loan_history_page_and_formula_safe_csv(self):
+        response = self.client.get(reverse('loan-history-all'))
+        self.assertEqual(len(response.context['checkouts']), 3)
+        self.assertNotContains(response, 'No loan history')
+
+        CustomUser.objects.filter(username='reader').update(first_name='=HYPERLINK("http://x")', last_name='')
+        response = self.client.get(reverse('overdue-books-report'), {'export': 'csv', 'columns': 'member_name,total_fine'})
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[1], ['\'=HYPERLINK("http://x")', '20.00'])
+
+    def test_xlsx_is_a_workbook(self):
+        response = self.client.get(reverse('issued-books-report'), {'export': 'xlsx', 'columns': 'id,book'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="issued_books.xlsx"')
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as workbook:
+            self.assertIsNone(workbook.testzip())
+            sheet = workbook.read('xl/worksheets/sheet1.xml').decode()
+        self.assertEqual(sheet.count('<row '), 3)  # header and the two open loans
+        self.assertIn('<t>Exported, "quoted"</t>', sheet)
+
+
+class ReportJobTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        librarian = CustomUser.objects.create_user(username='desk', password='pw', user_type=2)
+        member = CustomUser.objects.create_user(username='reader', password='pw', user_type=3)
+        book = Book.objects.create(
+            title='Queued Report', author='Author', publisher='Publisher', genre='FIC',
+            isbn='9990000000601', publication_date=date(2000, 1, 1), quantity=10, notify_subscribers=False,
+        )
+        Checkout.objects.create(book=book, member=member, due_date=timezone.now() - timedelta(days=5))
+        self.client.force_login(librarian)
+
+    def test_repeat_requests_share_one_job_and_file(self):
+        with self.settings(REPORTS_ROOT=self.media):
+            first = self.client.get(reverse('overdue-books-report'), {'export': 'csv', 'columns': 'book,member', 'async': 1})
+            again = self.client.get(reverse('overdue-books-report'), {'export': 'csv', 'columns': 'book,member', 'async': 1})
+            self.assertEqual(first.url, again.url)
+            job = ReportJob.objects.get()
+            self.assertEqual((job.status, job.requests), (ReportJob.PENDING, 2))
+
+            call_command('process_report_jobs', stdout=StringIO())
+            status = self.client.get(first.url, {'format': 'json'}).json()
+            self.assertEqual(status['status'], ReportJob.DONE)
+            job.refresh_from_db()
+            self.assertTrue(job.file.path.startswith(self.media))  # not under the public MEDIA_ROOT
+            response = self.client.get(status['download_url'])
+            self.assertEqual(b''.join(response.streaming_content), b'Book,Member\r\nQueued Report,reader\r\n')
+            self.assertEqual(response['Cache-Control'], 'private, max-age=86400')
+            cached = self.client.get(status['download_url'], HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(cached.status_code, 304)
+
+            # Still fresh, so a new click gets the finished file rather than another job
+            self.client.get(reverse('generate-overdue-pdf'), {'async': 1})
+            self.client.get(reverse('overdue-books-report'), {'export': 'csv', 'columns': 'book,member', 'async': 1})
+            self.assertEqual(ReportJob.objects.count(), 2)
+
+
+    def test_attempt_that_lost_its_job_does_not_finish_it(self):
+        with self.settings(REPORTS_ROOT=self.media):
+            ReportJob.request(ReportJob.ISSUED, 'csv', ['book'])
+            job = claim_job()
+            ReportJob.objects.filter(pk=job.pk).update(attempts=job.attempts + 1)  # another worker took it over
+            self.assertFalse(run_job(job))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.file.name), (ReportJob.RUNNING, ''))
+            self.assertEqual(os.listdir(self.media), [])
+
+
+class FakeTwilio(BaseHTTPRequestHandler):
+    """Accepts anything posted to the messages endpoint except the number +15550000"""
+    received = []
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        FakeTwilio.received.append((self.path, form['To'][0], form['Body'][0]))
+        status, payload = (400, {'message': 'Invalid To number'}) if form['To'][0] == '+15550000' else (201, {'sid': f"SM{len(FakeTwilio.received)}"})
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SmsDispatcherTests(SimpleTestCase):
+    def setUp(self):
+        FakeTwilio.received = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwilio)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.settings_override = override_settings(
+            TWILIO_API_BASE=f"http://127.0.0.1:{self.server.server_port}", TWILIO_ACCOUNT_SID='ACtest',
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_sends_concurrently_and_reports_failures(self):
+        texts = [(f"+1555010{i:02d}", f"Message {i}") for i in range(20)] + [('+15550000', 'Bad number')]
+        dispatcher = SmsDispatcher(concurrency=4, rate_limit=1000)
+        with self.assertLogs('accounts.sms', 'ERROR'):
+            stats = dispatcher.send(texts)
+        dispatcher.close()
+
+        self.assertEqual(stats['messages'], 21)
+        self.assertEqual(stats['sent'], 20)
+        self.assertEqual([(result['to'], result['status']) for result in stats['failed']], [('+15550000', 400)])
+        self.assertEqual(len(FakeTwilio.received), 21)  # a 400 isn't retried
+        self.assertEqual({path for path, _, _ in FakeTwilio.received}, {'/2010-04-01/Accounts/ACtest/Messages.json'})
+        self.assertTrue(all(result['sid'] for result in stats['results'] if result['ok']))
+        self.assertGreater(stats['latency_max'], 0)
+
+    def test_rate_limit_spaces_requests(self):
+        dispatcher = SmsDispatcher(concurrency=4, rate_limit=20)
+        started = time.perf_counter()
+        stats = dispatcher.send([(f"+1555010{i:02d}", 'Hi') for i in range(10)])
+        dispatcher.close()
+        self.assertEqual(stats['sent'], 10)
+        self.assertGreaterEqual(time.perf_counter() - started, 9 / 20)
@@ -13,8 +13,11 @@ urlpatterns = [
     path('reports/overdue-books/', views.OverdueBooksReportView.as_view(), name='overdue-books-report'),
     path('reports/issued-books/pdf/', views.generate_issued_pdf, name='generate-issued-pdf'),
     path('reports/overdue-books/pdf/', views.generate_overdue_pdf, name='generate-overdue-pdf'),
+    path('reports/jobs/<int:pk>/', views.report_job, name='report-job'),
+    path('reports/jobs/<int:pk>/download/', views.report_job_download, name='report-job-download'),
     path('notifications/send-due-notifications/', views.send_due_notifications, name='send-due-notifications'),
     path('notifications/send-reservation-notifications/', views.send_reservation_notifications, name='send-reservation-notifications'),
+    path('metrics/book-cache/', views.book_cache_metrics, name='book-cache-metrics'),
     path('profile/update/', views.profile_update, name='profile-update'),
     path('password-change/',
          auth_views.PasswordChangeView.as_view(
@@ -43,17 +46,22 @@ urlpatterns = [
     path('members/', views.member_list, name='member-list'),
     path('books/<int:pk>/edit/', views.book_edit, name='book-edit'),
     path('books/', views.book_list, name='book-list'),
+    path('books/autocomplete/', views.book_autocomplete, name='book-autocomplete'),
+    path('members/autocomplete/', views.member_autocomplete, name='member-autocomplete'),
     path('books/add/', views.add_book, name='book-add'),
     path('books/<int:pk>/', views.book_detail, name='book-detail'),
     path('books/<int:pk>/edit/', views.book_edit, name='book-edit'),
     path('books/<int:pk>/delete/', views.book_delete, name='book-delete'),
     path('books/add/', views.add_book, name='book-add'),
     path('books/issue/', views.issue_book, name='issue-book'),
+    path('books/issue/batch/', views.issue_books_batch, name='issue-books-batch'),
+    path('books/return/batch/', views.return_books_batch, name='return-books-batch'),
     path('books/return/<int:checkout_id>/', views.return_book, name='return-book'),
     path('loans/', include([
         path('', views.loan_list, name='loan-list'),
         path('active/', views.active_loans, name='active-loans'),
         path('history/', views.loan_list, name='loan-history'),
+        path('history/all/', views.loan_history, name='loan-history-all'),
         path('loans/<int:pk>/', views.loan_detail, name='loan-detail'),
     ])),
 ]
\ No newline at end of file
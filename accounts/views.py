@@ -1,36 +1,49 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.shortcuts import get_object_or_404, render, redirect
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
-from django.core.paginator import Paginator
 from django.db import transaction
 from django.utils import timezone
 from django.views.generic import ListView
-from io import BytesIO
 from django.contrib.auth.decorators import user_passes_test
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, JsonResponse
 from .models import Checkout, Reservation, BookSubscription
 from django.http import HttpResponse
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from .models import Checkout
 from .models import Book, Checkout, CustomUser, BookRequest  # Add BookRequest here
+from .models import ReportJob
 from .forms import (
     BookForm, BookSearchForm, CheckoutForm,
     UserRegisterForm, UserLoginForm, UserUpdateForm,
     BookRequestForm  # Make sure this is imported
 )
-from datetime import timedelta
+from .exports import ExportMixin, export_response
+from .pagination import KeysetPaginationMixin, KeysetPaginator, estimates_total
+from .pdf import pdf_response
+from .report_jobs import CONTENT_TYPES
+from .reports import issued_books_pdf, overdue_books_pdf, report_rows
+from .services import issue_books, return_checkouts
+from .search import (
+    AUTOCOMPLETE_MAX_RESULTS, autocomplete_books, autocomplete_members, search_books
+)
+from .book_cache import cache_stats, get_book, get_catalog
+from .facets import book_facets
+from datetime import date, timedelta
+import json
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import condition, require_POST
 from django.db.models import Q
+from django.urls import reverse
 
 
 def home(request):
     context = {
         'welcome_message': 'Welcome to Our Library',
-        'recent_books': Book.objects.order_by('-id')[:4],
+        'recent_books': get_catalog('home', {}, lambda: list(Book.objects.order_by('-id')[:4])),
         'user': request.user
     }
     return render(request, 'accounts/home.html', context)
@@ -51,10 +64,14 @@ def register(request):
 
 @login_required
 def subscribe_to_genre(request, genre):
+    defaults = {'is_active': True}
+    frequency = request.GET.get('frequency')
+    if frequency in dict(BookSubscription.FREQUENCY_CHOICES):
+        defaults['frequency'] = frequency
     BookSubscription.objects.update_or_create(
         member=request.user,
         genre=genre,
-        defaults={'is_active': True}
+        defaults=defaults
     )
     messages.success(request, f"You've subscribed to {dict(Book.GENRE_CHOICES).get(genre)} notifications")
     return redirect('book-list')
@@ -107,10 +124,12 @@ def profile_update(request):
 
 @login_required
 def book_list(request):
-    books = Book.objects.all()
+    books = Book.objects.order_by('title', 'id')
     form = BookSearchForm(request.GET or None)
     
     if form.is_valid():
+        if q := form.cleaned_data['q']:
+            books = search_books(books, q)
         if title := form.cleaned_data['title']:
             books = books.filter(title__icontains=title)
         if author := form.cleaned_data['author']:
@@ -119,13 +138,52 @@ def book_list(request):
             books = books.filter(genre=genre)
         if publisher := form.cleaned_data['publisher']:
             books = books.filter(publisher__icontains=publisher)
+        if availability := form.cleaned_data['availability']:
+            books = books.filter(available__gt=0) if availability == 'yes' else books.filter(available=0)
+        if (decade := form.cleaned_data['decade']) is not None:
+            books = books.filter(
+                publication_date__gte=date(decade, 1, 1),
+                publication_date__lt=date(decade + 10, 1, 1)
+            )
     
-    paginator = Paginator(books, 10)
+    search = form.cleaned_data if form.is_bound and form.is_valid() else {}
+    cursor = request.GET.get('cursor')
+    paginator = KeysetPaginator(books, per_page=10, estimate_total=estimates_total('book_list'))
     return render(request, 'accounts/book_list.html', {
-        'page_obj': paginator.get_page(request.GET.get('page')),
+        'page_obj': get_catalog('book_list', {**search, 'cursor': cursor}, lambda: paginator.get_page(cursor)),
+        'facets': book_facets(books, search),
         'form': form
     })
 
+def _autocomplete_limit(request):
+    try:
+        limit = int(request.GET.get('limit', 10))
+    except ValueError:
+        limit = 10
+    return min(max(limit, 1), AUTOCOMPLETE_MAX_RESULTS)
+
+@login_required
+def book_autocomplete(request):
+    books = Book.objects.only('id', 'title', 'author', 'available')
+    if request.GET.get('available') == '1':
+        member = request.GET.get('member', '')
+        books = books.filter(Book.lendable_filter(int(member) if member.isdigit() else None))
+    books = autocomplete_books(books, request.GET.get('q', '').strip(), _autocomplete_limit(request))
+    return JsonResponse({'results': [
+        {'id': book.pk, 'text': str(book), 'available': book.available}
+        for book in books
+    ]})
+
+@login_required
+@user_passes_test(lambda u: u.is_librarian_or_admin())
+def member_autocomplete(request):
+    members = CustomUser.objects.filter(user_type=3).only('id', 'username')
+    members = autocomplete_members(members, request.GET.get('q', '').strip(), _autocomplete_limit(request))
+    return JsonResponse({'results': [
+        {'id': member.pk, 'text': str(member)}
+        for member in members
+    ]})
+
 @login_required
 @user_passes_test(lambda u: u.is_librarian_or_admin())
 def add_book(request):
@@ -143,7 +201,10 @@ def add_book(request):
 
 @login_required
 def book_detail(request, pk):
-    book = get_object_or_404(Book, pk=pk)
+    try:
+        book = get_book(pk)
+    except Book.DoesNotExist:
+        raise Http404("No book found")
     return render(request, 'accounts/book_detail.html', {'book': book})
 
 @login_required
@@ -173,12 +234,18 @@ def book_delete(request, pk):
 @login_required
 def member_list(request):
     members = CustomUser.objects.filter(user_type=3)
-    return render(request, 'accounts/member_list.html', {'members': members})
+    return render(request, 'accounts/member_list.html', {
+        'members': members,
+        'max_active_loans': settings.MAX_ACTIVE_LOANS,
+    })
 
 @login_required
 def member_detail(request, pk):
     member = get_object_or_404(CustomUser, pk=pk)
-    return render(request, 'accounts/member_detail.html', {'member': member})
+    return render(request, 'accounts/member_detail.html', {
+        'member': member,
+        'max_active_loans': settings.MAX_ACTIVE_LOANS,
+    })
 
 @login_required
 @user_passes_test(lambda u: u.is_librarian_or_admin())
@@ -190,9 +257,9 @@ def issue_book(request):
                 with transaction.atomic():
                     checkout = form.save(commit=False)
                     checkout.checkout_date = timezone.now()
-                    if not checkout.book.checkout_copies(checkout.quantity):
-                        raise ValidationError("Not enough copies available")
                     checkout.save()
+                    if not checkout.book.checkout_copies(checkout.quantity, checkout=checkout):
+                        raise ValidationError("Not enough copies available")
                     messages.success(request, 
                         f'Checked out {checkout.quantity} copy(ies) of "{checkout.book.title}"')
                     return redirect('active-loans')
@@ -208,6 +275,38 @@ def issue_book(request):
     
     return render(request, 'accounts/issue_book.html', {'form': form})
 
+@login_required
+@user_passes_test(lambda u: u.is_librarian_or_admin())
+@require_POST
+def issue_books_batch(request):
+    """
+    Issue a stack of books to one member at once. Expects JSON like
+    {"member": 7, "due_date": "2025-05-01T12:00:00Z", "items": [{"book": 3, "quantity": 1}, ...]}
+    """
+    try:
+        payload = json.loads(request.body)
+        member = CustomUser.objects.get(pk=payload['member'], user_type=3)
+        items = [(item['book'], item.get('quantity', 1)) for item in payload['items']]
+        due_date = None
+        if payload.get('due_date'):
+            due_date = parse_datetime(payload['due_date'])
+            if due_date is None:
+                raise ValueError(f"Bad due date {payload['due_date']!r}")
+    except CustomUser.DoesNotExist:
+        return JsonResponse({'status': 'error', 'error': 'No such member'}, status=400)
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'status': 'error', 'error': 'Malformed request'}, status=400)
+
+    try:
+        results = issue_books(member, items, due_date)
+    except (ValueError, TypeError):
+        return JsonResponse({'status': 'error', 'error': 'Book ids and quantities must be integers'}, status=400)
+    return JsonResponse({
+        'status': 'success',
+        'issued': sum(1 for result in results if result['issued']),
+        'results': results,
+    })
+
 @login_required
 @user_passes_test(lambda u: u.is_librarian_or_admin())
 def return_book(request, checkout_id):
@@ -241,30 +340,54 @@ def return_book(request, checkout_id):
 
 @login_required
 def loan_list(request):
-    loans = Checkout.objects.all()
+    loans = Checkout.objects.select_related('book', 'member')
     if request.user.is_member():
         loans = loans.filter(member=request.user)
-    return render(request, 'accounts/loan_list.html', {'loans': loans.order_by('-checkout_date')})
+    paginator = KeysetPaginator(loans, ('-checkout_date', '-id'), per_page=25, estimate_total=estimates_total('loan_list'))
+    return render(request, 'accounts/loan_list.html', {'loans': paginator.get_page(request.GET.get('cursor'))})
 
 @login_required
 def loan_history(request):
     loans = Checkout.objects.all()
-    
-    # For existing records without the new fields
-    for loan in loans:
-        if not hasattr(loan, 'daily_fine_rate'):
-            loan.daily_fine_rate = 10.00  # Default value
-        if not hasattr(loan, 'total_fine'):
-            loan.total_fine = 0.00
-    
-    return render(request, 'accounts/loan_history.html', {'loans': loans})
+    if request.user.is_member():
+        loans = loans.filter(member=request.user)
+
+    # ?export=csv|xlsx streams every loan instead of rendering the page
+    export = export_response(
+        request, loans.order_by('-checkout_date', '-id'), 'loan_history',
+        ('id', 'book', 'member', 'checkout_date', 'due_date', 'returned', 'return_date', 'total_fine'),
+    )
+    if export:
+        return export
+
+    paginator = KeysetPaginator(loans.select_related('book', 'member'), ('-checkout_date', '-id'), per_page=25)
+    return render(request, 'accounts/loan_history.html', {'checkouts': paginator.get_page(request.GET.get('cursor'))})
 
 @login_required
 def active_loans(request):
-    loans = Checkout.objects.filter(returned=False)
+    loans = Checkout.objects.filter(returned=False).select_related('book', 'member')
     if request.user.is_member():
         loans = loans.filter(member=request.user)
-    return render(request, 'accounts/active_loans.html', {'checkouts': loans})  # <-- 'checkouts' is important
+    paginator = KeysetPaginator(loans, ('-checkout_date', '-id'), per_page=25, estimate_total=estimates_total('active_loans'))
+    return render(request, 'accounts/active_loans.html', {'checkouts': paginator.get_page(request.GET.get('cursor'))})  # <-- 'checkouts' is important
+
+@login_required
+@user_passes_test(lambda u: u.is_librarian_or_admin())
+@require_POST
+def return_books_batch(request):
+    """
+    Return station / book drop. Expects JSON like
+    {"checkouts": [12, 13], "barcodes": ["0000042-0001", ...]}
+    """
+    try:
+        payload = json.loads(request.body)
+        checkout_ids = [int(checkout_id) for checkout_id in payload.get('checkouts', [])]
+        barcodes = [str(barcode).strip() for barcode in payload.get('barcodes', [])]
+    except (ValueError, TypeError, AttributeError):
+        return JsonResponse({'status': 'error', 'error': 'Malformed request'}, status=400)
+
+    report = return_checkouts(checkout_ids, barcodes)
+    return JsonResponse({'status': 'success', **report})
 
 @login_required
 @user_passes_test(lambda u: u.is_librarian_or_admin())
@@ -370,10 +493,17 @@ def loan_detail(request, pk):
     }
     return render(request, 'accounts/loan_detail.html', context)
 
-class IssuedBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ListView):
+class IssuedBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ExportMixin, KeysetPaginationMixin, ListView):
     model = Checkout
     template_name = 'accounts/reports/issued_books.html'
     context_object_name = 'checkouts'
+    paginate_by = 50
+    keyset_ordering = ('due_date', 'id')
+    listing = 'issued_books'
+    export_filename = 'issued_books'
+    export_report = ReportJob.ISSUED
+    export_columns = ('id', 'book', 'member', 'member_name', 'checkout_date', 'due_date', 'quantity')
+    export_ordering = keyset_ordering
     
     def test_func(self):
         return self.request.user.is_staff or self.request.user.is_librarian_or_admin()
@@ -381,10 +511,17 @@ class IssuedBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ListView):
     def get_queryset(self):
         return Checkout.objects.filter(returned=False).select_related('book', 'member')
 
-class OverdueBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ListView):
+class OverdueBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ExportMixin, KeysetPaginationMixin, ListView):
     model = Checkout
     template_name = 'accounts/reports/overdue_books.html'
     context_object_name = 'checkouts'
+    paginate_by = 50
+    keyset_ordering = ('due_date', 'id')
+    listing = 'overdue_books'
+    export_filename = 'overdue_books'
+    export_report = ReportJob.OVERDUE
+    export_columns = ('id', 'book', 'member', 'member_name', 'member_email', 'due_date', 'days_overdue', 'total_fine')
+    export_ordering = keyset_ordering
     
     def test_func(self):
         return self.request.user.is_staff or self.request.user.is_librarian_or_admin()
@@ -399,134 +536,94 @@ class OverdueBooksReportView(LoginRequiredMixin, UserPassesTestMixin, ListView):
 def generate_issued_pdf(request):
     if not request.user.is_staff and not request.user.is_librarian_or_admin():
         return HttpResponse("Unauthorized", status=401)
-    
-    from .models import Checkout
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="issued_books.pdf"'
-    
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    
-    # Header
-    p.setFont("Helvetica-Bold", 16)
-    p.drawString(100, 750, "Currently Issued Books Report")
-    p.setFont("Helvetica", 12)
-    p.drawString(100, 730, f"Generated on: {timezone.now().strftime('%Y-%m-%d %H:%M')}")
-    
-    # Table Header
-    p.drawString(100, 700, "Book Title")
-    p.drawString(300, 700, "Member")
-    p.drawString(450, 700, "Due Date")
-    p.drawString(550, 700, "Status")
-    
-    # Table Content
-    y = 680
-    p.setFont("Helvetica", 10)
-    checkouts = Checkout.get_issued_books_report()
-    
-    for checkout in checkouts:
-        p.drawString(100, y, checkout.book.title[:30])  # Limit title length
-        p.drawString(300, y, checkout.member.get_full_name())
-        p.drawString(450, y, checkout.due_date.strftime('%Y-%m-%d'))
-        
-        if checkout.is_overdue:
-            status = f"Overdue ({checkout.days_overdue} days)"
-            p.setFillColorRGB(1, 0, 0)  # Red
-        elif checkout.due_soon:
-            status = "Due Soon"
-            p.setFillColorRGB(1, 0.5, 0)  # Orange
-        else:
-            status = "On Time"
-            p.setFillColorRGB(0, 0.5, 0)  # Green
-            
-        p.drawString(550, y, status)
-        p.setFillColorRGB(0, 0, 0)  # Reset to black
-        y -= 20
-        
-        if y < 50:  # New page if running out of space
-            p.showPage()
-            y = 750
-    
-    p.showPage()
-    p.save()
-    
-    pdf = buffer.getvalue()
-    buffer.close()
-    response.write(pdf)
-    return response
+    if request.GET.get('async'):
+        job = ReportJob.request(ReportJob.ISSUED, 'pdf', user=request.user)
+        return redirect('report-job', pk=job.pk)
+
+    # Pages go out as they're drawn; only the current one is ever in memory
+    checkouts = report_rows(Checkout.get_issued_books_report())
+    return pdf_response("issued_books.pdf", issued_books_pdf(checkouts))
 
 def generate_overdue_pdf(request):
     if not request.user.is_staff and not request.user.is_librarian_or_admin():
         return HttpResponse("Unauthorized", status=401)
-    
-    from .models import Checkout
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = 'attachment; filename="overdue_books.pdf"'
-    
-    buffer = BytesIO()
-    p = canvas.Canvas(buffer, pagesize=letter)
-    
-    # Header
-    p.setFont("Helvetica-Bold", 16)
-    p.drawString(100, 750, "Overdue Books Report")
-    p.setFont("Helvetica", 12)
-    p.drawString(100, 730, f"Generated on: {timezone.now().strftime('%Y-%m-%d %H:%M')}")
-    
-    # Table Header
-    p.drawString(100, 700, "Book Title")
-    p.drawString(300, 700, "Member")
-    p.drawString(450, 700, "Due Date")
-    p.drawString(550, 700, "Days Overdue")
-    p.drawString(650, 700, "Fine")
-    
-    # Table Content
-    y = 680
-    p.setFont("Helvetica", 10)
-    checkouts = Checkout.get_overdue_books_report()
-    
-    for checkout in checkouts:
-        p.drawString(100, y, checkout.book.title[:30])
-        p.drawString(300, y, checkout.member.get_full_name())
-        p.drawString(450, y, checkout.due_date.strftime('%Y-%m-%d'))
-        p.drawString(550, y, str(checkout.days_overdue))
-        p.drawString(650, y, f"${checkout.total_fine:.2f}")
-        y -= 20
-        
-        if y < 50:
-            p.showPage()
-            y = 750
-    
-    p.showPage()
-    p.save()
-    
-    pdf = buffer.getvalue()
-    buffer.close()
-    response.write(pdf)
+    if request.GET.get('async'):
+        job = ReportJob.request(ReportJob.OVERDUE, 'pdf', user=request.user)
+        return redirect('report-job', pk=job.pk)
+
+    checkouts = report_rows(Checkout.get_overdue_books_report())
+    return pdf_response("overdue_books.pdf", overdue_books_pdf(checkouts))
+
+
+def can_view_reports(user):
+    return user.is_authenticated and (user.is_staff or user.is_librarian_or_admin())
+
+
+def report_job_status(job):
+    return {
+        'id': job.pk,
+        'status': job.status,
+        'status_display': job.get_status_display(),
+        'requests': job.requests,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'download_url': reverse('report-job-download', args=[job.pk]) if job.status == ReportJob.DONE else None,
+        'error': job.error,
+    }
+
+
+@user_passes_test(can_view_reports)
+def report_job(request, pk):
+    """The page a queued report lands on; it polls report_job_status until the file is ready"""
+    job = get_object_or_404(ReportJob, pk=pk)
+    if request.GET.get('format') == 'json':
+        return JsonResponse(report_job_status(job))
+    return render(request, 'accounts/reports/report_job.html', {'job': job, 'status': report_job_status(job)})
+
+
+def finished_report(pk):
+    return ReportJob.objects.filter(pk=pk, status=ReportJob.DONE).exclude(file='').first()
+
+
+def report_etag(request, pk):
+    job = finished_report(pk)
+    return f"{job.key[:16]}-{job.pk}" if job else None
+
+
+def report_last_modified(request, pk):
+    job = finished_report(pk)
+    return job.finished_at if job else None
+
+
+# A job's file is written once and never changes, so a browser can keep its copy
+# for as long as the worker keeps the file (a day, by default) and after that
+# revalidate it against the ETag/Last-Modified
+@user_passes_test(can_view_reports)
+@condition(etag_func=report_etag, last_modified_func=report_last_modified)
+def report_job_download(request, pk):
+    job = finished_report(pk)
+    if job is None:
+        raise Http404("That report isn't ready")
+    response = FileResponse(
+        job.file.open('rb'), as_attachment=True, filename=job.filename, content_type=CONTENT_TYPES[job.format],
+    )
+    response['Cache-Control'] = 'private, max-age=86400'
     return response
 
 
 @user_passes_test(lambda u: u.is_staff)
 def send_due_notifications(request):
-    checkouts = Checkout.objects.filter(
-        returned=False,
-        due_date__lte=timezone.now() + timedelta(days=3)
-    )
-    count = 0
-    for checkout in checkouts:
-        checkout.send_due_notification()
-        count += 1
-    return JsonResponse({'status': 'success', 'notifications_sent': count})
+    # Only loans that have reached a reminder stage they haven't been sent yet
+    queued = Checkout.queue_due_notices()
+    return JsonResponse({'status': 'success', 'notifications_queued': queued})
 
 @user_passes_test(lambda u: u.is_staff)
 def send_reservation_notifications(request):
-    reservations = Reservation.objects.filter(
-        notified=False,
-        book__available__gt=0
-    )
-    count = 0
-    for reservation in reservations:
-        reservation.send_available_notification()
-        reservation.notified = True
-        reservation.save()
-        count += 1
-    return JsonResponse({'status': 'success', 'notifications_sent': count})
\ No newline at end of file
+    # One copy per waiting member, oldest reservation first
+    with transaction.atomic():
+        queued = Reservation.allocate_holds()
+    return JsonResponse({'status': 'success', 'notifications_queued': queued})
+
+@user_passes_test(lambda u: u.is_staff)
+def book_cache_metrics(request):
+    return JsonResponse(cache_stats())
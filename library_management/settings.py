@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'accounts.apps.AccountsConfig',
     'crispy_forms',
     'crispy_bootstrap4',
@@ -65,6 +66,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'accounts.context_processors.subscriptions',
             ],
         },
     },
@@ -87,6 +89,16 @@ DATABASES = {
     }
 }
 
+# Shared by every web worker and management command, so a cache invalidation in
+# one process is seen by all of them (a per-process LocMemCache would not be).
+# Create the table with `manage.py createcachetable`; swap in RedisCache where there is one.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'django_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -143,10 +155,20 @@ CRISPY_TEMPLATE_PACK = "bootstrap4"
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Rendered reports hold member details, so they're kept out of the public MEDIA_ROOT
+REPORTS_ROOT = os.path.join(BASE_DIR, 'private', 'reports')
 
 DEFAULT_DAILY_FINE_RATE = 10.00  # $10 per day
 GRACE_PERIOD_DAYS = 3  # No fine for first 3 days late
 MAX_FINE_DAYS = 30  # Maximum days to charge fine for
+MAX_ACTIVE_LOANS = 10  # Copies a member can have out at once
+DUE_NOTICE_STAGES = [-3, 0, 1, 7]  # Days relative to the due date when a reminder goes out
+HOLD_DAYS = 3  # Days a copy is kept aside for a reservation before it lapses
+REPORT_FRESHNESS = 300  # Seconds a finished background report is handed out again for the same request
+# Listings that show a planner estimate of their size, e.g. {'book_list', 'loan_list', 'active_loans',
+# 'issued_books', 'overdue_books'}. The estimate costs an EXPLAIN per page and can be well off on
+# filtered queries, so listings show no total unless named here.
+ESTIMATED_TOTALS = set()
 
 
 # Email settings
@@ -162,6 +184,10 @@ DEFAULT_FROM_EMAIL = 'noreply@yourdomain.com'
 TWILIO_ACCOUNT_SID = 'your_account_sid'
 TWILIO_AUTH_TOKEN = 'your_auth_token'
 TWILIO_PHONE_NUMBER = '+1234567890'
+TWILIO_API_BASE = 'https://api.twilio.com'  # point at a local fake in tests
+SMS_CONCURRENCY = 8  # requests in flight at once
+SMS_RATE_LIMIT = 10  # messages per second the provider allows us
+SMS_TIMEOUT = 10  # seconds
 
 # Site info for emails
 SITE_NAME = "Your Library Name"